@@ -10,10 +10,36 @@
 
 import arcpy 
 
+import multiprocessing 
+
+import multiprocessing.util 
+
+import numpy as np 
+
 import os 
 
 import time 
 
+from ContourGeometry import closed_rings, highest_enclosing_contour 
+
+from ContourSearch import summarise_search_stats 
+
+from DemTileCache import DemTileCache, RasterioBlockSource, WindowReader, crop_window 
+
+from ElevationBackends import ArcpyBackend, ArcpyDemReader, NumpyBackend, crest_analysis, polygon_rings, read_dem_window 
+
+from GeoPackageWriter import GeoPackageWriter 
+
+from PriorityFlood import crest_level 
+
+from RunManifest import RunManifest, file_signature, input_hash 
+
+from StageProfiler import StageProfiler 
+
+from StorageClusters import buffer_extent, cluster_storages, print_plan 
+
+from TilePlanner import quadtree_tiles 
+
 def create_tiles(extent, tile_size): 
 
     # Function to create a grid of tiles covering the given extent 
@@ -32,21 +58,473 @@ def create_tiles(extent, tile_size):
 
     return tiles 
 
-def run_model_builder_script(): 
+def contour_parts(contour_shape): 
+
+    # Vertex arrays of every part of an arcpy polyline 
+
+    return [[(p.X, p.Y) for p in part if p] for part in contour_shape] 
+
+def geometry_highest_contour(Contour_Clip, point, profiler=None, oid=None): 
+
+    # Find the highest closed contour enclosing the point with the pure geometry engine 
+
+    # Every closed ring is tested against the point in a single vectorized pass 
+
+    profiler = profiler or StageProfiler() 
+
+    contour_shapes = [] 
+
+    contours = [] 
+
+    with profiler.stage("contour-read", oid) as counts: 
+
+        with arcpy.da.SearchCursor(Contour_Clip, ["SHAPE@", "Contour"], spatial_reference=point.spatialReference) as contour_cursor: 
+
+            for contour_shape, contour_elevation in contour_cursor: 
+
+                contour_shapes.append(contour_shape) 
+
+                contours.append((contour_elevation, contour_parts(contour_shape))) 
+
+        counts["count"] = len(contours) 
+
+    with profiler.stage("enclosure-test", oid) as counts: 
+
+        rings, levels, sources = closed_rings(contours) 
+
+        centroid = point.firstPoint 
+
+        index, highest_elevation = highest_enclosing_contour((centroid.X, centroid.Y), rings, levels) 
+
+        counts["count"] = len(rings) 
+
+    if index is None: 
+
+        return None 
+
+    print(f"Highest elevation: {highest_elevation}") 
+
+    return {"shape": contour_shapes[sources[index]], "Contour": highest_elevation} 
+
+def flood_highest_contour(DEM, point, buffer_distance, dem_cache=None, dem_window=None, profiler=None, oid=None): 
+
+    # Find the crest level with the priority-flood solver on the DEM window, skipping contour generation 
+
+    # dem_window is the (array, transform) window shared by the storage's cluster when clustering 
+
+    profiler = profiler or StageProfiler() 
+
+    centroid = point.firstPoint 
+
+    xmin, ymin, xmax, ymax = buffer_extent(centroid.X, centroid.Y, buffer_distance) 
+
+    with profiler.stage("dem-window", oid) as counts: 
+
+        if dem_window is not None: 
+
+            dem, transform = crop_window(dem_window[0], dem_window[1], xmin, ymin, xmax, ymax) 
+
+        elif dem_cache is not None: 
+
+            # Block-aligned window from the cache shared with neighbouring storages 
+
+            dem, transform = dem_cache.read_window(xmin, ymin, xmax, ymax) 
+
+        else: 
+
+            dem, transform = read_dem_window(DEM, arcpy.Extent(xmin, ymin, xmax, ymax)) 
+
+        counts["count"] = dem.size 
+
+    with profiler.stage("priority-flood", oid): 
+
+        result = crest_level(dem, transform, (centroid.X, centroid.Y), contour_interval=0.1) 
+
+    if result is None: 
+
+        return None 
+
+    # Inundation polygon at the crest level, outer ring first 
+
+    return {"polygons": [[ring.tolist() for ring in result["rings"]]], "Contour": result["Contour"]} 
+
+def numpy_highest_contour(DEM, point, buffer_distance, search="bisect", dem_cache=None, dem_window=None, profiler=None, oid=None): 
+
+    # Find the highest closed contour with the licence-free NumPy backend (ElevationBackends.py) 
+
+    # Contours are traced from the DEM window only at the levels the search tests 
+
+    if dem_window is not None: 
+
+        dem_reader = WindowReader(*dem_window) 
+
+    else: 
+
+        dem_reader = dem_cache if dem_cache is not None else ArcpyDemReader(DEM) 
+
+    centroid = point.firstPoint 
+
+    return crest_analysis(NumpyBackend(dem_reader), centroid.X, centroid.Y, buffer_distance, search=search, profiler=profiler, oid=oid) 
+
+def open_dem_cache(settings): 
+
+    # Block-cached reader over the DEM GeoTIFF for the DEM window engines (DemTileCache.py), None when disabled 
+
+    if settings["engine"] not in ("flood", "numpy") or not settings["dem_cache_blocks"]: 
+
+        return None 
+
+    # dem_cache_blocks=True sizes the cache from the widest window read (the buffer extent or the largest cluster envelope) 
+
+    max_blocks = None if settings["dem_cache_blocks"] is True else settings["dem_cache_blocks"] 
+
+    source = RasterioBlockSource(os.path.join(arcpy.env.workspace, settings["DEM"])) 
+
+    return DemTileCache(source, max_blocks=max_blocks, window_size=settings["dem_window"]) 
+
+def contour_polygons(contour_shape, polygon_temp): 
+
+    # Convert a closed contour line to polygon parts for the GeoPackage writer 
+
+    arcpy.management.FeatureToPolygon(contour_shape, polygon_temp) 
+
+    polygons = [] 
+
+    with arcpy.da.SearchCursor(polygon_temp, ["SHAPE@"]) as cursor: 
+
+        for (polygon,) in cursor: 
+
+            polygons.extend(polygon_rings(polygon)) 
+
+    arcpy.Delete_management(polygon_temp) 
+
+    return polygons 
+
+def open_polygon_writer(path, layer, spatial_reference, resume=True): 
+
+    # Single GeoPackage layer receiving every storage's polygon (GeoPackageWriter.py) 
+
+    # factoryCode is 0 for a custom spatial reference, which gets its own srs_id instead of the undefined geographic SRS 
+
+    srs = (spatial_reference.factoryCode or None, spatial_reference.name, spatial_reference.exportToString().split(";")[0]) 
+
+    return GeoPackageWriter(path, layer, srs, [("StorageID", "INTEGER"), ("Contour", "REAL")], overwrite=not resume) 
+
+# State of the current process; pool workers replace it in init_worker 
+
+worker_state = {"scratch": "main", "scratch_folder": "", "settings": None, "dem_cache": None} 
+
+def init_worker(workspace, scratch_root, settings): 
+
+    # Pool initializer: give every worker process its own arcpy environment, scratch folder and DEM cache 
+
+    scratch = f"w{os.getpid()}" 
+
+    scratch_folder = os.path.join(scratch_root, scratch) 
+
+    os.makedirs(scratch_folder, exist_ok=True) 
+
+    arcpy.env.overwriteOutput = True 
+
+    if settings["engine"] in ("arcpy", "geometry"): 
+
+        arcpy.CheckOutExtension("3D") 
+
+        arcpy.CheckOutExtension("spatial") 
+
+    arcpy.env.workspace = workspace 
+
+    arcpy.env.scratchWorkspace = scratch_folder 
+
+    dem_cache = open_dem_cache(settings) 
+
+    if dem_cache is not None: 
+
+        # Close the cache's DEM dataset when the worker exits (the pool is closed and joined, not terminated) 
+
+        multiprocessing.util.Finalize(None, dem_cache.close, exitpriority=10) 
+
+    worker_state.update(scratch=scratch, scratch_folder=scratch_folder, settings=settings, dem_cache=dem_cache) 
+
+def process_storage(oid, point, settings, scratch="main", scratch_folder="", dem_cache=None, shared=None): 
+
+    # Crest analysis for a single storage 
+
+    # shared holds the cluster's DEM window or contours when clustering (see process_cluster) 
+
+    # Returns the oid, the contour level, its polygon parts (None if nothing encloses it) and run statistics 
+
+    # including the storage's stage timings (StageProfiler.py) 
+
+    print(f"Processing point {oid}...") 
+
+    DEM2 = settings["DEM"] 
+
+    engine = settings["engine"] 
+
+    shared = shared or {} 
+
+    profiler = StageProfiler() 
+
+    # Square extent of the buffer around the current point 
+
+    centroid = point.firstPoint 
+
+    extent = arcpy.Extent(*buffer_extent(centroid.X, centroid.Y, settings["buffer_distance"])) 
+
+    contour_temp = f"memory\\contour_temp_{scratch}_{oid}" 
+
+    if engine == "arcpy": 
+
+        # Shared crest engine on arcpy.sa.Contour and FeatureToPolygon, clipping the cluster's contours when clustering 
+
+        backend = ArcpyBackend(DEM2, scratch, point.spatialReference, shared.get("contours")) 
+
+        highest_contour = crest_analysis(backend, centroid.X, centroid.Y, settings["buffer_distance"], search=settings["search"], 
+
+                                         profiler=profiler, oid=oid) 
+
+    elif engine == "flood": 
+
+        highest_contour = flood_highest_contour(DEM2, point, settings["buffer_distance"], dem_cache, shared.get("dem"), profiler, oid) 
+
+    elif engine == "numpy": 
+
+        highest_contour = numpy_highest_contour(DEM2, point, settings["buffer_distance"], settings["search"], dem_cache, shared.get("dem"), 
+
+                                                profiler, oid) 
+
+    else: 
+
+        # Perform contour analysis for the geometry engine 
+
+        Contour_Clip = os.path.join(scratch_folder, f"Contours_DEM_Clip_{oid}.shp")  # Modify output name 
+
+        with profiler.stage("contour", oid): 
+
+            if "contours" in shared: 
+
+                # Cut this storage's extent out of the contours extracted once for the cluster 
+
+                arcpy.analysis.Clip(shared["contours"], extent.polygon, Contour_Clip) 
+
+            else: 
+
+                with arcpy.EnvManager(extent=extent, snapRaster=DEM2): 
+
+                    contour_result = arcpy.sa.Contour(DEM2, contour_temp, 0.1, 0, 1, "CONTOUR", None) 
+
+                    arcpy.CopyFeatures_management(contour_result, Contour_Clip) 
+
+                arcpy.Delete_management(contour_temp) 
+
+        highest_contour = geometry_highest_contour(Contour_Clip, point, profiler, oid) 
+
+    print (f"Point {oid} processing complete.") 
+
+    polygons = None 
+
+    if highest_contour: 
+
+        extracted_info = {"Contour": highest_contour["Contour"]} 
+
+        print(extracted_info) 
+
+        try: 
+
+            with profiler.stage("polygon-write", oid): 
+
+                if "polygons" in highest_contour: 
+
+                    # Polygon from the shared crest engine (arcpy or NumPy backend) or the priority-flood solver 
+
+                    polygons = highest_contour["polygons"] 
+
+                else: 
+
+                    # Convert contour line to polygon; the main process streams it into the merged GeoPackage 
+
+                    polygons = contour_polygons(highest_contour["shape"], f"memory\\ContourPolygon_{scratch}_{oid}") 
+
+            print("Contour line converted to polygon successfully.") 
+
+        except arcpy.ExecuteError as e: 
+
+            print(f"Error converting contour to polygon: {e}") 
+
+            polygons = None 
+
+            # Additional error handling logic here... 
+
+    return { 
+
+        "oid": oid, 
+
+        "worker": scratch, 
+
+        "Contour": highest_contour["Contour"] if highest_contour else None, 
+
+        "polygons": polygons, 
+
+        "search_stats": highest_contour.get("search_stats") if highest_contour else None, 
+
+        "dem_cache": dem_cache.stats() if dem_cache is not None else None, 
+
+        "stages": profiler.export(), 
+
+    } 
+
+def prepare_cluster(envelope, settings, scratch="main", dem_cache=None): 
+
+    # Shared input of a cluster: the DEM window over its envelope (flood and numpy engines) or the contours over it 
+
+    if settings["engine"] in ("flood", "numpy"): 
+
+        if dem_cache is not None: 
+
+            return {"dem": dem_cache.read_window(*envelope)} 
+
+        return {"dem": read_dem_window(settings["DEM"], arcpy.Extent(*envelope))} 
+
+    # Contours clipped from the envelope are not identical to contours of the storage's own extent along its edge: 
+
+    # Contour stops at the last cell centre inside an extent, while Clip cuts the envelope's lines at the extent 
+
+    # boundary. A contour passing through that outer half cell is open in a per-storage run but can close (and be 
+
+    # reported) in a cluster run; anything further inside than half a cell is the same in both 
+
+    cluster_contours = f"memory\\cluster_contours_{scratch}" 
+
+    with arcpy.EnvManager(extent=arcpy.Extent(*envelope), snapRaster=settings["DEM"]): 
+
+        arcpy.sa.Contour(settings["DEM"], cluster_contours, 0.1, 0, 1, "CONTOUR", None) 
+
+    return {"contours": cluster_contours} 
+
+def process_cluster(cluster, points, settings, scratch="main", scratch_folder="", dem_cache=None): 
+
+    # Extract once per cluster envelope, then answer every storage of the cluster from the shared result 
+
+    print(f"Processing cluster {cluster['cluster']} ({len(cluster['oids'])} storages)...") 
+
+    start_time = time.time() 
+
+    shared = prepare_cluster(cluster["envelope"], settings, scratch, dem_cache) 
+
+    extract_time = time.time() - start_time 
+
+    results = [process_storage(oid, points[oid], settings, scratch, scratch_folder, dem_cache, shared) for oid in cluster["oids"]] 
+
+    # The shared extraction is split evenly over the cluster's storages rather than charged to one of them 
+
+    profiler = StageProfiler() 
+
+    profiler.share("cluster-extract", cluster["oids"], extract_time) 
+
+    for result, record in zip(results, profiler.export()): 
+
+        result["stages"].append(record) 
+
+    if "contours" in shared: 
+
+        arcpy.Delete_management(shared["contours"]) 
+
+    return results 
+
+def rebuild_point(x, y, spatial_reference): 
+
+    # Centroid geometry from the coordinates and spatial reference string sent to a pool worker 
+
+    sr = arcpy.SpatialReference() 
+
+    sr.loadFromString(spatial_reference) 
+
+    return arcpy.PointGeometry(arcpy.Point(x, y), sr) 
+
+def process_storage_task(task): 
+
+    # Pool entry point for a single storage: rebuild the centroid geometry inside the worker and run it 
+
+    oid, x, y, spatial_reference = task 
+
+    return [process_storage(oid, rebuild_point(x, y, spatial_reference), worker_state["settings"], worker_state["scratch"], 
+
+                            worker_state["scratch_folder"], worker_state["dem_cache"])] 
+
+def process_cluster_task(task): 
+
+    # Pool entry point for a whole cluster of storages 
+
+    cluster, storages = task 
+
+    points = {oid: rebuild_point(x, y, spatial_reference) for oid, x, y, spatial_reference in storages} 
+
+    return process_cluster(cluster, points, worker_state["settings"], worker_state["scratch"], worker_state["scratch_folder"], 
+
+                           worker_state["dem_cache"]) 
+
+def run_model_builder_script(engine="arcpy", workers=1, search="linear", dem_cache_blocks=0, cluster=False, resume=True, 
+
+                             max_storages=20, max_pixels=8192 * 8192): 
 
     """ 
 
     Function to run the ModelBuilder generated script. 
 
+    engine selects the enclosure test: "arcpy" (FeatureToPolygon per contour, on the shared crest engine of 
+
+    ElevationBackends.py) or "geometry" (ContourGeometry.py). 
+
+    engine="flood" skips contours altogether and solves the crest level on the DEM window (PriorityFlood.py). 
+
+    engine="numpy" runs the shared crest engine on the licence-free NumPy backend (ElevationBackends.py), tracing 
+
+    contours from the DEM window with marching squares. 
+
+    workers > 1 fans the storages out over a process pool, each worker with its own scratch namespace. 
+
+    search="bisect" bisects the sorted contour levels in the arcpy and numpy engines instead of testing every contour (ContourSearch.py). 
+
+    dem_cache_blocks > 0 serves the flood and numpy engines' DEM windows from an LRU cache of that many blocks (DemTileCache.py), 
+
+    shared by every storage in the run (one cache per worker process); dem_cache_blocks=True sizes it to two of the 
+
+    largest windows read, since a cache smaller than one window misses on every block (a 7000 m window at 1 m is 
+
+    about 800 blocks of 256 x 256). 
+
+    cluster=True groups storages with overlapping buffers (StorageClusters.py) and extracts contours or reads the 
+
+    DEM window once per cluster envelope. The DEM window engines crop exactly the cells of each storage's buffer 
+
+    extent; the contour engines can differ from a per-storage run along the buffer edge (see prepare_cluster). 
+
+    cluster="quadtree" uses adaptive tiles as the clusters instead (TilePlanner.quadtree_tiles): each tile holds at most 
+
+    max_storages storages and an envelope of at most max_pixels DEM cells, giving balanced work units for the pool. 
+
+    Stage timings of every storage are written to stage_profile.json/.csv in the output folder (StageProfiler.py). 
+
+    Every finished storage is streamed into the WS_poly_Surface239.gpkg layer in batched transactions (GeoPackageWriter.py) 
+
+    and recorded in run_manifest.jsonl (RunManifest.py) once its batch is committed; with resume=True a restarted run 
+
+    skips the storages already complete with the same inputs. 
+
     """ 
 
     # Set arcpy environment settings 
 
     arcpy.env.overwriteOutput = True 
 
-    arcpy.CheckOutExtension("3D") 
+    if engine in ("arcpy", "geometry"): 
+
+        # The DEM window engines need no Spatial Analyst or 3D Analyst licence 
 
-    arcpy.CheckOutExtension("spatial") 
+        arcpy.CheckOutExtension("3D") 
+
+        arcpy.CheckOutExtension("spatial") 
 
     # Set the workspace 
 
@@ -54,12 +532,14 @@ def run_model_builder_script():
 
     # Define Paths 
 
-        DEM2 = "Merged_DEM.tif" 
+    DEM2 = "Merged_DEM.tif" 
 
     WaterStorage = "Sample_1" 
 
     output_folder = r"C:\projects\Crest DEM Clip\outputs\Surface1" 
 
+    buffer_distance = 3500  # Metres, adjust as needed 
+
     start_time = time.time()      
 
     # Identify centroid of water storage 
@@ -72,183 +552,235 @@ def run_model_builder_script():
 
     FarmSites = centroid_feature     
 
-    # Define a list to store paths of individual contour polygon shapefiles 
+    settings = {"DEM": DEM2, "output_folder": output_folder, "engine": engine, "search": search, 
 
-    contour_polygon_files = [] 
+                "dem_cache_blocks": dem_cache_blocks, "buffer_distance": buffer_distance} 
 
     # Iterate over each point in "water storages" 
 
-    with arcpy.da.SearchCursor(WaterStorages, ["OID@", "SHAPE@"]) as cursor: 
+    with arcpy.da.SearchCursor(FarmSites, ["OID@", "SHAPE@"]) as cursor: 
+
+        storages = [(oid, point) for oid, point in cursor] 
+
+    # Skip storages completed by an earlier run with the same inputs. The search strategy (linear fallback on nested 
+
+    # depressions) and the clustering (contours clipped from the cluster envelope) can both change a result 
+
+    manifest = RunManifest(os.path.join(output_folder, "run_manifest.jsonl"), resume) 
+
+    hash_settings = {"DEM": DEM2, "dem_file": file_signature(os.path.join(arcpy.env.workspace, DEM2)), "engine": engine, 
+
+                     "buffer_distance": buffer_distance, "search": search, 
+
+                     "cluster": [cluster, max_storages, max_pixels] if cluster == "quadtree" else cluster} 
+
+    hashes = {oid: input_hash(oid, point.firstPoint.X, point.firstPoint.Y, hash_settings) for oid, point in storages} 
+
+    completed = manifest.completed(hashes) 
+
+    # Polygons are streamed into one GeoPackage layer as storages finish, so a partial result is always available 
 
-        for oid, point in cursor: 
+    output_merged_gpkg = os.path.join(output_folder, "WS_poly_Surface239.gpkg") 
 
-            print(f"Processing point {oid}...") 
+    writer = open_polygon_writer(output_merged_gpkg, "WS_poly_Surface239", arcpy.Describe(FarmSites).spatialReference, resume) 
 
-            # Create a buffer for the current point 
+    # Drop polygons written in a batch whose storages never reached the manifest 
 
-            buffer_distance = "3500 Meters"  # Adjust as needed 
+    writer.prune("StorageID", completed) 
 
-            Buffer = f"FarmSites_Buffer_{oid}.shp" 
+    storages = [(oid, point) for oid, point in storages if oid not in completed] 
 
-            arcpy.analysis.Buffer(in_features=point, out_feature_class=Buffer, buffer_distance_or_field=buffer_distance) 
+    print(f"{len(completed)} storages already complete, {len(storages)} to process") 
 
-            # Perform contour analysis 
+    if cluster == "quadtree": 
 
-            Contour_Clip = f"Contours_DEM_Clip_{oid}.shp"  # Modify output name 
+        # Adaptive tiles of nearby storages, balanced by storage count and DEM window size 
 
-            with arcpy.EnvManager(extent=Buffer): 
+        extents = [(oid,) + buffer_extent(point.firstPoint.X, point.firstPoint.Y, buffer_distance) for oid, point in storages] 
 
-                contour_result = arcpy.sa.Contour(DEM2, f"memory\\contour_temp_{oid}",0.1, 0, 1, "CONTOUR", None) 
+        grid_extent = (min(e[1] for e in extents), min(e[2] for e in extents), max(e[3] for e in extents), max(e[4] for e in extents)) if extents else (0, 0, 0, 0) 
 
-                arcpy.CopyFeatures_management(contour_result, Contour_Clip) 
+        tiles = quadtree_tiles(extents, grid_extent, max_storages, max_pixels, arcpy.Describe(DEM2).meanCellWidth, 
 
-            # Measure time for getting maximum elevation 
+                               buffer_distance, assign="centre") 
 
-            start_time_get_max_elevation = time.time() 
+        clusters = [{"cluster": tile["tile"], "oids": tile["oids"], "envelope": tile["envelope"]} for tile in tiles] 
 
-            max_elevation = max([row[0] for row in arcpy.da.SearchCursor(Contour_Clip, ["Contour"])]) 
+        print_plan(storages, clusters, buffer_distance) 
 
-            print("Time taken for getting maximum elevation:", time.time() - start_time_get_max_elevation) 
+    elif cluster: 
 
-            # Measure time for creating feature layer 
+        # Group storages whose buffers overlap so each cluster envelope is processed once 
 
-            start_time_create_feature_layer = time.time() 
+        clusters = cluster_storages([(oid, point.firstPoint.X, point.firstPoint.Y) for oid, point in storages], buffer_distance) 
 
-            arcpy.management.MakeFeatureLayer(FarmSites, "CrestPointLayer") 
+        print_plan(storages, clusters, buffer_distance) 
 
-            print ("Time taken for creating feature layer:", time.time() - start_time_create_feature_layer) 
+    # Widest DEM window read by a storage or cluster, in map units, which the DEM block cache is sized from 
 
-            # Measure time for Near analysis 
+    settings["dem_window"] = 2 * buffer_distance 
 
-            start_time_near_analysis = time.time() 
+    if cluster and clusters: 
 
-            arcpy.analysis.Near(Contour_Clip, "CrestPointLayer", method="GEODESIC") 
+        settings["dem_window"] = max(max(c["envelope"][2] - c["envelope"][0], c["envelope"][3] - c["envelope"][1]) for c in clusters) 
 
-            print("Time taken for Near analysis:", time.time() - start_time_near_analysis) 
+    # Result of every storage processed in this run, keyed by oid 
 
-            # Measure time for geometry check 
+    results = {} 
 
-            start_time_geometry_check = time.time() 
+    profiler = StageProfiler() 
 
-            arcpy.management.CheckGeometry(Contour_Clip) 
+    # Storages written to the GeoPackage but not yet committed, checkpointed when their batch commits 
 
-            print("Time taken for geometry check:", time.time() - start_time_geometry_check) 
+    uncommitted = [] 
 
-            # Create a spatial index on contour lines 
+    def checkpoint(): 
 
-            arcpy.management.AddSpatialIndex(Contour_Clip) 
+        for result in uncommitted: 
 
-            # Bounding box of the current point 
+            manifest.record(result["oid"], hashes[result["oid"]], Contour=result["Contour"]) 
 
-            start_time_bounding_box = time.time() 
+        uncommitted.clear() 
 
-            point_extent = point.extent 
+    def collect(result): 
 
-            print ("Time taken for bounding box:", time.time() - start_time_geometry_check) 
+        results[result["oid"]] = result 
 
-            # Measure time for contour iteration 
+        uncommitted.append(result) 
 
-            start_time_contour_iteration = time.time() 
+        committed = False 
 
-            # Initialize variables to track the highest contour 
+        if result["polygons"]: 
 
-            highest_contour = None 
+            with profiler.stage("append", result["oid"]): 
 
-            highest_elevation = float("-inf") 
+                committed = writer.write(result["polygons"], (result["oid"], result["Contour"])) 
 
-            # Iterate through contours 
+        if committed: 
 
-            with arcpy.da.SearchCursor(Contour_Clip, ["SHAPE@", "Contour", "NEAR_DIST"], spatial_reference=point.spatialReference) as contour_cursor: 
+            checkpoint() 
 
-                for contour_shape, contour_elevation, near_dist in contour_cursor: 
+    if workers <= 1: 
 
-                    # Quick bounding box check 
+        dem_cache = open_dem_cache(settings) 
 
-                    if not contour_shape.extent.contains(point_extent): 
+        if cluster: 
 
-                        continue 
+            points = dict(storages) 
 
-                    # Check if contour elevation is higher than current highest elevation 
+            for storage_cluster in clusters: 
 
-                    if contour_elevation > highest_elevation: 
+                for result in process_cluster(storage_cluster, points, settings, dem_cache=dem_cache): 
 
-                        try: 
+                    collect(result) 
 
-                            # Convert contour feature to polygon 
+        else: 
 
-                            arcpy.management.FeatureToPolygon([contour_shape], r"memory\ContourPolygon") 
+            for oid, point in storages: 
 
-                        except arcpy.ExecuteError as e: 
+                collect(process_storage(oid, point, settings, dem_cache=dem_cache)) 
 
-                            print(f"Error converting contour to polygon: {e}") 
+        if dem_cache is not None: 
 
-                            continue 
+            dem_cache.close() 
 
-                        # Check if point is inside the polygon 
+    else: 
 
-                        arcpy.management.SelectLayerByLocation("CrestPointLayer", "COMPLETELY_WITHIN", 
+        # Fan storages (or whole clusters) out across the pool and collect the per-oid results as they finish 
 
-                                                               r"memory\ContourPolygon") 
+        point_tasks = {oid: (oid, point.firstPoint.X, point.firstPoint.Y, point.spatialReference.exportToString()) 
 
-                        if int(arcpy.management.GetCount("CrestPointLayer")[0]) > 0: 
+                       for oid, point in storages} 
 
-                            highest_contour = {"shape": contour_shape, "Contour": contour_elevation, "near_dist": near_dist} 
+        if cluster: 
 
-                            highest_elevation = contour_elevation 
+            tasks = [(storage_cluster, [point_tasks[oid] for oid in storage_cluster["oids"]]) for storage_cluster in clusters] 
 
-                            print(f"Current contour elevation: {contour_elevation}") 
+            task_function = process_cluster_task 
 
-                            print(f"Highest elevation so far: {highest_elevation}") 
+        else: 
 
-                    if highest_elevation >= max_elevation: 
+            tasks = list(point_tasks.values()) 
 
-                        break 
+            task_function = process_storage_task 
 
-            print (f"Point {oid} processing complete.") 
+        print(f"Processing {len(tasks)} tasks with {workers} workers...") 
 
-            if highest_contour: 
+        scratch_root = os.path.join(output_folder, "scratch") 
 
-                extracted_info = {"Contour": highest_elevation} 
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(arcpy.env.workspace, scratch_root, settings)) as pool: 
 
-                print(extracted_info)                 
+            for task_results in pool.imap_unordered(task_function, tasks): 
 
-                try: 
+                for result in task_results: 
 
-                    # Define the output polygon feature class path 
+                    collect(result) 
 
-                    output_polygon_path = os.path.join(output_folder, f"ContourPolygon_{oid}.shp") 
+            # Let the workers exit normally so their finalizers close the DEM caches 
 
-                    # Convert contour line to polygon and save it in the output folder 
+            pool.close() 
 
-                    arcpy.management.FeatureToPolygon(highest_contour["shape"], output_polygon_path) 
+            pool.join() 
 
-                    contour_polygon_files.append(output_polygon_path) 
+    # Commit the last batch and build the spatial index once 
 
-                    print("Contour line converted to polygon and saved successfully.") 
+    with profiler.stage("merge"): 
 
-                except arcpy.ExecuteError as e: 
+        writer.close() 
 
-                    print(f"Error converting contour to polygon: {e}")                     
+    checkpoint() 
 
-                    # Additional error handling logic here... 
+    search_stats = [result["search_stats"] for result in results.values() if result["search_stats"]] 
 
-            # Clean up intermediate files 
+    if search_stats: 
 
-            arcpy.Delete_management(Buffer) 
+        totals = summarise_search_stats(search_stats) 
 
-            arcpy.Delete_management(f"memory\\contour_temp_{oid}") 
+        print(f"Enclosure tests: {totals['tests']} of {totals['linear_tests']} levels, saved {totals['saved']} " 
+
+              f"({totals['fallbacks']} linear fallbacks)") 
+
+    # Cache statistics: the latest snapshot of each worker's cache 
+
+    cache_stats = {} 
+
+    for result in results.values(): 
+
+        stats = result["dem_cache"] 
+
+        if stats and (result["worker"] not in cache_stats or stats["hits"] + stats["misses"] > 
+
+                      cache_stats[result["worker"]]["hits"] + cache_stats[result["worker"]]["misses"]): 
+
+            cache_stats[result["worker"]] = stats 
+
+    if cache_stats: 
+
+        hits = sum(stats["hits"] for stats in cache_stats.values()) 
+
+        misses = sum(stats["misses"] for stats in cache_stats.values()) 
+
+        print(f"DEM block cache: {hits} hits, {misses} misses ({hits / max(hits + misses, 1):.1%} hit rate)") 
 
  
 
+    # Stage timings of every storage, from this process and the pool workers 
+
+    for result in results.values(): 
+
+        profiler.extend(result["stages"]) 
+
     print ("Contour analysis and additional processing complete.") 
 
-    # Merge all contour polygon shapefiles into a single shapefile 
+    print(f"{len(completed) + len(results)} storages complete, contour polygons written to:", output_merged_gpkg) 
+
+    # Per stage p50/p95/max over storages, to see which stage dominates the run 
 
-    output_merged_shapefile = os.path.join(output_folder, "WS_poly_Surface239.shp") 
+    profiler.print_summary() 
 
-    arcpy.management.Merge(contour_polygon_files, output_merged_shapefile) 
+    profiler.write_json(os.path.join(output_folder, "stage_profile.json")) 
 
-    print("All contour polygons merged successfully into:", output_merged_shapefile) 
+    profiler.write_csv(os.path.join(output_folder, "stage_profile.csv")) 
 
     print("Total execution time:", time.time() - start_time) 
 
@@ -0,0 +1,131 @@
+# ContourGeometry.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Pure geometry point-in-contour engine used by ContourAnalysis.py.
+# Works on plain NumPy coordinate arrays so it runs without arcpy or an ArcGIS licence.
+
+import time
+
+import numpy as np
+
+
+def is_closed_ring(coords, tolerance=1e-6):
+    # A contour part is a closed ring when it has at least three distinct vertices
+    # and its first and last vertices coincide (within tolerance)
+    coords = np.asarray(coords, dtype=float)
+    if len(coords) < 4:
+        return False
+    return bool(np.all(np.abs(coords[0] - coords[-1]) <= tolerance))
+
+
+def closed_rings(contours, tolerance=1e-6):
+    # Split contour polylines into their closed rings
+    # contours is an iterable of (level, parts) where parts is a list of (N, 2) vertex arrays
+    # Open parts (clipped at the buffer edge) can never enclose a point, so they are dropped here
+    # Also returns, for each ring, the index of the contour it came from
+    rings = []
+    levels = []
+    sources = []
+    for index, (level, parts) in enumerate(contours):
+        for part in parts:
+            part = np.asarray(part, dtype=float)
+            if is_closed_ring(part, tolerance):
+                rings.append(part)
+                levels.append(level)
+                sources.append(index)
+    return rings, np.asarray(levels, dtype=float), np.asarray(sources, dtype=np.intp)
+
+
+def pack_rings(rings):
+    # Concatenate every ring into flat edge arrays so all rings can be tested at once
+    # Returns the edge start/end coordinates, the index of the first edge of each ring and the ring extents
+    if not rings:
+        empty = np.empty(0)
+        return empty, empty, empty, empty, np.empty(0, dtype=np.intp), np.empty((0, 4))
+    starts = [c[:-1] for c in rings]
+    ends = [c[1:] for c in rings]
+    edge_counts = np.array([len(s) for s in starts])
+    ring_starts = np.concatenate(([0], np.cumsum(edge_counts)[:-1])).astype(np.intp)
+    start_xy = np.concatenate(starts)
+    end_xy = np.concatenate(ends)
+    extents = np.array([[c[:, 0].min(), c[:, 1].min(), c[:, 0].max(), c[:, 1].max()] for c in rings])
+    return start_xy[:, 0], start_xy[:, 1], end_xy[:, 0], end_xy[:, 1], ring_starts, extents
+
+
+def points_in_rings(points, rings, packed=None):
+    # Vectorized even-odd ray casting of every point against every ring
+    # Returns a boolean matrix of shape (n_points, n_rings)
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    x0, y0, x1, y1, ring_starts, _ = packed if packed is not None else pack_rings(rings)
+    if len(ring_starts) == 0:
+        return np.zeros((len(points), 0), dtype=bool)
+    px = points[:, 0:1]
+    py = points[:, 1:2]
+    # Edges that straddle the horizontal ray through each point
+    straddles = (y0 > py) != (y1 > py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+    crossings = straddles & (px < x_cross)
+    counts = np.add.reduceat(crossings.astype(np.int32), ring_starts, axis=1)
+    return (counts % 2) == 1
+
+
+def highest_enclosing_contours(points, rings, levels):
+    # Single pass over all rings: for each point return the index of the highest ring enclosing it
+    # Returns an array of ring indices, with -1 where no closed contour encloses the point
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    packed = pack_rings(rings)
+    extents = packed[5]
+    result = np.full(len(points), -1, dtype=np.intp)
+    if len(extents) == 0:
+        return result
+    levels = np.asarray(levels, dtype=float)
+    # Quick bounding box check before the ray cast
+    in_box = ((extents[None, :, 0] <= points[:, 0:1]) & (points[:, 0:1] <= extents[None, :, 2]) &
+              (extents[None, :, 1] <= points[:, 1:2]) & (points[:, 1:2] <= extents[None, :, 3]))
+    enclosed = in_box & points_in_rings(points, rings, packed)
+    ranked = np.where(enclosed, levels[None, :], -np.inf)
+    best = np.argmax(ranked, axis=1)
+    found = enclosed[np.arange(len(points)), best]
+    result[found] = best[found]
+    return result
+
+
+def highest_enclosing_contour(point, rings, levels):
+    # Convenience wrapper for a single storage centroid
+    # Returns (ring index, contour level), or (None, None) when no closed contour encloses the point
+    index = int(highest_enclosing_contours([point], rings, levels)[0])
+    if index < 0:
+        return None, None
+    return index, float(levels[index])
+
+
+def synthetic_contours(centre=(0.0, 0.0), n_levels=300, interval=0.1, spacing=5.0, vertices=400):
+    # Concentric closed contour rings around a depression, plus an open contour clipped at the edge
+    # Used to benchmark the engine on machines without arcpy
+    cx, cy = centre
+    angles = np.linspace(0.0, 2 * np.pi, vertices)
+    contours = []
+    for i in range(n_levels):
+        radius = spacing * (i + 1)
+        ring = np.column_stack((cx + radius * np.cos(angles), cy + radius * np.sin(angles)))
+        ring[-1] = ring[0]
+        contours.append((round(i * interval, 3), [ring]))
+    open_radius = spacing * (n_levels + 1)
+    contours.append((round(n_levels * interval, 3),
+                     [np.column_stack((cx + open_radius * np.cos(angles[:-50]), cy + open_radius * np.sin(angles[:-50])))]))
+    return contours
+
+
+if __name__ == '__main__':
+    # Benchmark the engine on a synthetic contour set
+    contours = synthetic_contours()
+    start_time = time.time()
+    rings, levels, sources = closed_rings(contours)
+    index, level = highest_enclosing_contour((1.0, 1.0), rings, levels)
+    print(f"Closed rings: {len(rings)}, vertices: {sum(len(r) for r in rings)}")
+    print(f"Highest enclosing contour: {level} (ring {index})")
+    print("Time taken for enclosure test:", time.time() - start_time)
@@ -0,0 +1,123 @@
+# ContourSearch.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Search strategies for the highest contour level enclosing a storage point.
+# Used by ContourAnalysis.py and DEM_Extraction_BespokePoints.py to cut down expensive enclosure tests.
+
+from bisect import bisect_left
+
+SEARCH_STRATEGIES = ("linear", "bisect")
+
+
+def highest_enclosing_level(levels, encloses, start_level=None, strategy="bisect", sweep=3):
+    """
+    Find the highest contour level for which encloses(level) is True.
+    levels holds the candidate contour levels (duplicates allowed) and encloses is the enclosure test.
+    Above the point's own elevation, enclosure is monotonic in level inside one depression: every
+    contour up to the spill level encloses the point and none above it does. "bisect" therefore
+    bisects the sorted distinct levels from start_level upwards (O(log n) tests). start_level should be the
+    ground elevation at the point (or the first contour at or above it); lower levels cannot enclose the point.
+    Nested depressions break the monotonicity (enclosing, not enclosing, enclosing again), so before a bisected
+    level is accepted every sweep-th level above the bracket and the highest level are tested; the search falls
+    back to a linear scan when any of them encloses the point, or when the lowest candidate does not. Any run of
+    at least sweep enclosing levels above the bracket is therefore found (sweep=1 tests every level above it);
+    only a run of fewer levels (less than sweep contour intervals high) can be missed.
+    "linear" scans all the levels from the top down, ignoring start_level, as the reference scan.
+    Returns (level or None, stats) where stats counts the enclosure tests run and saved.
+    """
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f"Unknown search strategy: {strategy}")
+    distinct = sorted(set(levels))
+    linear_tests = len(distinct)
+    if start_level is not None and strategy == "bisect":
+        distinct = distinct[bisect_left(distinct, start_level):]
+    results = {}
+
+    def test(index):
+        # Each level is tested at most once
+        if index not in results:
+            results[index] = bool(encloses(distinct[index]))
+        return results[index]
+
+    found = None
+    fallback = False
+    if distinct and strategy == "bisect":
+        if test(0):
+            # Invariant: distinct[low] encloses the point, distinct[high] (or beyond the end) does not
+            low, high = 0, len(distinct)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if test(middle):
+                    low = middle
+                else:
+                    high = middle
+            # Sweep above the bracket: an enclosing level there means the levels are not monotonic
+            above = sorted(set(range(high + 1, len(distinct), max(sweep, 1))) | ({len(distinct) - 1} - {low}))
+            if not any(test(index) for index in above if index > high):
+                found = low
+            else:
+                fallback = True
+        else:
+            fallback = True
+    if distinct and found is None:
+        for index in range(len(distinct) - 1, -1, -1):
+            if test(index):
+                found = index
+                break
+    stats = {
+        "strategy": strategy,
+        "levels": len(distinct),
+        "tests": len(results),
+        "linear_tests": linear_tests,
+        "saved": linear_tests - len(results),
+        "fallback": fallback,
+    }
+    return (None if found is None else distinct[found]), stats
+
+
+def summarise_search_stats(all_stats):
+    # Totals over a run, for the end of run report
+    tests = sum(s["tests"] for s in all_stats)
+    linear_tests = sum(s["linear_tests"] for s in all_stats)
+    fallbacks = sum(1 for s in all_stats if s["fallback"])
+    return {"storages": len(all_stats), "tests": tests, "linear_tests": linear_tests,
+            "saved": linear_tests - tests, "fallbacks": fallbacks}
+
+
+def search_check(seed=5, sweep=3):
+    # Bisect against the linear scan on monotonic and nested (True, False, True) enclosure patterns
+    import random
+    levels = [round(0.1 * i, 1) for i in range(40)]
+    patterns = [[True] * 25 + [False] * 15, [True] * 10 + [False] * 5 + [True] * 10 + [False] * 15,
+                [True] * 10 + [False] * 5 + [True] * 3 + [False] * 22, [True] * 5 + [False] * 34 + [True],
+                [False] * 3 + [True] * 20 + [False] * 17, [False] * 40]
+    # Random nested patterns whose enclosing runs are at least sweep levels long
+    rng = random.Random(seed)
+    for _ in range(200):
+        pattern = []
+        while len(levels) - len(pattern) > sweep:
+            run = min(rng.randint(sweep, 8), len(levels) - len(pattern) - 1)
+            pattern += [True] * run + [False] * rng.randint(1, 8)
+        patterns.append((pattern + [False] * len(levels))[:len(levels)])
+    ok = True
+    tests = 0
+    for pattern in patterns:
+        def encloses(level, pattern=pattern):
+            return pattern[levels.index(level)]
+        expected, linear = highest_enclosing_level(levels, encloses, strategy="linear")
+        found, stats = highest_enclosing_level(levels, encloses, strategy="bisect", sweep=sweep)
+        ok &= found == expected
+        tests += stats["tests"]
+    # The linear reference ignores start_level; bisect starts there
+    expected, linear = highest_enclosing_level(levels, lambda level: level < 1.0, start_level=2.0, strategy="linear")
+    found, stats = highest_enclosing_level(levels, lambda level: level < 1.0, start_level=2.0, strategy="bisect")
+    ok &= expected == 0.9 and linear["tests"] == 31 and found is None
+    print(f"{len(patterns)} patterns: {tests} bisect tests against {len(patterns) * len(levels)} linear tests")
+    return bool(ok)
+
+
+if __name__ == '__main__':
+    print("Search check passed" if search_check() else "Search check failed")
@@ -0,0 +1,135 @@
+# CrestBenchmark.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Head-to-head benchmark of the crest engine backends (ElevationBackends.py) on one synthetic DEM and storage set.
+# Reports the throughput of each backend and how often their crest levels agree, with the priority-flood
+# solver (PriorityFlood.py) as an independent reference. The arcpy backend is skipped when arcpy is not available.
+# Usage: python CrestBenchmark.py [--storages 100] [--search bisect] [--scratch folder]
+
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+
+from DemTileCache import ArrayBlockSource, DemTileCache
+from ElevationBackends import ArcpyBackend, NumpyBackend, crest_analysis
+from PriorityFlood import crest_level
+
+
+def synthetic_dem(storages=100, block=160, cell_size=2.0, seed=0):
+    """
+    DEM of a grid of farm dams: each block of block x block cells holds a bowl with a rim and a spillway notch
+    at random heights, plus centimetre noise. Returns the DEM, its geotransform and the storage centroids as (oid, x, y).
+    """
+    rng = np.random.default_rng(seed)
+    grid = int(math.ceil(math.sqrt(storages)))
+    dem = np.zeros((grid * block, grid * block))
+    rows, cols = np.mgrid[0:block, 0:block]
+    transform = (400000.0, cell_size, 0.0, 7000000.0, 0.0, -cell_size)
+    centroids = []
+    for oid in range(storages):
+        block_row, block_col = divmod(oid, grid)
+        radius = rng.uniform(0.2, 0.3) * block
+        floor = rng.uniform(90.0, 110.0)
+        rim = floor + rng.uniform(2.0, 6.0)
+        distance = np.hypot(rows - block / 2, cols - block / 2)
+        bowl = np.where(distance < radius, floor + (rim - floor) * distance / radius, rim - (distance - radius) * 0.02)
+        # Spillway notch from inside the rim out to the block edge in a random direction
+        angle = rng.uniform(0, 2 * np.pi)
+        along = (cols - block / 2) * np.cos(angle) + (rows - block / 2) * np.sin(angle)
+        across = np.abs(-(cols - block / 2) * np.sin(angle) + (rows - block / 2) * np.cos(angle))
+        notch = rng.uniform(floor + 1.0, rim - 0.3)
+        bowl = np.where((along > radius * 0.8) & (across < 2), np.minimum(bowl, notch), bowl)
+        dem[block_row * block:(block_row + 1) * block, block_col * block:(block_col + 1) * block] = bowl
+        x = transform[0] + (block_col * block + block / 2 + rng.uniform(-3, 3)) * cell_size
+        y = transform[3] - (block_row * block + block / 2 + rng.uniform(-3, 3)) * cell_size
+        centroids.append((oid, x, y))
+    dem += rng.normal(0.0, 0.01, dem.shape)
+    return dem.astype(np.float32), transform, centroids
+
+
+def run_backend(backend, centroids, buffer_distance, search):
+    # Crest level of every storage and the elapsed time
+    start_time = time.time()
+    levels = {}
+    for oid, x, y in centroids:
+        result = crest_analysis(backend, x, y, buffer_distance, search=search)
+        levels[oid] = result["Contour"] if result else None
+    return levels, time.time() - start_time
+
+
+def run_flood(dem_cache, centroids, buffer_distance):
+    # Reference crest levels from the priority-flood solver on the same windows
+    start_time = time.time()
+    levels = {}
+    for oid, x, y in centroids:
+        window, transform = dem_cache.read_window(x - buffer_distance, y - buffer_distance, x + buffer_distance, y + buffer_distance)
+        result = crest_level(window, transform, (x, y), contour_interval=0.1)
+        levels[oid] = result["Contour"] if result else None
+    return levels, time.time() - start_time
+
+
+def agreement(levels_a, levels_b, interval=0.1):
+    # Share of storages with the same crest level, and within one contour interval
+    same = within = 0
+    for oid, level_a in levels_a.items():
+        level_b = levels_b.get(oid)
+        if level_a is None or level_b is None:
+            same += level_a is None and level_b is None
+            within += level_a is None and level_b is None
+            continue
+        same += abs(level_a - level_b) < 1e-6
+        within += abs(level_a - level_b) <= interval + 1e-6
+    return {"same": same / len(levels_a), "within_interval": within / len(levels_a)}
+
+
+def arcpy_dem(dem, transform, scratch):
+    # Write the synthetic DEM to a GeoTIFF for the arcpy backend; None when arcpy is not installed
+    try:
+        import arcpy
+    except ImportError:
+        return None
+    os.makedirs(scratch, exist_ok=True)
+    arcpy.env.overwriteOutput = True
+    x_origin, cell_size, _, y_origin, _, _ = transform
+    lower_left = arcpy.Point(x_origin, y_origin - dem.shape[0] * cell_size)
+    path = os.path.join(scratch, "synthetic_dem.tif")
+    arcpy.NumPyArrayToRaster(dem, lower_left, cell_size, cell_size).save(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crest engine backends on a synthetic DEM")
+    parser.add_argument("--storages", type=int, default=100)
+    parser.add_argument("--search", choices=("linear", "bisect"), default="bisect")
+    parser.add_argument("--scratch", default="crest_benchmark")
+    args = parser.parse_args()
+    dem, transform, centroids = synthetic_dem(args.storages)
+    # Buffer within each dam's block, like the 3500 m buffer around a real storage
+    buffer_distance = 75 * transform[1]
+    dem_cache = DemTileCache(ArrayBlockSource(dem, transform), max_blocks=1024)
+    print(f"Synthetic DEM {dem.shape[1]} x {dem.shape[0]} cells, {len(centroids)} storages")
+    results = {"flood": run_flood(dem_cache, centroids, buffer_distance)}
+    results["numpy"] = run_backend(NumpyBackend(dem_cache), centroids, buffer_distance, args.search)
+    dem_path = arcpy_dem(dem, transform, args.scratch)
+    if dem_path is None:
+        print("arcpy not available, skipping the arcpy backend")
+    else:
+        results["arcpy"] = run_backend(ArcpyBackend(dem_path), centroids, buffer_distance, args.search)
+    for name, (levels, seconds) in results.items():
+        found = sum(level is not None for level in levels.values())
+        print(f"{name:<8}{seconds:>10.2f} s{len(levels) / seconds:>10.1f} storages/s{found:>8} crests found")
+    names = list(results)
+    for i, name_a in enumerate(names):
+        for name_b in names[i + 1:]:
+            match = agreement(results[name_a][0], results[name_b][0])
+            print(f"{name_a} vs {name_b}: {match['same']:.1%} identical, {match['within_interval']:.1%} within one contour interval")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,211 +14,187 @@ import os
 
 import time 
 
-def run_model_builder_script(): 
+from ContourAnalysis import open_polygon_writer 
 
-    """ 
-
-    Function to run the ModelBuilder generated script. 
-
-    """ 
-
-    # Set arcpy environment settings 
-
-    arcpy.env.overwriteOutput = True 
-
-    arcpy.CheckOutExtension("3D") 
-
-    arcpy.CheckOutExtension("spatial") 
-
-    # Set the workspace 
-
-    arcpy.env.workspace = r"C:\projects\2RP37125\2RP37125\points\points_new" 
-
-    # Define paths 
-
-    DEM = r"C:\projects\topo_update\DEM.lyrx" 
-
-    BespokePoints = r"C:\projects\2RP37125\2RP37125\points\points_new\points" 
+from ContourSearch import summarise_search_stats 
 
-    output_folder = r"C:\projects\2RP37125\2RP37125\points\points_new" 
-
-    start_time = time.time()     
+from ElevationBackends import ArcpyBackend, ArcpyDemReader, NumpyBackend, crest_analysis 
 
-    # Define a list to store paths of individual contour polygon shapefiles 
+from RunManifest import RunManifest, file_signature, input_hash 
 
-    contour_polygon_files = [] 
+from StageProfiler import StageProfiler 
 
-    # Iterate over each point in "BespokePoints" 
+def run_model_builder_script(search="linear", resume=True, backend="arcpy"): 
 
-    with arcpy.da.SearchCursor(FarmSites, ["OID@", "SHAPE@"]) as cursor: 
+    """ 
 
-        for oid, point in cursor: 
+    Function to run the ModelBuilder generated script. 
 
-            print(f"Processing point {oid}...") 
+    The crest of every point is found by the crest engine shared with ContourAnalysis.py (ElevationBackends.py). 
 
-            # Create a buffer for the current point 
+    backend="arcpy" runs it on arcpy.sa.Contour and FeatureToPolygon; backend="numpy" traces contours from the 
 
-            buffer_distance = "1000 Meters"  # Adjust as needed 
+    DEM window with NumPy and needs no Spatial Analyst or 3D Analyst licence. 
 
-            Buffer = f"BespokePoints_{oid}.shp" 
+    search="bisect" bisects the sorted contour levels instead of testing every contour (ContourSearch.py). 
 
-            arcpy.analysis.Buffer(in_features=point, out_feature_class=Buffer, buffer_distance_or_field=buffer_distance) 
+    Stage timings are written to stage_profile.json/.csv in the output folder (StageProfiler.py). 
 
-            # Perform contour analysis 
+    Every finished point is streamed into the MergedContours2.gpkg layer in batched transactions (GeoPackageWriter.py) 
 
-            Contour_Clip = f"Contours_DEM_Clip_{oid}.shp"  # Modify output name 
+    and recorded in run_manifest.jsonl (RunManifest.py) once its batch is committed; with resume=True a restarted run 
 
-            with arcpy.EnvManager(extent=Buffer): 
+    skips the points already complete with the same inputs. 
 
-                contour_result = arcpy.sa.Contour(DEM, f"memory\\contour_temp_{oid}", 0.1, 0, 1, "CONTOUR", None) 
+    """ 
 
-                arcpy.CopyFeatures_management(contour_result, Contour_Clip) 
+    # Set arcpy environment settings 
 
-            # Measure time for getting maximum elevation 
+    arcpy.env.overwriteOutput = True 
 
-            start_time_get_max_elevation = time.time() 
+    # Set the workspace 
 
-            max_elevation = max([row[0] for row in arcpy.da.SearchCursor(Contour_Clip, ["Contour"])]) 
+    arcpy.env.workspace = r"C:\projects\2RP37125\2RP37125\points\points_new" 
 
-            print("Time taken for getting maximum elevation:", time.time() - start_time_get_max_elevation) 
+    # Define paths 
 
-            # Measure time for creating feature layer 
+    DEM = r"C:\projects\topo_update\DEM.lyrx" 
 
-            start_time_create_feature_layer = time.time() 
+    BespokePoints = r"C:\projects\2RP37125\2RP37125\points\points_new\points" 
 
-            arcpy.management.MakeFeatureLayer(FarmSites, "CrestPointLayer") 
+    output_folder = r"C:\projects\2RP37125\2RP37125\points\points_new" 
 
-            print("Time taken for creating feature layer:", time.time() - start_time_create_feature_layer) 
+    buffer_distance = 1000  # Metres, adjust as needed 
 
-            # Measure time for Near analysis 
+    start_time = time.time() 
 
-            start_time_near_analysis = time.time() 
+    if backend == "numpy": 
 
-            arcpy.analysis.Near(Contour_Clip, "CrestPointLayer", method="GEODESIC") 
+        elevation_backend = NumpyBackend(ArcpyDemReader(DEM)) 
 
-            print("Time taken for Near analysis:", time.time() - start_time_near_analysis) 
+    else: 
 
-            # Measure time for geometry check 
+        arcpy.CheckOutExtension("3D") 
 
-            start_time_geometry_check = time.time() 
+        elevation_backend = ArcpyBackend(DEM) 
 
-            arcpy.management.CheckGeometry(Contour_Clip) 
+    # Enclosure test statistics of every point 
 
-            print("Time taken for geometry check:", time.time() - start_time_geometry_check) 
+    search_stats = [] 
 
-            # Create a spatial index on contour lines 
+    profiler = StageProfiler() 
 
-            arcpy.management.AddSpatialIndex(Contour_Clip) 
+    # Skip points completed by an earlier run with the same inputs 
 
-            # Bounding box of the current point 
+    manifest = RunManifest(os.path.join(output_folder, "run_manifest.jsonl"), resume) 
 
-            start_time_bounding_box = time.time() 
+    # Sign the raster behind the layer file rather than the .lyrx itself, so a replaced DEM invalidates earlier results 
 
-            point_extent = point.extent 
+    dem_source = arcpy.mp.LayerFile(DEM).listLayers()[0].dataSource if DEM.lower().endswith(".lyrx") else DEM 
 
-            print("Time taken for bounding box:", time.time() - start_time_geometry_check) 
+    hash_settings = {"DEM": DEM, "dem_source": dem_source, "dem_file": file_signature(dem_source), "backend": backend, 
 
-            # Measure time for contour iteration 
+                     "buffer_distance": buffer_distance, "search": search} 
 
-            start_time_contour_iteration = time.time() 
+    hashes = {oid: input_hash(oid, x, y, hash_settings) for oid, (x, y) in arcpy.da.SearchCursor(BespokePoints, ["OID@", "SHAPE@XY"])} 
 
-            # Initialize variables to track the highest contour 
+    completed = manifest.completed(hashes) 
 
-            highest_contour = None 
+    # Polygons are streamed into one GeoPackage layer as points finish, so a partial result is always available 
 
-            highest_elevation = float("-inf") 
+    output_merged_gpkg = os.path.join(output_folder, "MergedContours2.gpkg") 
 
-            # Iterate through contours 
+    writer = open_polygon_writer(output_merged_gpkg, "MergedContours2", arcpy.Describe(BespokePoints).spatialReference, resume) 
 
-            with arcpy.da.SearchCursor(Contour_Clip, ["SHAPE@", "Contour", "NEAR_DIST"], spatial_reference=point.spatialReference) as contour_cursor: 
+    # Drop polygons written in a batch whose points never reached the manifest 
 
-                for contour_shape, contour_elevation, near_dist in contour_cursor: 
+    writer.prune("StorageID", completed) 
 
-                    # Quick bounding box check 
+    # Points written to the GeoPackage but not yet committed, checkpointed when their batch commits 
 
-                    if not contour_shape.extent.contains(point_extent): 
+    uncommitted = [] 
 
-                        continue 
+    print(f"{len(completed)} points already complete, {len(hashes) - len(completed)} to process") 
 
-                    # Check if contour elevation is higher than current highest elevation 
+    # Iterate over each point in "BespokePoints" 
 
-                    if contour_elevation > highest_elevation: 
+    with arcpy.da.SearchCursor(BespokePoints, ["OID@", "SHAPE@"]) as cursor: 
 
-                        try: 
+        for oid, point in cursor: 
 
-                            # Convert contour feature to polygon 
+            if oid in completed: 
 
-                            arcpy.management.FeatureToPolygon([contour_shape], r"memory\ContourPolygon") 
+                continue 
 
-                        except arcpy.ExecuteError as e: 
+            print(f"Processing point {oid}...") 
 
-                            print(f"Error converting contour to polygon: {e}") 
+            committed = False 
 
-                            continue 
+            # Buffer, contour the DEM and find the highest closed contour enclosing the point 
 
-                        # Check if point is inside the polygon 
+            centroid = point.firstPoint 
 
-                        arcpy.management.SelectLayerByLocation("CrestPointLayer", "COMPLETELY_WITHIN", 
+            highest_contour = crest_analysis(elevation_backend, centroid.X, centroid.Y, buffer_distance, search=search, 
 
-                                                               r"memory\ContourPolygon") 
+                                             profiler=profiler, oid=oid) 
 
-                        if int(arcpy.management.GetCount("CrestPointLayer")[0]) > 0: 
+            if highest_contour: 
 
-                            highest_contour = {"shape": contour_shape, "Contour": contour_elevation, "near_dist": near_dist} 
+                search_stats.append(highest_contour["search_stats"]) 
 
-                            highest_elevation = contour_elevation 
+            print(f"Point {oid} processing complete.") 
 
-                            print(f"Current contour elevation: {contour_elevation}") 
+            if highest_contour and highest_contour["polygons"]: 
 
-                            print(f"Highest elevation so far: {highest_elevation}") 
+                extracted_info = {"Contour": highest_contour["Contour"]} 
 
-                    if highest_elevation >= max_elevation: 
+                print(extracted_info) 
 
-                        break 
+                with profiler.stage("append", oid): 
 
-            print(f"Point {oid} processing complete.") 
+                    committed = writer.write(highest_contour["polygons"], (oid, highest_contour["Contour"])) 
 
-            if highest_contour: 
+            # Checkpoint the points of a batch once it is committed to the GeoPackage 
 
-                extracted_info = {"Contour": highest_elevation} 
+            uncommitted.append((oid, highest_contour["Contour"] if highest_contour else None)) 
 
-                print(extracted_info) 
+            if committed: 
 
-                # Convert contour line to polygon 
+                for done_oid, contour in uncommitted: 
 
-                try: 
+                    manifest.record(done_oid, hashes[done_oid], Contour=contour) 
 
-                    # Define the output polygon feature class path 
+                uncommitted.clear() 
 
-                    output_polygon_path = os.path.join(output_folder, f"ContourPolygon_{oid}.shp") 
+    # Commit the last batch and build the spatial index once 
 
-                    # Convert contour line to polygon and save it in the output folder 
+    with profiler.stage("merge"): 
 
-                    arcpy.management.FeatureToPolygon(highest_contour["shape"], output_polygon_path) 
+        writer.close() 
 
-                    contour_polygon_files.append(output_polygon_path) 
+    for done_oid, contour in uncommitted: 
 
-                    print("Contour line converted to polygon and saved successfully.") 
+        manifest.record(done_oid, hashes[done_oid], Contour=contour) 
 
-                except arcpy.ExecuteError as e: 
+    print("Contour analysis and additional processing complete.") 
 
-                    print(f"Error converting contour to polygon: {e}") 
+    if search_stats: 
 
-            # Clean up intermediate files 
+        totals = summarise_search_stats(search_stats) 
 
-            arcpy.Delete_management(Buffer) 
+        print(f"Enclosure tests: {totals['tests']} of {totals['linear_tests']} levels, saved {totals['saved']} " 
 
-            arcpy.Delete_management(f"memory\\contour_temp_{oid}") 
+              f"({totals['fallbacks']} linear fallbacks)") 
 
-    print("Contour analysis and additional processing complete.") 
+    print("All contour polygons written to:", output_merged_gpkg) 
 
-    # Merge all contour polygon shapefiles into a single shapefile 
+    # Per stage p50/p95/max over points, to see which stage dominates the run 
 
-    output_merged_shapefile = os.path.join(output_folder, "MergedContours2.shp") 
+    profiler.print_summary() 
 
-    arcpy.management.Merge(contour_polygon_files, output_merged_shapefile) 
+    profiler.write_json(os.path.join(output_folder, "stage_profile.json")) 
 
-    print("All contour polygons merged successfully into:", output_merged_shapefile) 
+    profiler.write_csv(os.path.join(output_folder, "stage_profile.csv")) 
 
     print("Total execution time:", time.time() - start_time) 
 
@@ -14,27 +14,25 @@ import os
 
 import time 
 
-def create_tiles(extent, tile_size): 
+from TileMosaic import mosaic_tiles_to_cog, snap_origin 
 
-    # Function to create a grid of tiles covering the given extent 
+from TilePlanner import print_quadtree, quadtree_tiles 
 
-    xmin, ymin, xmax, ymax = extent 
+def run_model_builder_script(cog=False, workers=4): 
 
-    xstep, ystep = tile_size     
-
-    tiles = [] 
+    # Function to run the modelbuilder generated script 
 
-    for x in range(int(xmin), int(xmax), xstep): 
+    # The storages are buffered once and only the tiles intersecting a buffered storage are clipped, each to its own window. 
 
-        for y in range(int(ymin), int(ymax), ystep): 
+    # Tiles are adaptive (TilePlanner.quadtree_tiles): split until each holds at most max_storages storages and 
 
-            tiles.append((x, y, x + xstep, y + ystep)) 
+    # max_pixels DEM cells, so sparse catchments get few large tiles and dense irrigation areas many small ones 
 
-    return tiles 
+    # cog=False (default) keeps the arcpy Clip of each tile to Tile_{i}.tif and MosaicToNewRaster 
 
-def run_model_builder_script(): 
+    # cog=True clips the tiles on workers threads and streams them into one Cloud-Optimized GeoTIFF (TileMosaic.py); 
 
-    # Function to run the modelbuilder generated script 
+    # it needs rasterio (pip install rasterio), which is not part of the ArcGIS Pro default environment 
 
     # Set arcpy environment settings 
 
@@ -58,51 +56,135 @@ def run_model_builder_script():
 
     start_time = time.time()     
 
-    # Define tile size and buffer distance 
+    # Define tile limits and buffer distance 
+
+    max_storages = 50 
+
+    max_pixels = 4096 * 4096 
+
+    min_tile_size = 500 
+
+    buffer_distance = "50 Meters" 
+
+    block_size = 512 
+
+    # DEM source behind the layer file, its cell grid and spatial reference 
+
+    dem_source = arcpy.mp.LayerFile(os.path.join(arcpy.env.workspace, DEM)).listLayers()[0].dataSource 
+
+    dem_raster = arcpy.Raster(dem_source) 
+
+    dem_transform = (dem_raster.extent.XMin, dem_raster.meanCellWidth, 0.0, dem_raster.extent.YMax, 0.0, -dem_raster.meanCellHeight) 
+
+    origin = None 
+
+    if cog: 
+
+        # Tiles of whole output blocks on the DEM cell grid, so each block is written once 
+
+        min_tile_size = block_size * dem_raster.meanCellWidth 
+
+    # Buffer the water storages once 
+
+    buffer_file = "WaterStorage_Buffer.shp" 
+
+    arcpy.analysis.Buffer(WaterStorage, buffer_file, buffer_distance) 
+
+    with arcpy.da.SearchCursor(buffer_file, ["OID@", "SHAPE@"], spatial_reference=dem_raster.spatialReference) as cursor: 
+
+        buffers = {oid: shape for oid, shape in cursor} 
+
+    # Get extent of the buffered water storage area, in the DEM spatial reference 
+
+    extent = arcpy.Extent(min(s.extent.XMin for s in buffers.values()), min(s.extent.YMin for s in buffers.values()), 
+
+                          max(s.extent.XMax for s in buffers.values()), max(s.extent.YMax for s in buffers.values())) 
 
-    tile_size = (2000, 2000) 
+    # Keep only the tiles that intersect a buffered storage 
 
-    buffer_distance = "50 Meters"     
+    def intersects(tile_extent, oid): 
 
-    # Get extent of water storage area 
+        return not arcpy.Extent(*tile_extent).polygon.disjoint(buffers[oid]) 
 
-    desc = arcpy.Describe(WaterStorage) 
+    storage_extents = [(oid, shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax) for oid, shape in buffers.items()] 
 
-    extent = desc.extent     
+    grid_extent = (extent.XMin, extent.YMin, extent.XMax, extent.YMax) 
 
-    # Create tiles covering the extent of the water storage area 
+    if cog: 
 
-    tiles = create_tiles((extent.XMin, extent.YMin, extent.XMax, extent.YMax), tile_size)     
+        origin = snap_origin(extent.XMin, extent.YMin, dem_transform) 
+
+    tiles = quadtree_tiles(storage_extents, grid_extent, max_storages, max_pixels, dem_raster.meanCellWidth, min_tile_size, 
+
+                           origin, intersects) 
+
+    print_quadtree(tiles, dem_raster.meanCellWidth) 
+
+    if cog: 
+
+        # Concurrent clipping streamed into one compressed, tiled GeoTIFF with overviews; no tile files 
+
+        for tile in tiles: 
+
+            tile["shapes"] = [buffers[oid].__geo_interface__ for oid in tile["oids"]] 
+
+        print("Clipping and mosaicking DEM tiles....") 
+
+        if tiles: 
+
+            mosaic_tiles_to_cog(dem_source, tiles, os.path.join(output_folder, "Merged_DEM1.tif"), workers, block_size) 
+
+            print("DEM tiles merged successfully") 
+
+        else: 
+
+            print("No DEM tiles to merge.") 
+
+        arcpy.Delete_management(buffer_file) 
+
+        print("Contour analysis and additional processing complete") 
+
+        print("Total execution time:", time.time() - start_time) 
+
+        return 
 
     # List to store paths of extracted DEM tiles 
 
-    dem_tiles = []     
+    dem_tiles = [] 
 
     # Iterate over each tile 
 
-    for i, (xmin, ymin, xmax, ymax) in enumerate(tiles): 
+    for tile in tiles: 
+
+        i = tile["tile"] 
 
-        print(f"Processing Tile {i + 1}/{len(tiles)}...")         
+        xmin, ymin, xmax, ymax = tile["extent"] 
+
+        print(f"Processing Tile {i + 1}/{len(tiles)} ({len(tile['oids'])} storages)...") 
 
         # Define tile name 
 
-        tile_name = f"Tile_{i}.tif"         
+        tile_name = f"Tile_{i}.tif" 
+
+        # Clip geometry: the buffered storages of this tile, cut to the tile window 
+
+        tile_polygon = arcpy.Extent(xmin, ymin, xmax, ymax).polygon 
 
-        # Extract DEM within the buffer zone of the tile 
+        clip_geometry = buffers[tile["oids"][0]] 
 
-        buffer_file = f"Tile_{i}_Buffer.shp" 
+        for oid in tile["oids"][1:]: 
 
-        buffer_file_path = os.path.join(arcpy.env.workspace, buffer_file) 
+            clip_geometry = clip_geometry.union(buffers[oid]) 
 
-        print("Buffer file path:", buffer_file_path)  # Print buffer file path         
+        clip_file = f"memory\\Tile_{i}_Clip" 
 
         # Clip operation 
 
         try: 
 
-            arcpy.analysis.Buffer(WaterStorage, buffer_file, buffer_distance) 
+            arcpy.management.CopyFeatures([tile_polygon.intersect(clip_geometry, 4)], clip_file) 
 
-            arcpy.management.Clip(DEM, buffer_file_path, tile_name) 
+            arcpy.management.Clip(DEM, f"{xmin} {ymin} {xmax} {ymax}", tile_name, clip_file, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT") 
 
             dem_tiles.append(tile_name) 
 
@@ -110,7 +192,11 @@ def run_model_builder_script():
 
             print(f"Error clipping DEM for Tile {i}: {e}") 
 
-            continue  # Skip to the next tile     
+            continue  # Skip to the next tile 
+
+        finally: 
+
+            arcpy.Delete_management(clip_file) 
 
     # Merge DEM tiles 
 
@@ -130,7 +216,9 @@ def run_model_builder_script():
 
     for tile_name in dem_tiles: 
 
-        arcpy.Delete_management(tile_name)     
+        arcpy.Delete_management(tile_name) 
+
+    arcpy.Delete_management(buffer_file) 
 
     print("Contour analysis and additional processing complete") 
 
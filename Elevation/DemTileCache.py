@@ -0,0 +1,184 @@
+# DemTileCache.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Windowed, block-cached DEM reader shared by the storages of a run.
+# Neighbouring storages have heavily overlapping buffers, so each request only reads the
+# block-aligned window it needs and decoded blocks are kept in a bounded LRU cache.
+
+import math
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ArrayBlockSource:
+    # Block source over an in-memory or memory-mapped (np.memmap) elevation array
+    def __init__(self, array, transform, nodata=None, block_shape=(256, 256)):
+        self.array = array
+        self.transform = tuple(transform)
+        self.nodata = nodata
+        self.block_shape = block_shape
+        self.shape = array.shape
+
+    def read(self, row_off, col_off, height, width):
+        return np.array(self.array[row_off:row_off + height, col_off:col_off + width])
+
+
+class RasterioBlockSource:
+    # Block source reading windows of a GeoTIFF (e.g. Merged_DEM.tif) aligned to its internal tiles
+    def __init__(self, path, band=1):
+        try:
+            import rasterio
+            from rasterio.windows import Window
+        except ImportError:
+            raise ImportError("rasterio is required to read GeoTIFF blocks: pip install rasterio")
+        self.window = Window
+        self.dataset = rasterio.open(path)
+        self.band = band
+        self.transform = tuple(self.dataset.transform.to_gdal())
+        self.nodata = self.dataset.nodata
+        self.block_shape = self.dataset.block_shapes[band - 1]
+        self.shape = (self.dataset.height, self.dataset.width)
+
+    def read(self, row_off, col_off, height, width):
+        return self.dataset.read(self.band, window=self.window(col_off, row_off, width, height))
+
+    def close(self):
+        self.dataset.close()
+
+
+def crop_window(window, transform, xmin, ymin, xmax, ymax):
+    # Sub-window covering a map extent, snapped to the window's cell grid like DemTileCache.read_window
+    # The extent must lie inside the window (e.g. a storage buffer inside its cluster envelope)
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    cell_height = -cell_height
+    col_start = int(math.floor((xmin - x_origin) / cell_width))
+    col_end = int(math.ceil((xmax - x_origin) / cell_width))
+    row_start = int(math.floor((y_origin - ymax) / cell_height))
+    row_end = int(math.ceil((y_origin - ymin) / cell_height))
+    if col_start < 0 or row_start < 0 or col_end > window.shape[1] or row_end > window.shape[0]:
+        raise ValueError("Extent is not inside the window")
+    cropped_transform = (x_origin + col_start * cell_width, cell_width, 0.0, y_origin - row_start * cell_height, 0.0, -cell_height)
+    return window[row_start:row_end, col_start:col_end], cropped_transform
+
+
+class WindowReader:
+    # Serves sub-windows of one window already in memory, e.g. the DEM window shared by a storage cluster
+    def __init__(self, window, transform):
+        self.window = window
+        self.transform = transform
+
+    def read_window(self, xmin, ymin, xmax, ymax):
+        return crop_window(self.window, self.transform, xmin, ymin, xmax, ymax)
+
+
+def window_blocks(source, window_size):
+    # Most blocks of the source one square window of window_size map units can touch (one more per axis when unaligned)
+    block_height, block_width = source.block_shape
+    cell_width, cell_height = source.transform[1], -source.transform[5]
+    return (math.ceil(window_size / (cell_height * block_height)) + 1) * (math.ceil(window_size / (cell_width * block_width)) + 1)
+
+
+class DemTileCache:
+    """
+    DEM access layer: serves arbitrary map windows from block-aligned reads kept in an LRU cache.
+    source is an ArrayBlockSource or RasterioBlockSource; max_blocks bounds the number of decoded
+    blocks held in memory. Windows are returned as float arrays with NoData converted to NaN.
+    A bound smaller than one window evicts blocks the same read still needs, so every read misses; without
+    max_blocks the cache is sized from window_size, the widest window read in map units (e.g. twice the buffer
+    distance), to hold two windows so a storage's window and most of its neighbour's stay cached.
+    """
+
+    def __init__(self, source, max_blocks=None, window_size=None):
+        if max_blocks is None:
+            if window_size is None:
+                raise ValueError("DemTileCache needs max_blocks or the window_size of the reads")
+            max_blocks = 2 * window_blocks(source, window_size)
+        self.source = source
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.read_time = 0.0
+
+    def block(self, block_row, block_col):
+        # Decoded block, from the cache when possible
+        key = (block_row, block_col)
+        if key in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        self.misses += 1
+        start_time = time.time()
+        block_height, block_width = self.source.block_shape
+        rows, cols = self.source.shape
+        row_off = block_row * block_height
+        col_off = block_col * block_width
+        data = self.source.read(row_off, col_off, min(block_height, rows - row_off), min(block_width, cols - col_off))
+        data = data.astype(np.float32)
+        if self.source.nodata is not None:
+            data[data == self.source.nodata] = np.nan
+        self.read_time += time.time() - start_time
+        self.blocks[key] = data
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+            self.evictions += 1
+        return data
+
+    def read_window(self, xmin, ymin, xmax, ymax):
+        # Cells covering a map extent, snapped to the DEM grid, with the GDAL style geotransform of the window
+        # Cells outside the DEM are returned as NaN
+        x_origin, cell_width, _, y_origin, _, cell_height = self.source.transform
+        cell_height = -cell_height
+        col_start = int(math.floor((xmin - x_origin) / cell_width))
+        col_end = int(math.ceil((xmax - x_origin) / cell_width))
+        row_start = int(math.floor((y_origin - ymax) / cell_height))
+        row_end = int(math.ceil((y_origin - ymin) / cell_height))
+        window = np.full((row_end - row_start, col_end - col_start), np.nan, dtype=np.float32)
+        rows, cols = self.source.shape
+        block_height, block_width = self.source.block_shape
+        # Only the blocks overlapping the part of the window inside the DEM are read
+        first_row, last_row = max(row_start, 0), min(row_end, rows)
+        first_col, last_col = max(col_start, 0), min(col_end, cols)
+        for block_row in range(first_row // block_height, (last_row - 1) // block_height + 1 if last_row > first_row else 0):
+            for block_col in range(first_col // block_width, (last_col - 1) // block_width + 1 if last_col > first_col else 0):
+                data = self.block(block_row, block_col)
+                top = block_row * block_height
+                left = block_col * block_width
+                r0, r1 = max(first_row, top), min(last_row, top + data.shape[0])
+                c0, c1 = max(first_col, left), min(last_col, left + data.shape[1])
+                window[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = data[r0 - top:r1 - top, c0 - left:c1 - left]
+        transform = (x_origin + col_start * cell_width, cell_width, 0.0, y_origin - row_start * cell_height, 0.0, -cell_height)
+        return window, transform
+
+    def close(self):
+        # Close the source's dataset (RasterioBlockSource); array sources hold nothing open
+        if hasattr(self.source, "close"):
+            self.source.close()
+
+    def stats(self):
+        # Hit and miss statistics of the cache
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "cached_blocks": len(self.blocks),
+            "read_time": self.read_time,
+        }
+
+
+if __name__ == '__main__':
+    # Overlapping 3500 m buffers around neighbouring storages on a synthetic 5 m DEM, cache sized from the 7000 m window
+    dem = np.random.default_rng(0).normal(100.0, 5.0, (4000, 4000)).astype(np.float32)
+    cache = DemTileCache(ArrayBlockSource(dem, (400000.0, 5.0, 0.0, 7020000.0, 0.0, -5.0)), window_size=7000)
+    for i in range(20):
+        x, y = 410000.0 + i * 200.0, 7010000.0 - i * 150.0
+        window, transform = cache.read_window(x - 3500, y - 3500, x + 3500, y + 3500)
+    print(cache.stats())
@@ -0,0 +1,381 @@
+# ElevationBackends.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Elevation operations behind the crest analysis (buffer, contour, near, point-in-polygon, polygon export),
+# with the arcpy implementation and a licence-free NumPy one behind the same interface.
+# crest_analysis is the crest engine shared by ContourAnalysis.py and DEM_Extraction_BespokePoints.py.
+# arcpy is only imported by the arcpy classes, so the NumPy path runs on machines without ArcGIS.
+
+import math
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+import numpy as np
+
+from ContourGeometry import points_in_rings
+from ContourSearch import highest_enclosing_level
+from PriorityFlood import ring_area, world_to_cell
+from StageProfiler import StageProfiler
+from StorageClusters import buffer_extent
+
+# Marching squares: segments of each cell case as pairs of cell edges (0 top, 1 right, 2 bottom, 3 left)
+# Corners at or above the level set the bits top-left 8, top-right 4, bottom-right 2, bottom-left 1
+CASE_SEGMENTS = {1: ((3, 2),), 2: ((2, 1),), 3: ((3, 1),), 4: ((0, 1),), 6: ((0, 2),), 7: ((3, 0),), 8: ((3, 0),),
+                 9: ((0, 2),), 11: ((0, 1),), 12: ((3, 1),), 13: ((2, 1),), 14: ((3, 2),)}
+# Saddle cases are resolved by whether the cell centre is at or above the level
+SADDLE_SEGMENTS = {(5, True): ((3, 0), (2, 1)), (5, False): ((0, 1), (3, 2)),
+                   (10, True): ((0, 1), (3, 2)), (10, False): ((3, 0), (2, 1))}
+
+
+def marching_squares(dem, transform, level):
+    """
+    Contour lines of a DEM window at one level, through the cell centres like arcpy.sa.Contour.
+    Returns a list of (N, 2) vertex arrays in map coordinates; closed rings repeat their first vertex.
+    Lines stop at NoData (NaN) cells and at the window edge, so they stay open there.
+    """
+    dem = np.asarray(dem, dtype=float)
+    rows, cols = dem.shape
+    if rows < 2 or cols < 2:
+        return []
+    above = dem >= level
+    corners = (dem[:-1, :-1], dem[:-1, 1:], dem[1:, 1:], dem[1:, :-1])
+    valid = np.isfinite(corners[0]) & np.isfinite(corners[1]) & np.isfinite(corners[2]) & np.isfinite(corners[3])
+    case = 8 * above[:-1, :-1] + 4 * above[:-1, 1:] + 2 * above[1:, 1:] + above[1:, :-1]
+    # Cell edges are numbered globally so neighbouring squares share the vertex on their common edge:
+    # horizontal edges first (between grid points (r, c) and (r, c + 1)), then vertical ones ((r, c) to (r + 1, c))
+    horizontal = rows * (cols - 1)
+
+    def edge_ids(edge, r, c):
+        if edge == 0:
+            return r * (cols - 1) + c
+        if edge == 2:
+            return (r + 1) * (cols - 1) + c
+        if edge == 3:
+            return horizontal + r * cols + c
+        return horizontal + r * cols + c + 1
+
+    starts = []
+    ends = []
+    for k, segments in CASE_SEGMENTS.items():
+        r, c = np.nonzero((case == k) & valid)
+        for a, b in segments:
+            starts.append(edge_ids(a, r, c))
+            ends.append(edge_ids(b, r, c))
+    centre = (corners[0] + corners[1] + corners[2] + corners[3]) / 4.0 >= level
+    for (k, centre_above), segments in SADDLE_SEGMENTS.items():
+        r, c = np.nonzero((case == k) & valid & (centre == centre_above))
+        for a, b in segments:
+            starts.append(edge_ids(a, r, c))
+            ends.append(edge_ids(b, r, c))
+    if not starts:
+        return []
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    # Stitch the segments into lines: every edge vertex joins at most two segments
+    neighbours = defaultdict(list)
+    for a, b in zip(starts.tolist(), ends.tolist()):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    seen = set()
+
+    def walk(start):
+        path = [start]
+        seen.add(start)
+        previous, current = None, start
+        while True:
+            candidates = [n for n in neighbours[current] if n != previous]
+            if previous is None:
+                candidates = candidates[:1]
+            if not candidates:
+                return path
+            following = candidates[0]
+            if following == start:
+                path.append(start)
+                return path
+            if following in seen:
+                return path
+            path.append(following)
+            seen.add(following)
+            previous, current = current, following
+
+    paths = [walk(node) for node in list(neighbours) if len(neighbours[node]) == 1 and node not in seen]
+    paths += [walk(node) for node in list(neighbours) if node not in seen]
+    # Interpolate the vertex position along each edge
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    lines = []
+    for path in paths:
+        ids = np.asarray(path)
+        is_vertical = ids >= horizontal
+        k = np.where(is_vertical, ids - horizontal, ids)
+        r = np.where(is_vertical, k // cols, k // (cols - 1))
+        c = np.where(is_vertical, k % cols, k % (cols - 1))
+        r2 = np.where(is_vertical, r + 1, r)
+        c2 = np.where(is_vertical, c, c + 1)
+        a = dem[r, c]
+        t = (level - a) / (dem[r2, c2] - a)
+        row = r + np.where(is_vertical, t, 0.0)
+        col = c + np.where(is_vertical, 0.0, t)
+        lines.append(np.column_stack((x_origin + (col + 0.5) * cell_width, y_origin + (row + 0.5) * cell_height)))
+    return lines
+
+
+def contour_levels(minimum, maximum, interval, base=0.0):
+    # Contour levels of the series base + k * interval within [minimum, maximum]
+    first = int(np.ceil((minimum - base) / interval - 1e-9))
+    last = int(np.floor((maximum - base) / interval + 1e-9))
+    return [round(base + k * interval, 10) for k in range(first, last + 1)]
+
+
+def polygon_rings(polygon):
+    # Parts of an arcpy polygon as lists of rings of (x, y), outer ring first; rings within a part are separated by None
+    polygons = []
+    for part in polygon:
+        rings = [[]]
+        for p in part:
+            if p is None:
+                rings.append([])
+            else:
+                rings[-1].append((p.X, p.Y))
+        polygons.append([ring for ring in rings if ring])
+    return polygons
+
+
+class ElevationBackend(ABC):
+    """
+    Elevation operations used by crest_analysis.
+    contours() returns a backend specific handle over one buffer extent that the other operations take:
+    levels() lists the candidate contour levels around the point, near() gives the ground elevation at the point
+    (the search starts at the first level at or above it), encloses() is the point-in-polygon test of one level
+    and export_polygons() returns the enclosing polygon as parts of rings for GeoPackageWriter.py.
+    """
+
+    name = None
+
+    def buffer(self, x, y, distance):
+        # Square buffer extent around a storage centroid, as used by ContourAnalysis.py
+        return buffer_extent(x, y, distance)
+
+    @abstractmethod
+    def contours(self, extent, interval=0.1, base=0.0):
+        pass
+
+    @abstractmethod
+    def levels(self, contours, x, y):
+        pass
+
+    @abstractmethod
+    def near(self, contours, x, y):
+        pass
+
+    @abstractmethod
+    def encloses(self, contours, level, x, y):
+        pass
+
+    @abstractmethod
+    def export_polygons(self, contours, level, x, y):
+        pass
+
+    def release(self, contours):
+        pass
+
+
+class NumpyBackend(ElevationBackend):
+    """
+    Licence-free backend on DEM windows.
+    dem_reader is anything with read_window(xmin, ymin, xmax, ymax) returning (array, geotransform), e.g. a
+    DemTileCache over a GeoTIFF (DemTileCache.py) or ArcpyDemReader. Contours are traced with marching squares
+    only for the levels the search actually tests, instead of vectorizing the whole 0.1 m series.
+    """
+
+    name = "numpy"
+
+    def __init__(self, dem_reader):
+        self.dem_reader = dem_reader
+
+    def contours(self, extent, interval=0.1, base=0.0):
+        dem, transform = self.dem_reader.read_window(*extent)
+        return {"dem": dem, "transform": transform, "interval": interval, "base": base, "rings": {}}
+
+    def rings(self, contours, level):
+        # Closed rings of one level, traced once
+        if level not in contours["rings"]:
+            lines = marching_squares(contours["dem"], contours["transform"], level)
+            contours["rings"][level] = [line for line in lines if len(line) >= 4 and np.array_equal(line[0], line[-1])]
+        return contours["rings"][level]
+
+    def levels(self, contours, x, y):
+        dem = contours["dem"]
+        if not np.isfinite(dem).any():
+            return []
+        return contour_levels(np.nanmin(dem), np.nanmax(dem), contours["interval"], contours["base"])
+
+    def near(self, contours, x, y):
+        # Ground elevation of the DEM cell under the point
+        row, col = world_to_cell(contours["transform"], x, y)
+        dem = contours["dem"]
+        if not (0 <= row < dem.shape[0] and 0 <= col < dem.shape[1]) or not np.isfinite(dem[row, col]):
+            return None
+        return float(dem[row, col])
+
+    def enclosing_rings(self, contours, level, x, y):
+        rings = self.rings(contours, level)
+        if not rings:
+            return []
+        inside = points_in_rings([(x, y)], rings)[0]
+        return [ring for ring, enclosed in zip(rings, inside) if enclosed]
+
+    def encloses(self, contours, level, x, y):
+        return bool(self.enclosing_rings(contours, level, x, y))
+
+    def export_polygons(self, contours, level, x, y):
+        # The tightest enclosing ring, as the polygon FeatureToPolygon builds from that contour line
+        rings = self.enclosing_rings(contours, level, x, y)
+        if not rings:
+            return None
+        ring = min(rings, key=lambda r: abs(ring_area(r)))
+        return [[ring.tolist()]]
+
+
+def read_dem_window(DEM, extent):
+    # Read the DEM cells covering an extent into a NumPy array with its GDAL style geotransform
+    import arcpy
+    raster = arcpy.Raster(DEM)
+    cell_width = raster.meanCellWidth
+    cell_height = raster.meanCellHeight
+    # Snap the window to the DEM cell grid
+    xmin = raster.extent.XMin + math.floor((extent.XMin - raster.extent.XMin) / cell_width) * cell_width
+    ymin = raster.extent.YMin + math.floor((extent.YMin - raster.extent.YMin) / cell_height) * cell_height
+    ncols = int(math.ceil((extent.XMax - xmin) / cell_width))
+    nrows = int(math.ceil((extent.YMax - ymin) / cell_height))
+    dem = arcpy.RasterToNumPyArray(raster, arcpy.Point(xmin, ymin), ncols, nrows, nodata_to_value=np.nan)
+    transform = (xmin, cell_width, 0.0, ymin + dem.shape[0] * cell_height, 0.0, -cell_height)
+    return dem, transform
+
+
+class ArcpyDemReader:
+    # DEM windows read with arcpy.RasterToNumPyArray (no Spatial Analyst licence), e.g. for a .lyrx DEM
+    def __init__(self, DEM):
+        self.DEM = DEM
+
+    def read_window(self, xmin, ymin, xmax, ymax):
+        import arcpy
+        return read_dem_window(self.DEM, arcpy.Extent(xmin, ymin, xmax, ymax))
+
+
+class ArcpyBackend(ElevationBackend):
+    """
+    The geoprocessing implementation: arcpy.sa.Contour over the buffer extent snapped to the DEM,
+    ground elevation by GetCellValue and the FeatureToPolygon enclosure test (the arcpy engine of ContourAnalysis.py).
+    cluster_contours is a contour feature class already extracted over a larger envelope (a storage cluster);
+    each buffer extent is then clipped out of it instead of running Contour again.
+    Needs the Spatial Analyst extension.
+    """
+
+    name = "arcpy"
+
+    def __init__(self, DEM, scratch="main", spatial_reference=None, cluster_contours=None):
+        import arcpy
+        self.arcpy = arcpy
+        self.DEM = DEM
+        self.scratch = scratch
+        self.spatial_reference = spatial_reference or arcpy.Describe(DEM).spatialReference
+        self.cluster_contours = cluster_contours
+        arcpy.CheckOutExtension("spatial")
+
+    def contours(self, extent, interval=0.1, base=0.0):
+        arcpy = self.arcpy
+        contour_temp = f"memory\\backend_contours_{self.scratch}"
+        if self.cluster_contours is not None:
+            arcpy.analysis.Clip(self.cluster_contours, arcpy.Extent(*extent).polygon, contour_temp)
+        else:
+            with arcpy.EnvManager(extent=arcpy.Extent(*extent), snapRaster=self.DEM):
+                arcpy.sa.Contour(self.DEM, contour_temp, interval, base, 1, "CONTOUR", None)
+        with arcpy.da.SearchCursor(contour_temp, ["SHAPE@", "Contour"], spatial_reference=self.spatial_reference) as cursor:
+            shapes = [(shape, level) for shape, level in cursor]
+        return {"fc": contour_temp, "shapes": shapes, "enclosing": {}}
+
+    def point(self, x, y):
+        return self.arcpy.PointGeometry(self.arcpy.Point(x, y), self.spatial_reference)
+
+    def candidates(self, contours, x, y):
+        # Quick bounding box check: only contours whose extent contains the point can enclose it
+        point_extent = self.point(x, y).extent
+        return [(shape, level) for shape, level in contours["shapes"] if shape.extent.contains(point_extent)]
+
+    def levels(self, contours, x, y):
+        return [level for shape, level in self.candidates(contours, x, y)]
+
+    def near(self, contours, x, y):
+        # Ground elevation at the point; the nearest contour can lie below it and would start the search too low
+        value = self.arcpy.management.GetCellValue(self.DEM, f"{x} {y}").getOutput(0)
+        try:
+            return float(value)
+        except ValueError:
+            # "NoData"
+            return None
+
+    def shape_polygons(self, shape):
+        # Convert a contour line to polygon parts
+        polygon_temp = f"memory\\backend_polygon_{self.scratch}"
+        self.arcpy.management.FeatureToPolygon([shape], polygon_temp)
+        with self.arcpy.da.SearchCursor(polygon_temp, ["SHAPE@"], spatial_reference=self.spatial_reference) as cursor:
+            polygons = [polygon for (polygon,) in cursor]
+        self.arcpy.Delete_management(polygon_temp)
+        return polygons
+
+    def encloses(self, contours, level, x, y):
+        point = self.point(x, y)
+        for shape, shape_level in self.candidates(contours, x, y):
+            if shape_level != level:
+                continue
+            try:
+                polygons = self.shape_polygons(shape)
+            except self.arcpy.ExecuteError as e:
+                print(f"Error converting contour to polygon: {e}")
+                continue
+            for polygon in polygons:
+                if polygon.contains(point):
+                    contours["enclosing"][level] = polygon
+                    return True
+        return False
+
+    def export_polygons(self, contours, level, x, y):
+        if level not in contours["enclosing"] and not self.encloses(contours, level, x, y):
+            return None
+        return polygon_rings(contours["enclosing"][level])
+
+    def release(self, contours):
+        self.arcpy.Delete_management(contours["fc"])
+
+
+def crest_analysis(backend, x, y, buffer_distance, interval=0.1, base=0.0, search="bisect", profiler=None, oid=None):
+    """
+    Highest closed contour enclosing a storage centroid, on any ElevationBackend.
+    Returns None when no closed contour within the buffer encloses the point, otherwise a dict with the
+    contour level, the enclosing polygon parts and the enclosure search statistics (ContourSearch.py).
+    """
+    profiler = profiler or StageProfiler()
+    extent = backend.buffer(x, y, buffer_distance)
+    with profiler.stage("contour", oid):
+        contours = backend.contours(extent, interval, base)
+    try:
+        with profiler.stage("near", oid) as counts:
+            levels = backend.levels(contours, x, y)
+            start_level = backend.near(contours, x, y)
+            counts["count"] = len(levels)
+
+        def encloses(level):
+            with profiler.stage("enclosure-test", oid):
+                return backend.encloses(contours, level, x, y)
+
+        level, search_stats = highest_enclosing_level(levels, encloses, start_level, search)
+        if level is None:
+            return None
+        with profiler.stage("polygon-write", oid):
+            polygons = backend.export_polygons(contours, level, x, y)
+        return {"Contour": level, "polygons": polygons, "search_stats": search_stats}
+    finally:
+        backend.release(contours)
@@ -0,0 +1,229 @@
+# GeoPackageWriter.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Streaming polygon writer for the crest scripts (ContourAnalysis.py, DEM_Extraction_BespokePoints.py).
+# Every storage's polygon is appended to one GeoPackage layer inside batched transactions, instead of
+# writing a shapefile per storage and merging them all at the end. The spatial index is built once on close.
+# Plain sqlite3, no GDAL or arcpy required.
+
+import os
+import sqlite3
+import struct
+
+# GeoPackage 1.2 "GPKG" application id and version
+APPLICATION_ID = 0x47504B47
+USER_VERSION = 10200
+
+# First srs_id given to a spatial reference without an EPSG code (organization NONE), clear of the EPSG range
+CUSTOM_SRS_ID = 100000
+
+WGS84_DEFINITION = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+                    'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]')
+
+CORE_TABLES = """
+CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+CREATE TABLE IF NOT EXISTS gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+CREATE TABLE IF NOT EXISTS gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, definition TEXT NOT NULL,
+    scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+"""
+
+# Triggers of the GeoPackage rtree extension, which keep the index in step with later edits (e.g. in ArcGIS Pro or QGIS)
+RTREE_TRIGGERS = """
+CREATE TRIGGER rtree_{t}_{c}_insert AFTER INSERT ON "{t}" WHEN (new."{c}" NOT NULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.fid, ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END;
+CREATE TRIGGER rtree_{t}_{c}_update1 AFTER UPDATE OF "{c}" ON "{t}"
+WHEN OLD.fid = NEW.fid AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.fid, ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END;
+CREATE TRIGGER rtree_{t}_{c}_update2 AFTER UPDATE OF "{c}" ON "{t}" WHEN OLD.fid = NEW.fid AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid; END;
+CREATE TRIGGER rtree_{t}_{c}_update3 AFTER UPDATE ON "{t}" WHEN OLD.fid != NEW.fid AND (NEW."{c}" NOTNULL AND NOT ST_IsEmpty(NEW."{c}"))
+BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid;
+INSERT OR REPLACE INTO rtree_{t}_{c} VALUES (NEW.fid, ST_MinX(NEW."{c}"), ST_MaxX(NEW."{c}"), ST_MinY(NEW."{c}"), ST_MaxY(NEW."{c}")); END;
+CREATE TRIGGER rtree_{t}_{c}_update4 AFTER UPDATE ON "{t}" WHEN OLD.fid != NEW.fid AND (NEW."{c}" ISNULL OR ST_IsEmpty(NEW."{c}"))
+BEGIN DELETE FROM rtree_{t}_{c} WHERE id IN (OLD.fid, NEW.fid); END;
+CREATE TRIGGER rtree_{t}_{c}_delete AFTER DELETE ON "{t}" WHEN old."{c}" NOT NULL
+BEGIN DELETE FROM rtree_{t}_{c} WHERE id = OLD.fid; END;
+"""
+RTREE_TRIGGER_NAMES = ("insert", "update1", "update2", "update3", "update4", "delete")
+
+
+def close_ring(ring):
+    ring = [(float(x), float(y)) for x, y in ring]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return ring
+
+
+def polygon_blob(polygons, srs_id):
+    """
+    GeoPackage geometry blob of a MultiPolygon.
+    polygons is a list of polygons, each a list of rings of (x, y) with the outer ring first.
+    The blob is the standard GP header with the XY envelope followed by little-endian WKB.
+    """
+    wkb = [struct.pack("<BII", 1, 6, len(polygons))]
+    xs = []
+    ys = []
+    for rings in polygons:
+        wkb.append(struct.pack("<BII", 1, 3, len(rings)))
+        for ring in rings:
+            ring = close_ring(ring)
+            wkb.append(struct.pack("<I", len(ring)))
+            wkb.append(struct.pack(f"<{2 * len(ring)}d", *[value for point in ring for value in point]))
+            xs.extend(x for x, y in ring)
+            ys.extend(y for x, y in ring)
+    # Flags: little-endian, envelope [minx, maxx, miny, maxy]
+    header = b"GP" + bytes((0, 0b011)) + struct.pack("<i4d", srs_id, min(xs), max(xs), min(ys), max(ys))
+    return header + b"".join(wkb)
+
+
+def blob_envelope(blob):
+    # (minx, maxx, miny, maxy) from the header of a blob written by polygon_blob
+    return struct.unpack_from("<4d", blob, 8)
+
+
+class GeoPackageWriter:
+    """
+    Appends MultiPolygon features to one GeoPackage layer.
+    srs is (srs_id, srs_name, definition), e.g. the EPSG code, name and WKT of the storages' spatial reference.
+    srs_id None (a spatial reference without an EPSG code) registers the definition under a custom srs_id (see register_srs).
+    fields is a list of (name, SQLite type) attribute columns. Rows are inserted batch_size at a time, each batch in
+    one transaction. An existing file is reopened for appending (resume) unless overwrite=True; the rtree spatial
+    index is dropped while writing and rebuilt once by close().
+    """
+
+    def __init__(self, path, layer, srs, fields, batch_size=500, overwrite=False):
+        if overwrite and os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.layer = layer
+        self.fields = [name for name, sql_type in fields]
+        self.batch_size = batch_size
+        self.pending = []
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(f"PRAGMA application_id = {APPLICATION_ID}")
+        self.connection.execute(f"PRAGMA user_version = {USER_VERSION}")
+        self.connection.executescript(CORE_TABLES)
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            [("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+             ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+             ("WGS 84 geodetic", 4326, "EPSG", 4326, WGS84_DEFINITION, None)])
+        self.srs_id = self.register_srs(*srs)
+        columns = "".join(f', "{name}" {sql_type}' for name, sql_type in fields)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{layer}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom MULTIPOLYGON{columns})')
+        self.connection.execute("INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+                                (layer, layer, self.srs_id))
+        self.connection.execute("INSERT OR IGNORE INTO gpkg_geometry_columns VALUES (?, 'geom', 'MULTIPOLYGON', ?, 0, 0)", (layer, self.srs_id))
+        self.drop_spatial_index()
+        self.connection.commit()
+        column_names = "".join(f', "{name}"' for name in self.fields)
+        placeholders = ", ".join("?" for _ in range(len(self.fields) + 1))
+        self.insert = f'INSERT INTO "{layer}" (geom{column_names}) VALUES ({placeholders})'
+
+    def register_srs(self, srs_id, name, definition):
+        # srs_id of the layer's spatial reference. Without an EPSG code the row with the same definition is reused
+        # (a resumed run), otherwise the next id from CUSTOM_SRS_ID is allocated, so it never collides with 0 or -1
+        if srs_id is not None:
+            self.connection.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, 'EPSG', ?, ?, NULL)",
+                                    (name, srs_id, srs_id, definition))
+            return srs_id
+        row = self.connection.execute("SELECT srs_id FROM gpkg_spatial_ref_sys WHERE organization = 'NONE' AND srs_id >= ? "
+                                      "AND definition = ?", (CUSTOM_SRS_ID, definition)).fetchone()
+        if row:
+            return row[0]
+        (last,) = self.connection.execute("SELECT MAX(srs_id) FROM gpkg_spatial_ref_sys").fetchone()
+        srs_id = max(CUSTOM_SRS_ID, last + 1)
+        self.connection.execute("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, 'NONE', ?, ?, NULL)", (name, srs_id, srs_id, definition))
+        return srs_id
+
+    def drop_spatial_index(self):
+        # The index triggers call ST_* functions that plain sqlite3 does not define, so the index is rebuilt on close
+        for name in RTREE_TRIGGER_NAMES:
+            self.connection.execute(f"DROP TRIGGER IF EXISTS rtree_{self.layer}_geom_{name}")
+        self.connection.execute(f"DROP TABLE IF EXISTS rtree_{self.layer}_geom")
+        self.connection.execute("DELETE FROM gpkg_extensions WHERE table_name = ? AND extension_name = 'gpkg_rtree_index'", (self.layer,))
+
+    def write(self, polygons, values):
+        # Queue one feature (values in the order of fields); returns True when this call committed a batch
+        blob = polygon_blob(polygons, self.srs_id) if polygons else None
+        self.pending.append((blob, *values))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        # Insert and commit the queued features in one transaction
+        if self.pending:
+            self.connection.executemany(self.insert, self.pending)
+            self.connection.commit()
+            self.pending = []
+
+    def prune(self, field, keep):
+        # Delete committed features whose field value is not in keep, e.g. storages missing from the run manifest
+        keep = set(keep)
+        stale = [(value,) for (value,) in self.connection.execute(f'SELECT DISTINCT "{field}" FROM "{self.layer}"') if value not in keep]
+        self.connection.executemany(f'DELETE FROM "{self.layer}" WHERE "{field}" = ?', stale)
+        self.connection.commit()
+        return len(stale)
+
+    def build_spatial_index(self):
+        # Bulk load the rtree from the blob envelopes and register the extension and layer extent
+        rtree = f"rtree_{self.layer}_geom"
+        self.connection.execute(f"CREATE VIRTUAL TABLE {rtree} USING rtree(id, minx, maxx, miny, maxy)")
+        rows = [(fid, *blob_envelope(blob)) for fid, blob in self.connection.execute(f'SELECT fid, geom FROM "{self.layer}" WHERE geom NOT NULL')]
+        self.connection.executemany(f"INSERT INTO {rtree} VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.executescript(RTREE_TRIGGERS.format(t=self.layer, c="geom"))
+        self.connection.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                                (self.layer,))
+        if rows:
+            self.connection.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ?, "
+                                    "last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE table_name = ?",
+                                    (min(r[1] for r in rows), min(r[3] for r in rows), max(r[2] for r in rows), max(r[4] for r in rows), self.layer))
+        self.connection.commit()
+        return len(rows)
+
+    def close(self, spatial_index=True):
+        self.flush()
+        if spatial_index:
+            self.build_spatial_index()
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    # Write 20,000 square storages and query the index
+    import time
+    path = "crest_polygons_demo.gpkg"
+    start_time = time.time()
+    writer = GeoPackageWriter(path, "crest_polygons", (28356, "GDA94 / MGA zone 56", "unknown"),
+                              [("StorageID", "INTEGER"), ("Contour", "REAL")], overwrite=True)
+    for oid in range(20000):
+        x, y = 400000.0 + (oid % 200) * 500.0, 7000000.0 + (oid // 200) * 500.0
+        writer.write([[[(x, y), (x, y + 100), (x + 100, y + 100), (x + 100, y)], [(x + 40, y + 40), (x + 60, y + 40), (x + 60, y + 60)]]], (oid, 10.0 + oid % 7))
+    writer.close()
+    print("Written in", time.time() - start_time, "s")
+    connection = sqlite3.connect(path)
+    print("Features near (401020, 7000020):", connection.execute(
+        "SELECT id FROM rtree_crest_polygons_geom WHERE minx <= 401020 AND maxx >= 401020 AND miny <= 7000020 AND maxy >= 7000020").fetchall())
+    connection.close()
+    # A custom projection (no EPSG code) gets its own srs_id, kept when the run resumes
+    custom = (None, "Custom Albers", 'PROJCS["Custom Albers",GEOGCS["GDA94",DATUM["GDA94",SPHEROID["GRS 1980",6378137,298.257222101]]]]')
+    srs_ids = []
+    for overwrite in (True, False):
+        writer = GeoPackageWriter(path, "crest_polygons", custom, [("StorageID", "INTEGER")], overwrite=overwrite)
+        writer.write([[[(0, 0), (0, 1), (1, 1)]]], (1,))
+        writer.close()
+        srs_ids.append(writer.srs_id)
+    print("Custom srs_id:", srs_ids)
+    os.remove(path)
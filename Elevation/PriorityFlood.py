@@ -0,0 +1,199 @@
+# PriorityFlood.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Raster crest level solver for ContourAnalysis.py and DEM_Extraction_BespokePoints.py.
+# The highest closed contour around a storage is the spill elevation of the depression holding it,
+# so the crest is found by priority-flood (fill-and-spill) directly on the DEM window
+# instead of vectorizing and scanning 0.1 m contours. Pure NumPy, no arcpy required.
+
+import heapq
+import math
+from collections import deque
+
+import numpy as np
+
+# 8-connected neighbour offsets
+NEIGHBOURS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def world_to_cell(transform, x, y):
+    # Row and column of the cell containing a map coordinate
+    # transform is a GDAL style geotransform (x_origin, cell_width, 0, y_origin, 0, -cell_height)
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    return int(math.floor((y - y_origin) / cell_height)), int(math.floor((x - x_origin) / cell_width))
+
+
+def valid_cells(dem, nodata=None):
+    # Cells holding a real elevation; NoData is treated as an outlet like the window edge
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+    return valid
+
+
+def spill_elevation(dem, seed, nodata=None):
+    # Priority-flood outward from the seed cell, always growing into the lowest neighbour
+    # The running maximum of the popped elevations is the minimax path height from the seed,
+    # so the level at which the flood first reaches the window edge (or NoData) is the spill elevation
+    # Returns (spill elevation, spill cell), or (None, None) when the seed is not inside a closed depression
+    rows, cols = dem.shape
+    valid = valid_cells(dem, nodata)
+    seed_row, seed_col = seed
+    if not (0 <= seed_row < rows and 0 <= seed_col < cols) or not valid[seed_row, seed_col]:
+        return None, None
+    visited = np.zeros(dem.shape, dtype=bool)
+    visited[seed_row, seed_col] = True
+    heap = [(float(dem[seed_row, seed_col]), seed_row, seed_col)]
+    level = float("-inf")
+    while heap:
+        elevation, row, col = heapq.heappop(heap)
+        level = max(level, elevation)
+        if row == 0 or col == 0 or row == rows - 1 or col == cols - 1:
+            break
+        outlet = False
+        for d_row, d_col in NEIGHBOURS:
+            n_row, n_col = row + d_row, col + d_col
+            if visited[n_row, n_col]:
+                continue
+            if not valid[n_row, n_col]:
+                outlet = True
+                continue
+            visited[n_row, n_col] = True
+            heapq.heappush(heap, (float(dem[n_row, n_col]), n_row, n_col))
+        if outlet:
+            break
+    else:
+        return None, None
+    if level <= dem[seed_row, seed_col]:
+        # Water at the seed drains straight out of the window
+        return None, None
+    return level, (row, col)
+
+
+def snap_to_contour(level, contour_interval, base_contour=0.0):
+    # Highest contour of the arcpy.sa.Contour series that lies strictly below the spill elevation
+    # A contour at exactly the spill elevation runs through the spill point and does not close
+    steps = math.ceil((level - base_contour) / contour_interval - 1e-9) - 1
+    return round(base_contour + steps * contour_interval, 10)
+
+
+def inundation_mask(dem, seed, level, nodata=None):
+    # Cells connected to the seed that lie below the given water level
+    below = valid_cells(dem, nodata) & (dem < level)
+    mask = np.zeros(dem.shape, dtype=bool)
+    seed_row, seed_col = seed
+    if not below[seed_row, seed_col]:
+        return mask
+    rows, cols = dem.shape
+    mask[seed_row, seed_col] = True
+    queue = deque([seed])
+    while queue:
+        row, col = queue.popleft()
+        for d_row, d_col in NEIGHBOURS:
+            n_row, n_col = row + d_row, col + d_col
+            if 0 <= n_row < rows and 0 <= n_col < cols and below[n_row, n_col] and not mask[n_row, n_col]:
+                mask[n_row, n_col] = True
+                queue.append((n_row, n_col))
+    return mask
+
+
+def ring_area(ring):
+    # Signed shoelace area (positive for counter-clockwise rings)
+    x = ring[:, 0]
+    y = ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def mask_to_rings(mask, transform):
+    # Trace the cell edges bounding a boolean mask into closed rings in map coordinates
+    # Outer ring first and clockwise, holes counter-clockwise (ESRI ring order)
+    padded = np.pad(mask, 1)
+    inner = padded[1:-1, 1:-1]
+    edges = {}
+    # Directed edges between cell corners (row, col), chained around each boundary
+    for d_row, d_col, start, end in ((-1, 0, (0, 1), (0, 0)), (0, -1, (0, 0), (1, 0)),
+                                     (1, 0, (1, 0), (1, 1)), (0, 1, (1, 1), (0, 1))):
+        neighbour = padded[1 + d_row:padded.shape[0] - 1 + d_row, 1 + d_col:padded.shape[1] - 1 + d_col]
+        for row, col in zip(*np.nonzero(inner & ~neighbour)):
+            edges.setdefault((row + start[0], col + start[1]), []).append((row + end[0], col + end[1]))
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    rings = []
+    while edges:
+        first = next(iter(edges))
+        corners = [first]
+        current = first
+        direction = None
+        while True:
+            targets = edges[current]
+            if len(targets) > 1 and direction is not None:
+                # Pinch point between diagonal cells: keep turning the same way so rings stay simple
+                targets.sort(key=lambda t: (direction[0] * (t[1] - current[1]) - direction[1] * (t[0] - current[0])))
+            target = targets.pop(0)
+            if not targets:
+                del edges[current]
+            direction = (target[0] - current[0], target[1] - current[1])
+            current = target
+            if current == first:
+                break
+            corners.append(current)
+        corners.append(first)
+        corners = np.array(corners, dtype=float)
+        # Drop vertices in the middle of straight runs
+        keep = np.ones(len(corners), dtype=bool)
+        before = corners[1:-1] - corners[:-2]
+        after = corners[2:] - corners[1:-1]
+        keep[1:-1] = before[:, 0] * after[:, 1] - before[:, 1] * after[:, 0] != 0
+        corners = corners[keep]
+        ring = np.column_stack((x_origin + corners[:, 1] * cell_width, y_origin + corners[:, 0] * cell_height))
+        rings.append(ring)
+    rings.sort(key=lambda r: abs(ring_area(r)), reverse=True)
+    for i, ring in enumerate(rings):
+        clockwise = ring_area(ring) < 0
+        if clockwise != (i == 0):
+            rings[i] = ring[::-1]
+    return rings
+
+
+def crest_level(dem, transform, point, nodata=None, contour_interval=None, base_contour=0.0):
+    """
+    Crest level and inundation polygon of the depression containing a point.
+    dem is a 2D elevation window (for example read from Merged_DEM.tif) and transform its GDAL geotransform.
+    When contour_interval is given the level is snapped to the highest closed contour of that series,
+    matching the 0.1 m arcpy.sa.Contour output used by ContourAnalysis.py.
+    Returns None when the point is not inside a closed depression within the window, otherwise a dict with
+    the level, the raw spill elevation, the spill point, the inundation mask and the polygon rings.
+    """
+    dem = np.asarray(dem, dtype=float)
+    seed = world_to_cell(transform, point[0], point[1])
+    spill, spill_cell = spill_elevation(dem, seed, nodata)
+    if spill is None:
+        return None
+    level = spill if contour_interval is None else snap_to_contour(spill, contour_interval, base_contour)
+    mask = inundation_mask(dem, seed, level, nodata)
+    if not mask.any():
+        return None
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    spill_point = (x_origin + (spill_cell[1] + 0.5) * cell_width, y_origin + (spill_cell[0] + 0.5) * cell_height)
+    return {
+        "Contour": level,
+        "spill_elevation": spill,
+        "spill_point": spill_point,
+        "mask": mask,
+        "rings": mask_to_rings(mask, transform),
+    }
+
+
+if __name__ == '__main__':
+    # Synthetic dam: a bowl with a rim at 12.0 m and a spillway notch at 10.45 m
+    rows, cols = np.mgrid[0:201, 0:201]
+    distance = np.hypot(rows - 100, cols - 100)
+    dem = np.where(distance < 60, 5.0 + distance / 12.0, 12.0 - (distance - 60) / 20.0)
+    dem[99:102, 155:] = np.minimum(dem[99:102, 155:], 10.45)
+    transform = (500000.0, 1.0, 0.0, 7000000.0, 0.0, -1.0)
+    result = crest_level(dem, transform, (500100.5, 6999899.5), contour_interval=0.1)
+    print("Spill elevation:", result["spill_elevation"])
+    print("Highest closed contour:", result["Contour"])
+    print("Inundated cells:", int(result["mask"].sum()), "rings:", len(result["rings"]))
@@ -0,0 +1,81 @@
+# RunManifest.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Checkpoint/resume manifest for long crest runs (ContourAnalysis.py, DEM_Extraction_BespokePoints.py).
+# One JSON line is appended per finished storage, keyed by its oid and a hash of its inputs,
+# so a restarted run skips every storage that already completed with the same inputs.
+
+import hashlib
+import json
+import os
+import time
+
+
+def file_signature(path):
+    # Size and modification time of an input file, so a replaced DEM invalidates earlier results
+    # A dataset inside a file geodatabase (C:\data\dem.gdb\dem) has no file of its own and is signed by its .gdb folder
+    if not os.path.exists(path) and ".gdb" in path.lower():
+        path = path[:path.lower().index(".gdb") + 4]
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def input_hash(oid, x, y, settings):
+    # Hash of everything that determines the result of one storage
+    payload = {"oid": oid, "x": round(x, 3), "y": round(y, 3), "settings": settings}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class RunManifest:
+    """
+    Append-only JSON lines manifest of finished storages.
+    Every entry holds the oid, the input hash and the storage's result fields; the latest entry of an oid wins.
+    Entries are flushed to disk as they are recorded, so the manifest survives a crash at any point.
+    resume=False discards the manifest of an earlier run.
+    """
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.entries = {}
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for line in data.decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line cut short by a crash
+                continue
+            self.entries[entry["oid"]] = entry
+        if data and not data.endswith(b"\n"):
+            # Terminate the cut line so the next entry starts on its own line
+            with open(self.path, "a") as f:
+                f.write("\n")
+
+    def is_complete(self, oid, storage_hash):
+        entry = self.entries.get(oid)
+        return entry is not None and entry["input_hash"] == storage_hash
+
+    def completed(self, hashes):
+        # Oids of {oid: input hash} that finished with the same inputs in an earlier run
+        return {oid for oid, storage_hash in hashes.items() if self.is_complete(oid, storage_hash)}
+
+    def record(self, oid, storage_hash, **fields):
+        entry = {"oid": oid, "input_hash": storage_hash, "finished": time.strftime("%Y-%m-%d %H:%M:%S"), **fields}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[oid] = entry
+        return entry
@@ -0,0 +1,340 @@
+# SpatialPortalExport.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Chunked DEM export from the SpatialPortal elevation image service, replacing the single export_image call
+# over gdf.total_bounds in SpatialPortal_DEM.ipynb. The extent is split into chunks within the service's
+# maxImageWidth/maxImageHeight, fetched concurrently with retry/backoff, cached on disk and assembled into one GeoTIFF.
+# Only urllib is used for the requests, so the service URL can point at a local stand-in server.
+# Assembly needs rasterio (pip install rasterio).
+# Usage: python SpatialPortalExport.py xmin ymin xmax ymax --sr 3857 --cell-size 1 --output exported_image.tif
+#        python SpatialPortalExport.py --check   (downloader against a local stand-in server, no rasterio needed)
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PORTAL_URL = "https://spatial.information.qld.gov.au/arcgis"
+ELEVATION_ITEM_ID = "278092282caf4a5ba77160df0d52f32e"
+# HTTP statuses worth retrying: throttling and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ExportError(Exception):
+    # The service answered with an error that retrying will not fix
+    pass
+
+
+def get_json(url, params=None, timeout=60):
+    # GET a JSON resource of the ArcGIS REST API, raising the error object it returns with a 200 status
+    query = urllib.parse.urlencode(dict(params or {}, f="json"))
+    with urllib.request.urlopen(f"{url}?{query}", timeout=timeout) as response:
+        body = json.loads(response.read().decode("utf-8"))
+    if "error" in body:
+        raise ExportError(f"{url}: {body['error'].get('message', body['error'])}")
+    return body
+
+
+def resolve_service_url(portal_url=PORTAL_URL, item_id=ELEVATION_ITEM_ID):
+    # Image service URL of a portal item, as gis.content.get(item_id).url does in the notebook
+    return get_json(f"{portal_url}/sharing/rest/content/items/{item_id}")["url"]
+
+
+def service_limits(service_url):
+    # Largest image the service exports in one request (ArcGIS defaults when not advertised)
+    info = get_json(service_url)
+    return info.get("maxImageWidth", 4000), info.get("maxImageHeight", 4000)
+
+
+def plan_chunks(extent, cell_size, max_width, max_height):
+    """
+    Split an extent into chunks of at most max_width x max_height pixels of cell_size.
+    The extent is snapped outwards to the cell grid so neighbouring chunks share edges exactly.
+    Returns the snapped extent, its size in pixels and a list of chunks, each a dict with
+    the chunk bbox, its size in pixels and its pixel offset (col, row) from the top left corner.
+    """
+    xmin, ymin, xmax, ymax = extent
+    xmin = math.floor(xmin / cell_size) * cell_size
+    ymin = math.floor(ymin / cell_size) * cell_size
+    xmax = math.ceil(xmax / cell_size) * cell_size
+    ymax = math.ceil(ymax / cell_size) * cell_size
+    width = max(int(round((xmax - xmin) / cell_size)), 1)
+    height = max(int(round((ymax - ymin) / cell_size)), 1)
+    chunks = []
+    for row in range(0, height, max_height):
+        for col in range(0, width, max_width):
+            chunk_width = min(max_width, width - col)
+            chunk_height = min(max_height, height - row)
+            left = xmin + col * cell_size
+            top = ymax - row * cell_size
+            chunks.append({"bbox": (left, top - chunk_height * cell_size, left + chunk_width * cell_size, top),
+                           "size": (chunk_width, chunk_height), "offset": (col, row)})
+    return (xmin, ymin, xmax, ymax), (width, height), chunks
+
+
+def cache_key(service_url, bbox, spatial_reference, size, item_id=None):
+    # Cache file name of a chunk: the same service item, bbox, spatial reference and size give the same key
+    key = json.dumps([item_id or service_url, [round(v, 6) for v in bbox], spatial_reference, list(size)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ChunkDownloader:
+    """
+    Fetches exportImage chunks from an image service into an on-disk cache.
+    At most workers requests run at once; failed requests are retried up to retries times with exponential
+    backoff (backoff, 2 x backoff, ... seconds plus jitter). Chunks already in cache_folder are not downloaded again.
+    """
+
+    def __init__(self, service_url, cache_folder, spatial_reference=3857, item_id=None, workers=4, retries=4,
+                 backoff=1.0, timeout=120, pixel_type="F32", no_data=-9999):
+        self.service_url = service_url.rstrip("/")
+        self.cache_folder = cache_folder
+        self.spatial_reference = spatial_reference
+        self.item_id = item_id
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pixel_type = pixel_type
+        self.no_data = no_data
+        self.stats = {"downloaded": 0, "cached": 0, "retries": 0}
+        self.lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def chunk_path(self, chunk):
+        key = cache_key(self.service_url, chunk["bbox"], self.spatial_reference, chunk["size"], self.item_id)
+        return os.path.join(self.cache_folder, f"{key}.tif")
+
+    def export_url(self, chunk):
+        params = {
+            "bbox": ",".join(str(v) for v in chunk["bbox"]),
+            "bboxSR": self.spatial_reference,
+            "imageSR": self.spatial_reference,
+            "size": f"{chunk['size'][0]},{chunk['size'][1]}",
+            "format": "tiff",
+            "pixelType": self.pixel_type,
+            "noData": self.no_data,
+            "interpolation": "RSP_BilinearInterpolation",
+            "f": "image",
+        }
+        return f"{self.service_url}/exportImage?{urllib.parse.urlencode(params)}"
+
+    def request(self, url):
+        # One exportImage request; the service reports errors as JSON even with a 200 status
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            content_type = response.headers.get("Content-Type", "")
+            data = response.read()
+        if "json" in content_type or data[:1] == b"{":
+            try:
+                error = json.loads(data.decode("utf-8")).get("error", {})
+            except ValueError:
+                error = {}
+            if error.get("code") in RETRY_STATUSES:
+                raise urllib.error.HTTPError(url, error["code"], error.get("message", ""), None, None)
+            raise ExportError(f"exportImage failed: {error.get('message', data[:200])}")
+        return data
+
+    def fetch(self, chunk):
+        """
+        Path of a chunk's GeoTIFF in the cache, downloading it first when missing.
+        The file is written under a temporary name and renamed, so an interrupted run never leaves a partial chunk.
+        """
+        path = self.chunk_path(chunk)
+        if os.path.exists(path):
+            self.count("cached")
+            return path
+        url = self.export_url(chunk)
+        for attempt in range(self.retries + 1):
+            try:
+                data = self.request(url)
+                break
+            except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+                status = getattr(e, "code", None)
+                if (status is not None and status not in RETRY_STATUSES) or attempt == self.retries:
+                    raise
+                self.count("retries")
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                print(f"Chunk {chunk['offset']} failed ({e}), retrying in {delay:.1f} s")
+                time.sleep(delay)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        with open(temp_path, "wb") as chunk_file:
+            chunk_file.write(data)
+        os.replace(temp_path, path)
+        self.count("downloaded")
+        return path
+
+    def fetch_all(self, chunks):
+        # Cached paths of all chunks, in chunk order, fetched on at most workers threads
+        with ThreadPoolExecutor(self.workers) as pool:
+            paths = list(pool.map(self.fetch, chunks))
+        print(f"Chunks: {self.stats['downloaded']} downloaded, {self.stats['cached']} from cache, "
+              f"{self.stats['retries']} retries")
+        return paths
+
+
+def assemble_geotiff(chunks, paths, extent, size, cell_size, spatial_reference, output_path, no_data=-9999):
+    # Write every chunk into its window of one tiled, compressed GeoTIFF over the whole extent
+    try:
+        import rasterio
+        from rasterio.crs import CRS
+        from rasterio.transform import from_origin
+        from rasterio.windows import Window
+    except ImportError:
+        raise ImportError("rasterio is required to assemble the exported chunks: pip install rasterio")
+    profile = {"driver": "GTiff", "width": size[0], "height": size[1], "count": 1, "dtype": "float32",
+               "crs": CRS.from_epsg(spatial_reference), "transform": from_origin(extent[0], extent[3], cell_size, cell_size),
+               "nodata": no_data, "tiled": True, "blockxsize": 512, "blockysize": 512, "compress": "deflate",
+               "predictor": 3, "bigtiff": "IF_SAFER"}
+    with rasterio.open(output_path, "w", **profile) as output:
+        for chunk, path in zip(chunks, paths):
+            with rasterio.open(path) as source:
+                data = source.read(1).astype("float32")
+            col, row = chunk["offset"]
+            output.write(data, 1, window=Window(col, row, chunk["size"][0], chunk["size"][1]))
+    return output_path
+
+
+def export_dem(extent, output_path, cell_size=1.0, spatial_reference=3857, service_url=None, cache_folder="dem_cache",
+               workers=4, retries=4, backoff=1.0, max_size=None):
+    """
+    Export the DEM over extent (xmin, ymin, xmax, ymax in spatial_reference) to one GeoTIFF at cell_size.
+    service_url defaults to the SpatialPortal elevation service resolved from its portal item; max_size (width, height)
+    defaults to the service's own limits. Returns the output path.
+    """
+    item_id = None
+    if service_url is None:
+        item_id = ELEVATION_ITEM_ID
+        service_url = resolve_service_url(PORTAL_URL, item_id)
+    max_width, max_height = max_size or service_limits(service_url)
+    grid_extent, size, chunks = plan_chunks(extent, cell_size, max_width, max_height)
+    print(f"Exporting {size[0]} x {size[1]} pixels in {len(chunks)} chunks of at most {max_width} x {max_height}")
+    downloader = ChunkDownloader(service_url, cache_folder, spatial_reference, item_id, workers, retries, backoff)
+    paths = downloader.fetch_all(chunks)
+    assemble_geotiff(chunks, paths, grid_extent, size, cell_size, spatial_reference, output_path, downloader.no_data)
+    print("Exported image saved to:", output_path)
+    return output_path
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    exportImage of a local stand-in image service. The first request for each bbox fails with the status in
+    server.first_status (a JSON error with a 200 status when json_errors is set, as ArcGIS reports them), later
+    requests return the bbox as the image bytes. A bbox starting at server.bad_left gets a non-retryable JSON error.
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        bbox = urllib.parse.parse_qs(url.query)["bbox"][0]
+        with self.server.lock:
+            self.server.requests.append(bbox)
+            attempt = self.server.requests.count(bbox)
+        if bbox.split(",")[0] == self.server.bad_left:
+            self.reply(200, json.dumps({"error": {"code": 400, "message": "Invalid bbox"}}).encode("utf-8"), "application/json")
+        elif attempt == 1 and self.server.json_errors:
+            self.reply(200, json.dumps({"error": {"code": self.server.first_status, "message": "Busy"}}).encode("utf-8"), "application/json")
+        elif attempt == 1:
+            self.reply(self.server.first_status, b"Busy", "text/plain")
+        else:
+            self.reply(200, bbox.encode("utf-8"), "image/tiff")
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def server_check():
+    # ChunkDownloader against a local stand-in server: retry/backoff, the .part rename and the on-disk cache
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.first_status = 503
+    server.json_errors = False
+    server.bad_left = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service_url = f"http://127.0.0.1:{server.server_address[1]}/arcgis/rest/services/Elevation/ImageServer"
+    cache_folder = tempfile.mkdtemp(prefix="dem_cache_")
+    ok = True
+    try:
+        extent, size, chunks = plan_chunks((0, 0, 250, 120), 1, 100, 100)
+        downloader = ChunkDownloader(service_url, cache_folder, workers=3, retries=2, backoff=0.01)
+        paths = downloader.fetch_all(chunks)
+        # Every chunk failed once with a 503 and was retried, then written under its cache key with no .part left
+        ok &= downloader.stats == {"downloaded": len(chunks), "cached": 0, "retries": len(chunks)}
+        ok &= len(server.requests) == 2 * len(chunks)
+        for chunk, path in zip(chunks, paths):
+            with open(path, "rb") as chunk_file:
+                ok &= chunk_file.read().decode("utf-8") == ",".join(str(v) for v in chunk["bbox"])
+        ok &= not [name for name in os.listdir(cache_folder) if name.endswith(".part")]
+        # A second run is served from the cache without a request
+        cached = ChunkDownloader(service_url, cache_folder, workers=3, retries=2, backoff=0.01)
+        ok &= cached.fetch_all(chunks) == paths and cached.stats["cached"] == len(chunks)
+        ok &= len(server.requests) == 2 * len(chunks)
+        # A throttling error reported as JSON with a 200 status is retried too
+        server.json_errors, server.first_status = True, 429
+        server.requests = []
+        shutil.rmtree(cache_folder)
+        retried = ChunkDownloader(service_url, cache_folder, retries=2, backoff=0.01)
+        retried.fetch(chunks[0])
+        ok &= retried.stats["retries"] == 1
+        # A non-retryable error is raised straight away and leaves nothing in the cache
+        server.bad_left = str(chunks[1]["bbox"][0])
+        before = len(server.requests)
+        try:
+            retried.fetch(chunks[1])
+            ok = False
+        except ExportError:
+            ok &= len(server.requests) == before + 1 and not os.path.exists(retried.chunk_path(chunks[1]))
+        print(f"{len(chunks)} chunks of {size[0]} x {size[1]} pixels")
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_folder, ignore_errors=True)
+    return bool(ok)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunked DEM export from the SpatialPortal elevation service")
+    parser.add_argument("bounds", type=float, nargs="*", metavar="BOUND", help="XMIN YMIN XMAX YMAX")
+    parser.add_argument("--sr", type=int, default=3857, help="EPSG code of the bounds and the output")
+    parser.add_argument("--cell-size", type=float, default=1.0)
+    parser.add_argument("--output", default="exported_image.tif")
+    parser.add_argument("--service-url", help="Image service URL, e.g. a local stand-in server")
+    parser.add_argument("--cache", default="dem_cache")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--check", action="store_true", help="Run the downloader against a local stand-in server")
+    args = parser.parse_args()
+    if args.check:
+        print("Chunk downloader check passed" if server_check() else "Chunk downloader check failed")
+        return
+    if len(args.bounds) != 4:
+        parser.error("expected four bounds: XMIN YMIN XMAX YMAX")
+    export_dem(args.bounds, args.output, args.cell_size, args.sr, args.service_url, args.cache, args.workers, args.retries)
+
+
+if __name__ == '__main__':
+    main()
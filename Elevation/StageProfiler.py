@@ -0,0 +1,118 @@
+# StageProfiler.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Structured stage timing for the Elevation scripts.
+# Durations and record counts are collected per storage and per named stage, and summarised at the
+# end of a run as p50/p95/max per stage (JSON/CSV) to show which stage dominates a statewide run.
+
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+# Stages used by ContourAnalysis.py and DEM_Extraction_BespokePoints.py
+STAGES = ("cluster-extract", "contour", "contour-read", "near", "dem-window", "priority-flood", "enclosure-test", "polygon-write",
+          "append", "merge")
+
+
+def percentile(values, q):
+    # Linearly interpolated percentile (q in 0-100) of a list of numbers
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class StageProfiler:
+    """
+    Collects (stage, oid) durations and record counts; run-level stages such as the merge use oid None.
+    Repeated timings of the same stage for the same storage (e.g. one enclosure test per contour)
+    accumulate into one record, so percentiles are taken over storages.
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.records = {}
+
+    def add(self, stage, oid=None, seconds=0.0, count=None, calls=1):
+        record = self.records.setdefault((stage, oid), {"stage": stage, "oid": oid, "seconds": 0.0, "count": None, "calls": 0})
+        record["seconds"] += seconds
+        record["calls"] += calls
+        if count is not None:
+            record["count"] = (record["count"] or 0) + count
+        return record
+
+    def share(self, stage, oids, seconds):
+        # Split one timing shared by several storages (e.g. a cluster's extraction) evenly over them, so per storage
+        # percentiles stay comparable with unclustered runs instead of one storage carrying the whole cost
+        for oid in oids:
+            self.add(stage, oid, seconds / len(oids))
+
+    @contextmanager
+    def stage(self, stage, oid=None):
+        # Time a block of work; the yielded dict takes an optional record count, e.g. counts["count"] = n
+        counts = {"count": None}
+        start_time = time.time()
+        try:
+            yield counts
+        finally:
+            seconds = time.time() - start_time
+            self.add(stage, oid, seconds, counts["count"])
+            if self.verbose:
+                print(f"Time taken for {stage}:", seconds)
+
+    def export(self):
+        # Plain records, e.g. to send back from a pool worker
+        return list(self.records.values())
+
+    def extend(self, records):
+        # Fold in records exported by another profiler
+        for record in records:
+            self.add(record["stage"], record["oid"], record["seconds"], record["count"], record["calls"])
+
+    def summary(self):
+        # Per stage: number of storages, calls, total seconds, p50/p95/max seconds per storage and total record count
+        by_stage = {}
+        for record in self.records.values():
+            by_stage.setdefault(record["stage"], []).append(record)
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        summary = []
+        for stage in sorted(by_stage, key=lambda s: (order.get(s, len(order)), s)):
+            records = by_stage[stage]
+            seconds = [r["seconds"] for r in records]
+            counts = [r["count"] for r in records if r["count"] is not None]
+            summary.append({
+                "stage": stage,
+                "storages": len(records),
+                "calls": sum(r["calls"] for r in records),
+                "total": sum(seconds),
+                "p50": percentile(seconds, 50),
+                "p95": percentile(seconds, 95),
+                "max": max(seconds),
+                "records": sum(counts) if counts else None,
+            })
+        return summary
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.export()}, f, indent=2)
+
+    def write_csv(self, path):
+        summary = self.summary()
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage", "storages", "calls", "total", "p50", "p95", "max", "records"])
+            writer.writeheader()
+            writer.writerows(summary)
+
+    def print_summary(self):
+        print(f"{'Stage':<16}{'Storages':>10}{'Total (s)':>12}{'p50 (s)':>10}{'p95 (s)':>10}{'Max (s)':>10}{'Records':>10}")
+        for row in self.summary():
+            records = "" if row["records"] is None else row["records"]
+            print(f"{row['stage']:<16}{row['storages']:>10}{row['total']:>12.2f}{row['p50']:>10.3f}{row['p95']:>10.3f}"
+                  f"{row['max']:>10.3f}{records:>10}")
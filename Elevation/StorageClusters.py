@@ -0,0 +1,99 @@
+# StorageClusters.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Planner grouping storages whose analysis buffers overlap, so that ContourAnalysis.py extracts
+# contours (or reads the DEM window for the crest solver) once per cluster envelope instead of once per storage.
+
+import math
+from collections import defaultdict
+
+
+def buffer_extent(x, y, buffer_distance):
+    # Square extent of the analysis buffer around a storage centroid
+    return (x - buffer_distance, y - buffer_distance, x + buffer_distance, y + buffer_distance)
+
+
+def union_extent(extents):
+    return (min(e[0] for e in extents), min(e[1] for e in extents), max(e[2] for e in extents), max(e[3] for e in extents))
+
+
+def extent_area(extent):
+    return (extent[2] - extent[0]) * (extent[3] - extent[1])
+
+
+def cluster_storages(storages, buffer_distance, max_span=None):
+    """
+    Group storages whose buffers overlap.
+    storages is a list of (oid, x, y) centroids. A grid index with cells of twice the buffer distance
+    finds the overlapping pairs, which are joined closest first (union-find). max_span caps the width
+    and height of a cluster envelope (default two buffer widths) so chains of storages do not grow into
+    one statewide window and the shared DEM window stays within memory.
+    Returns a list of clusters, each a dict with the cluster id, the member oids and the envelope.
+    """
+    if max_span is None:
+        max_span = 4 * buffer_distance
+    cell = 2 * buffer_distance
+    grid = defaultdict(list)
+    for index, (oid, x, y) in enumerate(storages):
+        grid[(math.floor(x / cell), math.floor(y / cell))].append(index)
+    # Overlapping pairs from the grid index: only the 3x3 neighbouring cells need checking
+    pairs = []
+    for (cell_x, cell_y), members in grid.items():
+        for d_x in (-1, 0, 1):
+            for d_y in (-1, 0, 1):
+                for j in grid.get((cell_x + d_x, cell_y + d_y), ()):
+                    for i in members:
+                        if i < j:
+                            distance = math.hypot(storages[i][1] - storages[j][1], storages[i][2] - storages[j][2])
+                            if distance < 2 * buffer_distance:
+                                pairs.append((distance, i, j))
+    pairs.sort()
+    parent = list(range(len(storages)))
+    envelopes = [buffer_extent(x, y, buffer_distance) for oid, x, y in storages]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for distance, i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i == root_j:
+            continue
+        merged = union_extent((envelopes[root_i], envelopes[root_j]))
+        if merged[2] - merged[0] > max_span or merged[3] - merged[1] > max_span:
+            continue
+        parent[root_j] = root_i
+        envelopes[root_i] = merged
+    groups = defaultdict(list)
+    for index in range(len(storages)):
+        groups[find(index)].append(index)
+    clusters = []
+    for cluster_id, (root, members) in enumerate(sorted(groups.items(), key=lambda item: min(item[1]))):
+        clusters.append({"cluster": cluster_id, "oids": [storages[i][0] for i in members], "envelope": envelopes[root]})
+    return clusters
+
+
+def area_reduction(storages, clusters, buffer_distance):
+    # DEM area processed per storage versus once per cluster envelope
+    per_storage = len(storages) * (2 * buffer_distance) ** 2
+    per_cluster = sum(extent_area(cluster["envelope"]) for cluster in clusters)
+    return {
+        "storages": len(storages),
+        "clusters": len(clusters),
+        "per_storage_area": per_storage,
+        "per_cluster_area": per_cluster,
+        "reduction": 1 - per_cluster / per_storage if per_storage else 0.0,
+    }
+
+
+def print_plan(storages, clusters, buffer_distance):
+    stats = area_reduction(storages, clusters, buffer_distance)
+    print(f"Clustered {stats['storages']} storages into {stats['clusters']} clusters")
+    print(f"DEM area processed: {stats['per_cluster_area'] / 1e6:.1f} km2 instead of {stats['per_storage_area'] / 1e6:.1f} km2 "
+          f"({stats['reduction']:.1%} reduction)")
+    return stats
@@ -0,0 +1,126 @@
+# TileMosaic.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Concurrent tile clipping for DEM_Extraction_WaterbodyAreas.py, streamed into one tiled, compressed GeoTIFF.
+# Tiles are clipped on a thread pool and each finished window is written straight into the output in block order,
+# so no Tile_{i}.tif files are written and at most max_pending tiles are held in memory.
+# The result gets internal overviews and is laid out as a Cloud-Optimized GeoTIFF for windowed reads.
+# Needs rasterio (pip install rasterio); DemTileCache.py handles the import the same way.
+
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def snap_origin(x, y, transform):
+    # Lower left grid origin snapped down onto the cell grid of a GDAL style geotransform
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    cell_height = -cell_height
+    return (x_origin + math.floor((x - x_origin) / cell_width) * cell_width,
+            y_origin - math.ceil((y_origin - y) / cell_height) * cell_height)
+
+
+def overview_factors(width, height, block_size=512):
+    # Power of two overview levels down to roughly one block
+    factors = []
+    factor = 2
+    while max(width, height) / factor >= block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors or [2]
+
+
+def mosaic_tiles_to_cog(source_path, tiles, output_path, workers=4, block_size=512, nodata=-9999.0, max_pending=None):
+    """
+    Clip tiles of a DEM concurrently and stream them into one Cloud-Optimized GeoTIFF.
+    source_path is a GDAL readable DEM. tiles come from TilePlanner.quadtree_tiles, with extents of whole blocks
+    on the DEM cell grid (min_size of block_size cells from snap_origin) and a "shapes" list of GeoJSON-like
+    polygons masking each tile; cells outside the shapes are set to nodata. Windows are written in row-major block order through a
+    reorder buffer of max_pending tiles (default twice the workers). Empty tiles are never written (sparse).
+    Returns the output path.
+    """
+    try:
+        import rasterio
+        from rasterio.enums import Resampling
+        from rasterio.features import geometry_mask
+        from rasterio.shutil import copy as copy_dataset
+        from rasterio.transform import from_origin
+        from rasterio.windows import Window
+    except ImportError:
+        raise ImportError("rasterio is required to write the Cloud-Optimized GeoTIFF: pip install rasterio")
+    if not tiles:
+        raise ValueError("No tiles to mosaic")
+    max_pending = max_pending or 2 * workers
+    with rasterio.open(source_path) as source:
+        source_transform = source.transform
+        source_nodata = source.nodata
+        crs = source.crs
+    cell_width, cell_height = source_transform.a, -source_transform.e
+    left = min(t["extent"][0] for t in tiles)
+    top = max(t["extent"][3] for t in tiles)
+    width = int(round((max(t["extent"][2] for t in tiles) - left) / cell_width))
+    height = int(round((top - min(t["extent"][1] for t in tiles)) / cell_height))
+    transform = from_origin(left, top, cell_width, cell_height)
+
+    def tile_window(extent, origin_x, origin_y):
+        xmin, ymin, xmax, ymax = extent
+        return Window(int(round((xmin - origin_x) / cell_width)), int(round((origin_y - ymax) / cell_height)),
+                      int(round((xmax - xmin) / cell_width)), int(round((ymax - ymin) / cell_height)))
+
+    # Each thread reads through its own dataset handle, closed once the pool is done
+    local = threading.local()
+    handles = []
+    handles_lock = threading.Lock()
+
+    def clip(tile):
+        if not hasattr(local, "source"):
+            local.source = rasterio.open(source_path)
+            with handles_lock:
+                handles.append(local.source)
+        window = tile_window(tile["extent"], source_transform.c, source_transform.f)
+        data = local.source.read(1, window=window, boundless=True, fill_value=source_nodata if source_nodata is not None else nodata)
+        data = data.astype("float32")
+        if source_nodata is not None:
+            # A NaN nodata never compares equal to itself
+            data[np.isnan(data) if np.isnan(source_nodata) else data == source_nodata] = nodata
+        tile_transform = from_origin(tile["extent"][0], tile["extent"][3], cell_width, cell_height)
+        inside = geometry_mask(tile["shapes"], data.shape, tile_transform, invert=True)
+        data[~inside] = nodata
+        return data, tile_window(tile["extent"], left, top)
+
+    # Row-major block order: top tile row first
+    ordered = sorted(tiles, key=lambda t: (-t["extent"][3], t["extent"][0]))
+    staging_path = output_path + ".staging.tif"
+    profile = {"driver": "GTiff", "width": width, "height": height, "count": 1, "dtype": "float32", "crs": crs,
+               "transform": transform, "nodata": nodata, "tiled": True, "blockxsize": block_size, "blockysize": block_size,
+               "compress": "deflate", "predictor": 3, "bigtiff": "IF_SAFER", "sparse_ok": True}
+    try:
+        with rasterio.open(staging_path, "w", **profile) as output, ThreadPoolExecutor(workers) as pool:
+            pending = {}
+            submitted = 0
+            for index, tile in enumerate(ordered):
+                # Keep at most max_pending clipped tiles in flight ahead of the write position
+                while submitted < len(ordered) and submitted < index + max_pending:
+                    pending[submitted] = pool.submit(clip, ordered[submitted])
+                    submitted += 1
+                data, window = pending.pop(index).result()
+                output.write(data, 1, window=window)
+                print(f"Written tile {index + 1}/{len(ordered)}")
+        # Internal overviews, then copy with the overviews ahead of the full resolution blocks (COG layout)
+        with rasterio.open(staging_path, "r+") as output:
+            output.build_overviews(overview_factors(width, height, block_size), Resampling.average)
+            output.update_tags(ns="rio_overview", resampling="average")
+        copy_dataset(staging_path, output_path, driver="GTiff", tiled=True, blockxsize=block_size, blockysize=block_size,
+                     compress="deflate", predictor=3, bigtiff="IF_SAFER", copy_src_overviews=True)
+    finally:
+        for handle in handles:
+            handle.close()
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+    return output_path
@@ -0,0 +1,86 @@
+# TilePlanner.py
+
+# Remote Sensing Team
+
+# Department of Regional Development, Manufacturing and Water
+
+# Intersection-aware tile planner for DEM_Extraction_WaterbodyAreas.py.
+# The storages are buffered once, so only the tiles that actually intersect a buffered storage are clipped,
+# each to its own window. quadtree_tiles gives adaptive tiles balanced by storage count and DEM cells,
+# shared by DEM_Extraction_WaterbodyAreas.py (tiles to clip) and ContourAnalysis.py (parallel work units).
+
+def quadtree_tiles(storages, extent, max_storages=50, max_pixels=None, cell_size=1.0, min_size=None, origin=None,
+                   intersects=None, assign="overlap"):
+    """
+    Adaptive tiles from a quadtree over extent, split until each tile holds at most max_storages storages
+    and max_pixels DEM cells of cell_size, so sparse areas get a few large tiles and dense areas many small ones.
+    storages is a list of (oid, xmin, ymin, xmax, ymax) extents. The root is a square of min_size * 2^k from origin
+    (lower left, default the extent corner), so every tile stays aligned to the min_size grid; tiles are not split
+    below min_size (default one cell).
+    assign="overlap" puts a storage in every tile its extent overlaps and counts the tile's own cells, for clipping
+    the tiles (DEM_Extraction_WaterbodyAreas.py); intersects(tile_extent, oid) refines the leaves with the exact geometry.
+    assign="centre" puts each storage in the one tile holding its centre and counts the cells of the envelope of
+    its members' extents, for work units that read that envelope (ContourAnalysis.py).
+    Returns a list of tiles, each a dict with the tile id, its depth, extent, the oids it holds and their envelope.
+    """
+    xmin, ymin, xmax, ymax = extent
+    min_size = min_size or cell_size
+    x0, y0 = origin if origin is not None else (xmin, ymin)
+    size = min_size
+    while x0 + size < xmax or y0 + size < ymax:
+        size *= 2
+    tiles = []
+
+    def members(tile_extent, candidates):
+        if assign == "centre":
+            return [s for s in candidates if tile_extent[0] <= (s[1] + s[3]) / 2 < tile_extent[2]
+                    and tile_extent[1] <= (s[2] + s[4]) / 2 < tile_extent[3]]
+        return [s for s in candidates if s[1] <= tile_extent[2] and s[3] >= tile_extent[0]
+                and s[2] <= tile_extent[3] and s[4] >= tile_extent[1]]
+
+    def pixels(tile_extent, held):
+        if assign == "centre":
+            tile_extent = envelope(held)
+        return (tile_extent[2] - tile_extent[0]) * (tile_extent[3] - tile_extent[1]) / cell_size ** 2
+
+    def envelope(held):
+        return (min(s[1] for s in held), min(s[2] for s in held), max(s[3] for s in held), max(s[4] for s in held))
+
+    # Depth-first, lower left quadrant first, so neighbouring tiles get neighbouring ids
+    stack = [(x0, y0, size, 0, storages)]
+    while stack:
+        tile_x, tile_y, tile_size, depth, candidates = stack.pop()
+        tile_extent = (tile_x, tile_y, tile_x + tile_size, tile_y + tile_size)
+        held = members(tile_extent, candidates)
+        if not held:
+            continue
+        too_big = len(held) > max_storages or (max_pixels is not None and pixels(tile_extent, held) > max_pixels)
+        if too_big and tile_size / 2 >= min_size:
+            half = tile_size / 2
+            for d_x, d_y in ((half, half), (0, half), (half, 0), (0, 0)):
+                stack.append((tile_x + d_x, tile_y + d_y, half, depth + 1, held))
+            continue
+        oids = [s[0] for s in held]
+        if intersects is not None and assign == "overlap":
+            oids = [oid for oid in oids if intersects(tile_extent, oid)]
+            held = [s for s in held if s[0] in oids]
+        if oids:
+            tiles.append({"tile": len(tiles), "depth": depth, "extent": tile_extent, "oids": oids, "envelope": envelope(held)})
+    return tiles
+
+
+def print_quadtree(tiles, cell_size=1.0):
+    # Spread of the adaptive tiles: how many, their sizes and the storages and cells per tile
+    if not tiles:
+        print("No tiles to process")
+        return {}
+    sizes = [tile["extent"][2] - tile["extent"][0] for tile in tiles]
+    counts = [len(tile["oids"]) for tile in tiles]
+    cells = [(tile["envelope"][2] - tile["envelope"][0]) * (tile["envelope"][3] - tile["envelope"][1]) / cell_size ** 2
+             for tile in tiles]
+    stats = {"tiles": len(tiles), "min_size": min(sizes), "max_size": max(sizes), "max_storages": max(counts),
+             "mean_storages": sum(counts) / len(tiles), "max_cells": max(cells)}
+    print(f"Adaptive tiles: {stats['tiles']}, {stats['min_size']:.0f} m to {stats['max_size']:.0f} m wide, "
+          f"{stats['mean_storages']:.1f} storages per tile (max {stats['max_storages']}), "
+          f"largest storage envelope {stats['max_cells'] / 1e6:.1f} M cells")
+    return stats
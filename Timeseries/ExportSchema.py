@@ -0,0 +1,31 @@
+# ExportSchema.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Columns and date formats of the statistics CSVs exported by the Timeseries scripts, shared by the modules that
+read them (WatermarkManifest.py, MergeUpdates.py, StatisticsStore.py).
+"""
+
+from datetime import datetime
+
+# Columns added by Earth Engine table exports
+DROP_COLUMNS = ("system:index", ".geo")
+# Date formats of the exports: YYYY-MM-dd (Landsat, AWEI) and dd-MM-YYYY (Sentinel2 FINAL)
+DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y")
+
+
+def parse_date(value):
+    # Date of an export date string in either format, or None when it is in neither
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def iso_date(value):
+    # Sortable YYYY-MM-DD form of an export date, whichever format it is in
+    parsed = parse_date(value)
+    return parsed.isoformat() if parsed is not None else value
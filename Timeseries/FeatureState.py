@@ -0,0 +1,128 @@
+# FeatureState.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Per-waterbody state for incremental Timeseries updates: the last processed date and a geometry hash of every pfi,
+kept as <table>.features.json next to the master table (in a WatermarkManifest store).
+plan_backfill compares the state with the current Waterbodies_qld_constructed features and returns only the
+missing (features, date range) work: new features get their full history, features whose geometry changed are
+recomputed from the start, and unchanged features are extended from their own last date. Rows recomputed for an
+edited feature replace its old rows when the update is merged into the master (latest file wins per pfi and date).
+"""
+
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+SCHEMA_VERSION = 1
+
+
+def state_name(table):
+    return table + ".features.json"
+
+
+def feature_key(pfi):
+    # State keys are strings: the JSON round trip of the state file turns numeric pfis into strings
+    return str(pfi)
+
+
+def geometry_hash(signature, digits=3):
+    # Stable hash of a geometry signature (coordinates, or area/perimeter/centroid values), rounded to digits
+    def rounded(value):
+        if isinstance(value, float):
+            return round(value, digits)
+        if isinstance(value, (list, tuple)):
+            return [rounded(item) for item in value]
+        return value
+    return hashlib.sha1(json.dumps(rounded(signature)).encode("utf-8")).hexdigest()
+
+
+def load_state(store, table):
+    # pfi -> {"last_date", "geometry_hash"}, or None when there is no state yet
+    data = store.read_bytes(state_name(table))
+    if data is None:
+        return None
+    state = json.loads(data.decode("utf-8"))
+    if state.get("schema_version") != SCHEMA_VERSION:
+        return None
+    return state["features"]
+
+
+def save_state(store, table, features):
+    state = {"schema_version": SCHEMA_VERSION, "updated": datetime.now().isoformat(timespec="seconds"), "features": features}
+    store.write_bytes(state_name(table), json.dumps(state, separators=(",", ":")).encode("utf-8"), "application/json")
+
+
+def master_pfis(store, table, id_column="pfi"):
+    # pfis with rows in the master table, from one streamed scan of a local copy; empty when there is no table
+    work_folder = tempfile.mkdtemp(prefix="master_pfis_")
+    try:
+        path = os.path.join(work_folder, os.path.basename(table))
+        if not store.download(table, path):
+            return set()
+        with open(path, newline="") as table_file:
+            return {row[id_column] for row in csv.DictReader(table_file) if row.get(id_column)}
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def bootstrap_state(hashes, last_date, pfis):
+    """
+    State of a master table built before the per-feature state: the current features with rows in the master
+    (pfis, from master_pfis) are processed up to its watermark. Features missing from the master get no entry,
+    so plan_backfill treats them as new and computes their full history.
+    """
+    return {feature_key(pfi): {"last_date": last_date, "geometry_hash": current_hash} for pfi, current_hash in hashes.items()
+            if feature_key(pfi) in pfis}
+
+
+def next_day(day):
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def plan_backfill(state, hashes, history_start, end_date):
+    """
+    Work needed to bring every feature up to end_date.
+    state is the stored pfi -> {"last_date", "geometry_hash"}; hashes maps the current features' pfi to their geometry hash.
+    Returns a list of work units {"start_date", "reason", "pfis"}, one per distinct start date and reason, so unchanged
+    features that share a watermark run as one group. pfis are compared and returned as strings (feature_key).
+    """
+    groups = defaultdict(list)
+    for pfi, current_hash in hashes.items():
+        pfi = feature_key(pfi)
+        entry = state.get(pfi)
+        if entry is None:
+            groups[(history_start, "new")].append(pfi)
+        elif entry["geometry_hash"] != current_hash:
+            groups[(history_start, "edited")].append(pfi)
+        else:
+            start = next_day(entry["last_date"])
+            if start < end_date:
+                groups[(start, "extend")].append(pfi)
+    return [{"start_date": start, "reason": reason, "pfis": sorted(pfis)} for (start, reason), pfis in sorted(groups.items())]
+
+
+def print_backfill(work, removed=0):
+    counts = defaultdict(int)
+    for unit in work:
+        counts[unit["reason"]] += len(unit["pfis"])
+    print(f"Features to process: {counts['new']} new (full history), {counts['edited']} edited (recomputed), "
+          f"{counts['extend']} extended, in {len(work)} work units")
+    if removed:
+        print(f"{removed} features no longer in the waterbodies layer")
+
+
+def mark_processed(state, work, hashes, end_date):
+    # Record every feature of the work units as processed up to the day before end_date, with its current geometry hash
+    last_date = (datetime.strptime(end_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    hashes = {feature_key(pfi): current_hash for pfi, current_hash in hashes.items()}
+    for unit in work:
+        for pfi in unit["pfis"]:
+            state[feature_key(pfi)] = {"last_date": last_date, "geometry_hash": hashes[feature_key(pfi)]}
+    return state
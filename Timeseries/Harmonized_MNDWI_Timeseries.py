@@ -0,0 +1,132 @@
+# Harmonized MNDWI Timeseries
+# Remote Sensing Team
+# 18/10/2026
+# Landsat 5/7/8/9 and Sentinel-2 in one run, written to one table with a sensor column
+
+### 1. Import modules
+print("Starting Harmonized MNDWI Timeseries Update")
+print("1. Import modules")
+
+import ee
+from datetime import datetime, timedelta, date
+from google.cloud import storage
+from google.oauth2 import service_account
+import sys
+from SensorRegistry import select_sensors, sensor_stats
+from TaskMonitor import monitor_export
+from WatermarkManifest import BucketStore, last_capture_date
+
+### 2. Initialize GEE with the service account credentials
+print("2. Initialising GEE")
+
+try:
+    SERVICE_ACCOUNT_JSON = r'K:\Projects\GEE\Service Key\remote-sensing-420704-a195c59596e7.json'
+    credentials = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_JSON, 
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    ee.Initialize(credentials)
+except:
+    print("Initialisation failed")
+    sys.exit()
+
+### 3. Declare variables
+print("3. Declaring variables")
+
+features = 'projects/remote-sensing-420704/assets/Waterbodies_qld_constructed'
+BUCKET = 'sentinel2_timeseries'
+uniqueid_field = 'pfi'
+# Sensors of the run; MNDWI thresholds are per sensor in SensorRegistry.py
+sensors = select_sensors(['landsat', 'sentinel2'])
+albers_projection = ee.Projection('EPSG:3577')
+output_filename = 'harmonized_daily_mndwi_statistics.csv'
+
+### 4. Define functions
+print("4. Defining functions")
+
+def time_series(feature):
+    # Geometry and ids prepared once per waterbody, shared by every sensor
+    geeFeatureGeometry = ee.Geometry(feature.geometry())
+    properties = {uniqueid_field: feature.get(uniqueid_field), 'ufi': feature.get('ufi')}
+    # Band mapping and cloud masking per sensor (SensorRegistry.py), one harmonized row per scene
+    return sensor_stats(geeFeatureGeometry, properties, sensors, start_date, end_date, albers_projection)
+
+def export_daily_stats(stats_feature_collection, description, bucket_name):
+    export_task = ee.batch.Export.table.toCloudStorage(
+        collection=ee.FeatureCollection(stats_feature_collection),
+        description=description,
+        bucket=bucket_name,
+        fileNamePrefix=description,
+        fileFormat='CSV'
+    )
+    export_task.start()
+    print(f"    Export task {export_task.id} started")
+    return export_task
+
+### 5. Find last capture date
+print("5. Finding last capture date")
+
+try:
+    
+    # Initialize storage client
+    storage_client = storage.Client.from_service_account_json(SERVICE_ACCOUNT_JSON)
+    store = BucketStore(storage_client.get_bucket(BUCKET))
+    # Last date from the master CSV's sidecar manifest, without downloading the CSV
+    last_date = last_capture_date(store, output_filename)
+
+    # Check if master CSV exists and read its last capture date
+    if last_date is not None:
+        start_date = (datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        end_date = date.today().strftime('%Y-%m-%d')
+        description = f'harmonized_daily_mndwi_update_{datetime.now().strftime("%Y%m%d")}'
+        print("   " + start_date)
+    else:
+        print("    Master CSV file not found. Creating new file.")
+        # Analysis period
+        start_date = "1900-01-01"
+        end_date = date.today().strftime('%Y-%m-%d')
+        description = "harmonized_daily_mndwi_statistics"
+
+except:
+    print("Error: Storage bucket not found")
+    sys.exit()
+
+### 6. Run timeseries of waterbodies
+print("6. Create waterbody feature collection")
+
+try:
+    # Generate and export statistics
+    fc_server = ee.FeatureCollection(features)
+except:
+    print("Error: Waterbody features not found")
+    sys.exit()
+
+### 7. For each waterbody, calculate daily statistics
+print("7. Calculating daily statistics")
+
+try:
+    stats_collections = fc_server.map(time_series)
+    flattened_stats = ee.FeatureCollection(stats_collections.flatten())
+except:
+    print("Error: Calculating statistics failed")
+    sys.exit()
+
+### 8. Export data to cloud bucket
+print("8. Exporting data to cloud bucket")
+
+try:
+    # Start the export process
+    export_task = export_daily_stats(flattened_stats, description, BUCKET)
+except:
+    print("Error: Exporting statistics to cloud bucket failed")
+    sys.exit()
+
+### 9. Wait for the export and merge it into the master CSV
+print("9. Monitoring export task")
+
+try:
+    # Polls the task with backoff and merges the update as soon as it completes, then rewrites the manifest
+    monitor_export(export_task.id, store, description + '.csv', output_filename)
+except:
+    print("Error: Merging the export into the master CSV failed")
+    sys.exit()
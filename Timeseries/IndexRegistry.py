@@ -0,0 +1,148 @@
+# IndexRegistry.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Registry of the Sentinel-2 water and vegetation indices used across the Timeseries scripts and notebooks, so one
+run computes any set of them from a single read of each scene instead of one script (and one pass over the
+collection) per index. A run asks for indices and thresholds, e.g. {"mndwi": 0.1, "awei": 0}; the bands of every
+requested index are selected and the 20 m bands resampled to 10 m once per scene, then all index areas are summed
+in one reduceRegion and emitted as <index>_area / <index>_percent columns of one row per (pfi, date).
+
+    mndwi  (B3 - B11) / (B3 + B11)                       Sentinel2_MNDWI_Timeseries.py
+    awei   B3 + 2.5 * B4 - 1.5 * (B8 + B11) - 0.25 * B12  Sentinel2_AWEI_Timeseries.py
+    ndwi   (B3 - B8) / (B3 + B8)                         ndwi_func of the notebooks
+    ndvi   (B8 - B4) / (B8 + B4)                         ndvi_func of the notebooks
+    ndmi   (B8 - B11) / (B8 + B11)                       Sentinel2_NDMI_local.ipynb
+
+Each index is also evaluated on NumPy band arrays (LocalStatsEngine.py), which the check below uses to confirm
+the single pass gives the same water areas as the per-index formulas.
+"""
+
+import numpy as np
+
+from LocalStatsEngine import normalized_difference, qa_bits, water_and_cloud
+
+# formula "nd" is normalizedDifference of the two bands, otherwise an Earth Engine expression over the band names
+# with "numpy", the same formula as a function of the band arrays (in the order of bands)
+INDICES = {
+    "mndwi": {"bands": ("B3", "B11"), "formula": "nd", "threshold": 0.1},
+    # As Sentinel2_AWEI_Timeseries.py, whose expression maps B2 <- B3 (green) and B3 <- B4 (red)
+    "awei": {"bands": ("B3", "B4", "B8", "B11", "B12"), "formula": "B3 + 2.5 * B4 - 1.5 * (B8 + B11) - 0.25 * B12",
+             "numpy": lambda B3, B4, B8, B11, B12: B3 + 2.5 * B4 - 1.5 * (B8 + B11) - 0.25 * B12, "threshold": 0},
+    "ndwi": {"bands": ("B3", "B8"), "formula": "nd", "threshold": 0},
+    "ndvi": {"bands": ("B8", "B4"), "formula": "nd", "threshold": 0.5},
+    "ndmi": {"bands": ("B8", "B11"), "formula": "nd", "threshold": 0},
+}
+# 20 m bands resampled to 10 m (bicubic) before the indices are computed
+RESAMPLED_BANDS = ("B11", "B12")
+CLOUD_BAND = "QA60"
+
+
+def select_indices(requested):
+    """
+    Thresholds of the requested indices, keyed by index name in registry order.
+    requested is a list of names (registry thresholds) or a dict of name to threshold (None for the registry's).
+    """
+    if not isinstance(requested, dict):
+        requested = {name: None for name in requested}
+    unknown = [name for name in requested if name not in INDICES]
+    if unknown:
+        raise ValueError(f"Unknown index {', '.join(unknown)}, expected one of {', '.join(INDICES)}")
+    return {name: INDICES[name]["threshold"] if requested[name] is None else requested[name]
+            for name in INDICES if name in requested}
+
+
+def required_bands(indices):
+    # Bands read from each scene for the requested indices, in first use order, plus the cloud band
+    bands = []
+    for name in indices:
+        bands += [band for band in INDICES[name]["bands"] if band not in bands]
+    return bands + [CLOUD_BAND]
+
+
+def resample_bands(image, indices, projection):
+    # Select the bands of all requested indices and resample the 20 m ones to 10 m, once per scene
+    image = image.select(required_bands(indices))
+    resampled = [image.select(band).resample('bicubic').reproject(crs=projection, scale=10)
+                 for band in RESAMPLED_BANDS if band in required_bands(indices)]
+    return image.addBands(resampled, overwrite=True) if resampled else image
+
+
+def index_image(image, name):
+    # One index on the Earth Engine image, renamed to the upper case index name
+    spec = INDICES[name]
+    if spec["formula"] == "nd":
+        index = image.normalizedDifference(list(spec["bands"]))
+    else:
+        index = image.expression(spec["formula"], {band: image.select(band) for band in spec["bands"]})
+    return index.rename(name.upper())
+
+
+def scene_stats(image, geometry, indices, properties, projection, scale=10):
+    """
+    Statistics of every requested index for one resampled scene over one waterbody, from a single reduceRegion.
+    properties (e.g. the pfi) are copied onto the row. Returns an ee.Feature with date, <index>_area and
+    <index>_percent for each index, and cloud_area, total_area and cloud_percent.
+    """
+    import ee
+    pixel_area = ee.Image.pixelArea()
+    areas = [index_image(image, name).gte(threshold).multiply(pixel_area).reproject(crs=projection, scale=scale)
+             .rename(f"{name.upper()}_Area") for name, threshold in indices.items()]
+    qa = image.select(CLOUD_BAND)
+    cloud_area = qa.bitwiseAnd(1 << 10).Or(qa.bitwiseAnd(1 << 11)).eq(1).multiply(pixel_area).rename('Cloud_Area')
+    statistics = ee.Image.cat(areas + [cloud_area, pixel_area.rename('Total_Area')]).reduceRegion(
+        reducer=ee.Reducer.sum(),
+        geometry=geometry,
+        scale=scale,
+        crs=projection
+    )
+    total_area = ee.Number(statistics.get('Total_Area'))
+    stats_dict = dict(properties, date=image.date().format('YYYY-MM-dd'))
+    for name in indices:
+        area = statistics.get(f"{name.upper()}_Area")
+        stats_dict[f"{name}_area"] = area
+        stats_dict[f"{name}_percent"] = ee.Number(area).divide(total_area).multiply(100)
+    stats_dict['cloud_area'] = statistics.get('Cloud_Area')
+    stats_dict['total_area'] = total_area
+    stats_dict['cloud_percent'] = ee.Number(statistics.get('Cloud_Area')).divide(total_area).multiply(100)
+    return ee.Feature(None, stats_dict)
+
+
+def index_arrays(bands, indices):
+    """
+    NumPy counterpart of scene_stats' masks: the water (index >= threshold) mask of every requested index and
+    the cloud mask, from band arrays with B11/B12 already resampled to 10 m.
+    """
+    masks = {}
+    for name, threshold in indices.items():
+        spec = INDICES[name]
+        if spec["formula"] == "nd":
+            index = normalized_difference(*[bands[band] for band in spec["bands"]])
+        else:
+            index = spec["numpy"](*[np.asarray(bands[band], dtype=np.float64) for band in spec["bands"]])
+        # NaN (masked) index values compare False, so masked pixels add no area
+        masks[name] = index >= threshold
+    masks["cloud"] = qa_bits(bands[CLOUD_BAND], (10, 11))
+    return masks
+
+
+def registry_check(seed=7):
+    # One pass over random scenes against the per-product masks of LocalStatsEngine
+    rng = np.random.default_rng(seed)
+    bands = {band: rng.integers(0, 4000, size=(3, 16, 16)) for band in required_bands(INDICES)}
+    bands[CLOUD_BAND] = rng.choice([0, 1 << 10, 1 << 11], size=(3, 16, 16))
+    masks = index_arrays(bands, select_indices({"mndwi": None, "awei": None, "ndvi": None}))
+    # Every expression index needs its NumPy counterpart
+    ok = all("numpy" in spec for spec in INDICES.values() if spec["formula"] != "nd")
+    for name, product in (("mndwi", "s2_mndwi"), ("awei", "s2_awei")):
+        water, cloud = water_and_cloud(bands, product)
+        ok &= np.array_equal(masks[name], water) and np.array_equal(masks["cloud"], cloud)
+    ndvi = (bands["B8"] - bands["B4"]) / (bands["B8"] + bands["B4"])
+    ok &= np.array_equal(masks["ndvi"], ndvi >= 0.5)
+    print(f"Bands read once: {', '.join(required_bands(INDICES))}")
+    return bool(ok)
+
+
+if __name__ == '__main__':
+    print("Index registry check passed" if registry_check() else "Index registry check failed")
@@ -8,13 +8,13 @@ print("Starting Landsat MNDWI Timeseries Update")
 print("1. Import modules")
 
 import ee
-import pandas as pd
 from datetime import datetime, timedelta, date
 from google.cloud import storage
 from google.oauth2 import service_account
-from io import BytesIO
 import time
 import sys
+from TaskMonitor import monitor_export
+from WatermarkManifest import BucketStore, last_capture_date
 
 ### 2. Initialize GEE with the service account credentials
 print("2. Initialising GEE")
@@ -130,7 +130,8 @@ def export_daily_stats(stats_feature_collection, description, bucket_name):
         fileFormat='CSV'
     )
     export_task.start()
-    print("Finished - Check Google Earth Engine for task status")
+    print(f"    Export task {export_task.id} started")
+    return export_task
 
 ### 5. Find last capture date
 print("5. Finding last capture date")
@@ -139,14 +140,13 @@ try:
     
     # Initialize storage client
     storage_client = storage.Client.from_service_account_json(SERVICE_ACCOUNT_JSON)
-    bucket = storage_client.get_bucket(BUCKET)
-    blob = bucket.get_blob(output_filename)
-
-    # Check if master CSV exists and extract last capture date
-    if blob is not None:
-        # Download the contents of the blob as a string and convert it to a DataFrame    
-        old_df = pd.read_csv(BytesIO(blob.download_as_string()), parse_dates=['date'])
-        start_date = (old_df['date'].max() + timedelta(days=1)).strftime('%Y-%m-%d')
+    store = BucketStore(storage_client.get_bucket(BUCKET))
+    # Last date from the master CSV's sidecar manifest, without downloading the CSV
+    last_date = last_capture_date(store, output_filename)
+
+    # Check if master CSV exists and read its last capture date
+    if last_date is not None:
+        start_date = (datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
         end_date = date.today().strftime('%Y-%m-%d')
         description = f'landsat_update_{datetime.now().strftime("%Y%m%d")}'
         print("   " + start_date)
@@ -186,7 +186,17 @@ print("8. Exporting data to cloud bucket")
 
 try:
     # Start the export process
-    export_daily_stats(flattened_stats, description, BUCKET)
+    export_task = export_daily_stats(flattened_stats, description, BUCKET)
 except:
     print("Error: Exporting statistics to cloud bucket failed")
     sys.exit()
+
+### 9. Wait for the export and merge it into the master CSV
+print("9. Monitoring export task")
+
+try:
+    # Polls the task with backoff and merges the update as soon as it completes, then rewrites the manifest
+    monitor_export(export_task.id, store, description + '.csv', output_filename)
+except:
+    print("Error: Merging the export into the master CSV failed")
+    sys.exit()
@@ -0,0 +1,339 @@
+# LocalStatsEngine.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Local NumPy engine reproducing the calculate_stats outputs of the Timeseries scripts on our own hardware.
+Takes band arrays of one or many scenes on a common grid (e.g. EPSG:3577 at the script's SCALE) and waterbody
+polygons, and returns the same area and percent columns as the Earth Engine reduceRegion sums:
+
+    s2_mndwi_final  Sentinel2_MNDWI_Timeseries_FINAL.py  B3, B11, probability (s2cloudless)
+    s2_mndwi        Sentinel2_MNDWI_Timeseries.py        B3, B11, QA60
+    s2_awei         Sentinel2_AWEI_Timeseries.py         B3, B4, B8, B11, B12, QA60
+    landsat_mndwi   Landsat_MNDWI_Timeseries.py          SR_B2, SR_B3, SR_B5, SR_B6, QA_PIXEL
+
+B11/B12 must already be resampled to 10 m (bicubic), as resample_to_10m does on the server.
+label_image and zonal_waterbody_stats give the same columns for every waterbody of a tile in one bincount pass
+per scene, so the cost per scene no longer grows with the number of waterbodies.
+Run this file to check the engine against golden outputs of the current formulas.
+"""
+
+import numpy as np
+
+# Thresholds of the Timeseries scripts
+CLD_PRB_THRESH = 50
+PRODUCTS = {
+    "s2_mndwi_final": {"index": "mndwi", "threshold": 0, "percent": False},
+    "s2_mndwi": {"index": "mndwi", "threshold": 0.1, "percent": True},
+    "s2_awei": {"index": "awei", "threshold": 0, "percent": True},
+    "landsat_mndwi": {"index": "mndwi", "threshold": 0.1, "percent": True},
+}
+
+
+def normalized_difference(first, second):
+    # ee.Image.normalizedDifference: (first - second) / (first + second), masked (NaN) where either input is negative
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+    total = first + second
+    with np.errstate(divide="ignore", invalid="ignore"):
+        nd = (first - second) / total
+    nd[(first < 0) | (second < 0) | (total == 0)] = np.nan
+    return nd
+
+
+def qa_bits(qa, bits):
+    # Pixels with any of the QA bits set, as the bitwiseAnd(...).Or(bitwiseAnd(...)) expressions
+    qa = np.asarray(qa).astype(np.int64)
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    return (qa & mask) != 0
+
+
+def water_and_cloud(bands, product):
+    """
+    Per pixel water and cloud masks of a product, vectorized across all scenes and pixels.
+    bands maps band names to arrays of shape (scenes, rows, cols) or (rows, cols).
+    Returns (water, cloud) boolean arrays of the same shape.
+    """
+    threshold = PRODUCTS[product]["threshold"]
+    if product == "s2_mndwi_final":
+        cloud = np.asarray(bands["probability"]) > CLD_PRB_THRESH
+        index = normalized_difference(bands["B3"], bands["B11"])
+        # mndwi.updateMask(cloudmask.Not()): cloudy pixels never count as water
+        water = (index >= threshold) & ~cloud
+    elif product == "s2_mndwi":
+        cloud = qa_bits(bands["QA60"], (10, 11))
+        water = normalized_difference(bands["B3"], bands["B11"]) >= threshold
+    elif product == "s2_awei":
+        cloud = qa_bits(bands["QA60"], (10, 11))
+        # Band mapping as in the script's expression: B2 <- B3 (green), B3 <- B4 (red)
+        awei = (np.asarray(bands["B3"], dtype=np.float64) + 2.5 * np.asarray(bands["B4"], dtype=np.float64)
+                - 1.5 * (np.asarray(bands["B8"], dtype=np.float64) + np.asarray(bands["B11"], dtype=np.float64))
+                - 0.25 * np.asarray(bands["B12"], dtype=np.float64))
+        water = awei >= threshold
+    elif product == "landsat_mndwi":
+        # SR_B6 is only a surface reflectance band on Landsat 8/9
+        if "SR_B6" in bands:
+            cloud = qa_bits(bands["QA_PIXEL"], (7, 3))
+            index = normalized_difference(bands["SR_B3"], bands["SR_B6"])
+        else:
+            cloud = qa_bits(bands["QA_PIXEL"], (5, 3))
+            index = normalized_difference(bands["SR_B2"], bands["SR_B5"])
+        water = index >= threshold
+    else:
+        raise ValueError(f"Unknown product {product}, expected one of {', '.join(PRODUCTS)}")
+    # NaN (masked) index values compare False, so masked pixels add no water area
+    return water, cloud
+
+
+def polygon_weights(rings, transform, shape):
+    """
+    Pixels of a grid whose centre lies inside a polygon (even-odd rule over all rings, so holes are excluded),
+    as reduceRegion selects pixels at the reduction scale. transform is a GDAL-style geotransform.
+    Returns a float array of shape (rows, cols) with 1.0 inside and 0.0 outside.
+    """
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    rows, cols = shape
+    xs = x_origin + (np.arange(cols) + 0.5) * cell_width
+    ys = y_origin + (np.arange(rows) + 0.5) * cell_height
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+    edges = np.vstack(edges)
+    x1, y1, x2, y2 = edges.T
+    weights = np.zeros(shape)
+    for row, y in enumerate(ys):
+        crossing = (y1 > y) != (y2 > y)
+        if not crossing.any():
+            continue
+        x_cross = np.sort(x1[crossing] + (y - y1[crossing]) * (x2[crossing] - x1[crossing]) / (y2[crossing] - y1[crossing]))
+        # Inside where an odd number of crossings lie to the right of the pixel centre
+        right = len(x_cross) - np.searchsorted(x_cross, xs, side="right")
+        weights[row] = right % 2
+    return weights
+
+
+def area_stats(bands, weights, product, cell_area):
+    """
+    Water, cloud and total areas of every scene over one waterbody, in the units of cell_area.
+    weights is the (rows, cols) pixel weight of the waterbody (polygon_weights, or coverage fractions).
+    Returns a dict of arrays with one value per scene, keyed by the script's column names.
+    """
+    water, cloud = water_and_cloud(bands, product)
+    water = water.reshape(-1, weights.size)
+    cloud = cloud.reshape(-1, weights.size)
+    pixel_area = weights.ravel() * cell_area
+    name = PRODUCTS[product]["index"]
+    stats = {
+        f"{name}_area": water.astype(np.float64) @ pixel_area,
+        "cloud_area": cloud.astype(np.float64) @ pixel_area,
+        "total_area": np.full(water.shape[0], pixel_area.sum()),
+    }
+    if PRODUCTS[product]["percent"]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats[f"{name}_percent"] = stats[f"{name}_area"] / stats["total_area"] * 100
+            stats["cloud_percent"] = stats["cloud_area"] / stats["total_area"] * 100
+    return stats
+
+
+def waterbody_window(rings, transform, rows, cols):
+    # Pixel window (row_start, row_stop, col_start, col_stop) of a waterbody's bounding box on the grid, None when outside
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    points = np.vstack([np.asarray(ring, dtype=np.float64) for ring in rings])
+    col_start = max(int(np.floor((points[:, 0].min() - x_origin) / cell_width)), 0)
+    col_stop = min(int(np.ceil((points[:, 0].max() - x_origin) / cell_width)), cols)
+    row_start = max(int(np.floor((points[:, 1].max() - y_origin) / cell_height)), 0)
+    row_stop = min(int(np.ceil((points[:, 1].min() - y_origin) / cell_height)), rows)
+    if col_start >= col_stop or row_start >= row_stop:
+        return None
+    return row_start, row_stop, col_start, col_stop
+
+
+def window_weights(rings, transform, window):
+    # polygon_weights of a waterbody over its pixel window only
+    x_origin, cell_width, _, y_origin, _, cell_height = transform
+    row_start, row_stop, col_start, col_stop = window
+    window_transform = (x_origin + col_start * cell_width, cell_width, 0.0, y_origin + row_start * cell_height, 0.0, cell_height)
+    return polygon_weights(rings, window_transform, (row_stop - row_start, col_stop - col_start))
+
+
+def waterbody_stats(bands, waterbodies, transform, product, dates, uniqueid_field="pfi"):
+    """
+    calculate_stats rows of every scene and waterbody.
+    bands maps band names to (scenes, rows, cols) arrays on the grid of transform; waterbodies maps each
+    waterbody id to its polygon rings in the grid's coordinates; dates gives the date string of each scene.
+    Each waterbody is reduced over the window of its bounding box only.
+    Returns a list of dicts with the date, the id and the area (and percent) columns.
+    """
+    cell_area = abs(transform[1] * transform[5])
+    bands = {name: np.asarray(array).reshape((-1,) + np.shape(array)[-2:]) for name, array in bands.items()}
+    rows, cols = next(iter(bands.values())).shape[-2:]
+    records = []
+    for uniqueid, rings in waterbodies.items():
+        window = waterbody_window(rings, transform, rows, cols)
+        if window is None:
+            continue
+        row_start, row_stop, col_start, col_stop = window
+        weights = window_weights(rings, transform, window)
+        window_bands = {name: array[:, row_start:row_stop, col_start:col_stop] for name, array in bands.items()}
+        stats = area_stats(window_bands, weights, product, cell_area)
+        for scene, date in enumerate(dates):
+            record = {"date": date, uniqueid_field: uniqueid}
+            record.update({column: float(values[scene]) for column, values in stats.items()})
+            records.append(record)
+    return records
+
+
+def label_image(waterbodies, transform, shape):
+    """
+    Rasterize all waterbodies of a tile grid once into label layers, for zonal_waterbody_stats.
+    Pixels get the 1-based position of their waterbody in the returned ids (0 = no waterbody). A waterbody
+    overlapping one already labelled goes to the next layer, so overlaps are counted for both, as with one
+    reduceRegion per feature; most tiles need a single layer. A waterbody on the grid with no pixel centre inside
+    still gets an id (and zero rows), as in waterbody_stats.
+    Returns (labels, ids) with labels of shape (layers, rows, cols).
+    """
+    rows, cols = shape
+    layers = []
+    ids = []
+    for uniqueid, rings in waterbodies.items():
+        window = waterbody_window(rings, transform, rows, cols)
+        if window is None:
+            continue
+        row_start, row_stop, col_start, col_stop = window
+        inside = window_weights(rings, transform, window) > 0
+        ids.append(uniqueid)
+        if not inside.any():
+            continue
+        for layer in layers:
+            if not layer[row_start:row_stop, col_start:col_stop][inside].any():
+                break
+        else:
+            layer = np.zeros(shape, dtype=np.int32)
+            layers.append(layer)
+        layer[row_start:row_stop, col_start:col_stop][inside] = len(ids)
+    labels = np.stack(layers) if layers else np.zeros((1, rows, cols), dtype=np.int32)
+    return labels, ids
+
+
+def zonal_waterbody_stats(bands, labels, ids, transform, product, dates, uniqueid_field="pfi"):
+    """
+    calculate_stats rows of every scene and waterbody from a label image (label_image), in one bincount pass
+    per scene and label layer: each pixel adds its water and cloud flags to its waterbody's total.
+    Gives the same rows (and float values) as waterbody_stats, without a reduction per waterbody.
+    """
+    cell_area = abs(transform[1] * transform[5])
+    water, cloud = water_and_cloud(bands, product)
+    scenes = len(dates)
+    water = water.reshape(scenes, -1)
+    cloud = cloud.reshape(scenes, -1)
+    count = len(ids) + 1
+    water_area = np.zeros((scenes, count))
+    cloud_area = np.zeros((scenes, count))
+    total_area = np.zeros(count)
+    for layer in labels.reshape(len(labels), -1):
+        # Offset the labels per scene, so one bincount covers all scenes of the layer
+        scene_labels = (layer[np.newaxis, :] + count * np.arange(scenes)[:, np.newaxis]).ravel()
+        water_area += np.bincount(scene_labels, weights=water.ravel(), minlength=count * scenes).reshape(scenes, count)
+        cloud_area += np.bincount(scene_labels, weights=cloud.ravel(), minlength=count * scenes).reshape(scenes, count)
+        total_area += np.bincount(layer, minlength=count)
+    name = PRODUCTS[product]["index"]
+    records = []
+    for position, uniqueid in enumerate(ids, start=1):
+        total = float(total_area[position] * cell_area)
+        for scene, date in enumerate(dates):
+            record = {"date": date, uniqueid_field: uniqueid, f"{name}_area": float(water_area[scene, position] * cell_area),
+                      "cloud_area": float(cloud_area[scene, position] * cell_area), "total_area": total}
+            if PRODUCTS[product]["percent"]:
+                # NaN for a waterbody with no pixel, as area_stats gives
+                record[f"{name}_percent"] = record[f"{name}_area"] / total * 100 if total else float("nan")
+                record["cloud_percent"] = record["cloud_area"] / total * 100 if total else float("nan")
+            records.append(record)
+    return records
+
+
+def zonal_check(seed=0):
+    # The label image pass must match the per-waterbody reduction, including overlapping waterbodies
+    rng = np.random.default_rng(seed)
+    transform = (1000.0, 10.0, 0.0, 2000.0, 0.0, -10.0)
+    shape = (60, 80)
+    bands = {"B3": rng.integers(-10, 3000, (4,) + shape), "B11": rng.integers(0, 3000, (4,) + shape),
+             "QA60": rng.choice([0, 1 << 10, 1 << 11], (4,) + shape)}
+    waterbodies = {}
+    for index in range(30):
+        x, y = rng.uniform(1000, 1800), rng.uniform(1400, 2000)
+        size = rng.uniform(15, 120)
+        waterbodies[f"wb{index}"] = [[(x, y), (x + size, y + size / 3), (x + size / 2, y + size)]]
+    # Sub-pixel waterbody with no pixel centre inside: a row of zero areas in both modes
+    waterbodies["wb_small"] = [[(1001.0, 1991.0), (1004.0, 1991.0), (1004.0, 1994.0), (1001.0, 1994.0)]]
+    dates = [f"2024-01-0{scene + 1}" for scene in range(4)]
+    expected = waterbody_stats(bands, waterbodies, transform, "s2_mndwi", dates)
+    labels, ids = label_image(waterbodies, transform, shape)
+    records = zonal_waterbody_stats(bands, labels, ids, transform, "s2_mndwi", dates)
+    expected = {(r["date"], r["pfi"]): r for r in expected}
+    mismatches = 0
+    for record in records:
+        golden = expected.get((record["date"], record["pfi"]))
+        if golden is None or not all(type(record[column]) is float and np.isclose(record[column], golden[column], equal_nan=True)
+                                     for column in golden if column not in ("date", "pfi")):
+            mismatches += 1
+    print(f"Zonal check: {len(records)} rows over {len(labels)} label layers, {mismatches} mismatches")
+    return not mismatches and len(records) == len(expected)
+
+
+def golden_check():
+    # Two scenes of a 3 x 4 grid of 10 m cells and a waterbody covering the left 3 x 3 pixels,
+    # with the areas worked out by hand from the current formulas
+    transform = (0.0, 10.0, 0.0, 30.0, 0.0, -10.0)
+    waterbody = {"wb1": [[(0.0, 0.0), (30.0, 0.0), (30.0, 30.0), (0.0, 30.0)]]}
+    dates = ["2024-01-01", "2024-01-02"]
+    green = np.array([[[900, 900, 100, 900], [900, 100, 100, 900], [-5, 100, 100, 900]],
+                      [[900, 900, 900, 900], [900, 900, 900, 900], [900, 900, 900, 900]]])
+    swir = np.array([[[100, 700, 900, 100], [100, 900, 100, 100], [100, 0, 900, 100]],
+                     [[100, 100, 100, 100], [100, 100, 100, 100], [100, 100, 100, 100]]])
+    qa60 = np.zeros((2, 3, 4), dtype=np.int64)
+    qa60[0, 0, 0] = 1 << 10
+    qa60[1, 2, 2] = 1 << 11
+    qa60[1, 1, 1] = 1 << 9
+    probability = np.zeros((2, 3, 4))
+    probability[0, 0, :] = [80, 50, 51, 90]
+    # Scene 1 MNDWI: 0.8, 0.125, -0.8 / 0.8, -0.8, 0 / masked, 1.0, -0.8; AWEI (B4 = B12 = 0, B8 = B11) is water
+    # at 3 pixels. QA_PIXEL is QA60 shifted down 3 bits, so QA60 bit 10 becomes the Landsat 8 cloud bit 7
+    expected = {
+        "s2_mndwi_final": ({"B3": green, "B11": swir, "probability": probability},
+                           [{"mndwi_area": 400.0, "cloud_area": 200.0, "total_area": 900.0},
+                            {"mndwi_area": 900.0, "cloud_area": 0.0, "total_area": 900.0}]),
+        "s2_mndwi": ({"B3": green, "B11": swir, "QA60": qa60},
+                     [{"mndwi_area": 400.0, "cloud_area": 100.0, "total_area": 900.0,
+                       "mndwi_percent": 400 / 9, "cloud_percent": 100 / 9},
+                      {"mndwi_area": 900.0, "cloud_area": 100.0, "total_area": 900.0,
+                       "mndwi_percent": 100.0, "cloud_percent": 100 / 9}]),
+        "landsat_mndwi": ({"SR_B3": green, "SR_B6": swir, "QA_PIXEL": qa60 >> 3},
+                          [{"mndwi_area": 400.0, "cloud_area": 100.0, "total_area": 900.0,
+                            "mndwi_percent": 400 / 9, "cloud_percent": 100 / 9},
+                           {"mndwi_area": 900.0, "cloud_area": 0.0, "total_area": 900.0,
+                            "mndwi_percent": 100.0, "cloud_percent": 0.0}]),
+        "s2_awei": ({"B3": green, "B4": np.zeros_like(green), "B8": swir, "B11": swir, "B12": np.zeros_like(green),
+                     "QA60": qa60},
+                    [{"awei_area": 300.0,"cloud_area": 100.0, "total_area": 900.0,
+                      "awei_percent": 300 / 9, "cloud_percent": 100 / 9},
+                     {"awei_area": 900.0, "cloud_area": 100.0, "total_area": 900.0,
+                      "awei_percent": 100.0, "cloud_percent": 100 / 9}]),
+    }
+    failures = 0
+    for product, (bands, scenes) in expected.items():
+        records = waterbody_stats(bands, waterbody, transform, product, dates)
+        for record, golden in zip(records, scenes):
+            for column, value in golden.items():
+                if not np.isclose(record[column], value):
+                    failures += 1
+                    print(f"{product} {record['date']} {column}: {record[column]} != {value}")
+    print("Golden check passed" if not failures else f"Golden check failed: {failures} mismatches")
+    return failures == 0
+
+
+if __name__ == '__main__':
+    golden_check()
+    zonal_check()
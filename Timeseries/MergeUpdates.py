@@ -0,0 +1,150 @@
+# MergeUpdates.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Streaming merge of the ..._update_YYYYMMDD exports into the master statistics CSV.
+Every input is sorted in bounded chunks spilled to temporary run files, and the runs are k-way merged in
+(pfi, date, sensor) order, so memory stays at one chunk however large the history grows. Tables without a sensor
+column (the single sensor scripts) merge on (pfi, date) alone.
+Duplicate rows are removed with a fixed tie-break: the row from the newest file wins (update files
+ordered by their name, i.e. their YYYYMMDD suffix, after the master), and within one file the last row wins.
+The output is written to a temporary file and renamed over the master, then the master's sidecar manifest
+(WatermarkManifest.py) is rewritten from the merge, so the next update reads the new watermark without a scan.
+Usage: python MergeUpdates.py sentinel2_daily_mndwi_statistics.csv sentinel2_daily_mndwi_statistics_update_*.csv
+"""
+
+import argparse
+import csv
+import glob
+import heapq
+import os
+import shutil
+import tempfile
+
+from ExportSchema import DROP_COLUMNS, iso_date
+from WatermarkManifest import LocalStore, write_manifest
+
+
+def read_header(path):
+    with open(path, newline="") as table_file:
+        return next(csv.reader(table_file), [])
+
+
+def sorted_runs(path, precedence, columns, temp_folder, chunk_rows, key_columns=("pfi", "date", "sensor")):
+    """
+    Split one CSV into sorted run files of at most chunk_rows rows.
+    Each run row is (pfi, iso date, sensor, precedence, row number, columns...) with the row laid out in the output
+    columns, so runs of every input merge directly. Returns the run paths.
+    """
+    runs = []
+    with open(path, newline="") as table_file:
+        reader = csv.DictReader(table_file)
+        chunk = []
+        for number, row in enumerate(reader):
+            key = (row.get(key_columns[0], ""), iso_date(row.get(key_columns[1], "")), row.get(key_columns[2], ""))
+            chunk.append(key + (precedence, number) + tuple(row.get(column, "") for column in columns))
+            if len(chunk) >= chunk_rows:
+                runs.append(write_run(chunk, temp_folder))
+                chunk = []
+        if chunk:
+            runs.append(write_run(chunk, temp_folder))
+    return runs
+
+
+def write_run(chunk, temp_folder):
+    chunk.sort(key=lambda row: (row[0], row[1], row[2], -row[3], -row[4]))
+    handle, path = tempfile.mkstemp(suffix=".csv", dir=temp_folder)
+    with os.fdopen(handle, "w", newline="") as run_file:
+        csv.writer(run_file).writerows(chunk)
+    return path
+
+
+def read_run(path):
+    # Run rows with the precedence and row number back as integers, for the merge order
+    with open(path, newline="") as run_file:
+        for row in csv.reader(run_file):
+            yield (row[0], row[1], row[2], -int(row[3]), -int(row[4])) + tuple(row[5:])
+
+
+def merge_runs(runs, temp_folder, max_open=64):
+    # Merge runs in passes of at most max_open files until one sorted stream remains
+    while len(runs) > max_open:
+        merged = []
+        for start in range(0, len(runs), max_open):
+            group = runs[start:start + max_open]
+            handle, path = tempfile.mkstemp(suffix=".csv", dir=temp_folder)
+            with os.fdopen(handle, "w", newline="") as run_file:
+                writer = csv.writer(run_file)
+                for row in heapq.merge(*[read_run(run) for run in group]):
+                    writer.writerow((row[0], row[1], row[2], -row[3], -row[4]) + row[5:])
+            for run in group:
+                os.remove(run)
+            merged.append(path)
+        runs = merged
+    return heapq.merge(*[read_run(run) for run in runs])
+
+
+def merge_updates(master_path, update_paths, output_path=None, chunk_rows=500000, temp_folder=None):
+    """
+    Merge the update CSVs into the master CSV in (pfi, date, sensor) order, without duplicate (pfi, date, sensor) rows.
+    The master may not exist yet. Returns a summary dict with the rows read, written and dropped as duplicates.
+    """
+    output_path = output_path or master_path
+    inputs = ([master_path] if os.path.exists(master_path) else []) + sorted(update_paths)
+    # Output columns: the master's, then any new columns of the updates, without the export's own columns
+    columns = []
+    for path in inputs:
+        columns += [column for column in read_header(path) if column not in columns and column not in DROP_COLUMNS]
+    temp_folder = tempfile.mkdtemp(prefix="merge_", dir=temp_folder or os.path.dirname(os.path.abspath(output_path)))
+    summary = {"inputs": len(inputs), "read": 0, "written": 0, "duplicates": 0, "last_date": None}
+    try:
+        runs = []
+        for precedence, path in enumerate(inputs):
+            runs += sorted_runs(path, precedence, columns, temp_folder, chunk_rows)
+        handle, temp_output = tempfile.mkstemp(suffix=".csv", dir=os.path.dirname(os.path.abspath(output_path)))
+        with os.fdopen(handle, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(columns)
+            previous = None
+            for row in merge_runs(runs, temp_folder):
+                summary["read"] += 1
+                # The first row of each (pfi, date, sensor) is the winner of the tie-break
+                if row[:3] == previous:
+                    summary["duplicates"] += 1
+                    continue
+                previous = row[:3]
+                writer.writerow(row[5:])
+                summary["written"] += 1
+                if summary["last_date"] is None or row[1] > summary["last_date"]:
+                    summary["last_date"] = row[1]
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temp_output, output_path)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    # The merge already knows the watermark, so the manifest is written without another scan
+    write_manifest(LocalStore(os.path.dirname(os.path.abspath(output_path))), os.path.basename(output_path),
+                   summary["last_date"], summary["written"], columns)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge update exports into the master statistics CSV")
+    parser.add_argument("master")
+    parser.add_argument("updates", nargs="*", help="Update CSVs (default: <master>_update_*.csv next to the master)")
+    parser.add_argument("--output", help="Write the merge here instead of replacing the master")
+    parser.add_argument("--chunk-rows", type=int, default=500000)
+    parser.add_argument("--remove-updates", action="store_true", help="Delete the update files once merged")
+    args = parser.parse_args()
+    updates = args.updates or glob.glob(os.path.splitext(args.master)[0] + "_update_*.csv")
+    summary = merge_updates(args.master, updates, args.output, args.chunk_rows)
+    print(f"Merged {summary['inputs']} files: {summary['read']} rows read, {summary['written']} written, "
+          f"{summary['duplicates']} duplicate (pfi, date, sensor) rows dropped, last date {summary['last_date']}")
+    if args.remove_updates:
+        for path in updates:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# SensorRegistry.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Band mapping and cloud masking of every sensor used by the Timeseries scripts, so one run can compute the MNDWI
+statistics of Landsat 5/7/8/9 and Sentinel-2 over the same waterbodies and write one harmonized table.
+
+Every scene is mapped to the same bands before the statistics: green and swir1 as surface reflectance (the
+collection's scale and offset applied) and a 0/1 cloud band from the collection's QA bits, as apply_cloud_mask
+(Landsat_MNDWI_Timeseries.py) and the QA60 masks of the Sentinel-2 scripts. harmonized_stats then gives one row
+per (pfi, date, sensor) with the same columns and YYYY-MM-dd dates for every sensor:
+
+    date, pfi, ufi, sensor, platform, mndwi_area, cloud_area, total_area, mndwi_percent, cloud_percent
+
+Landsat rows are reduced at 30 m and Sentinel-2 rows at 10 m (B11 resampled bicubic, as resample_to_10m).
+Granules of one pass (same date and orbit: WRS path, Sentinel-2 relative orbit) are mosaicked before the reduction
+by mosaic_same_day, so a waterbody across a tile boundary gets one complete row per date instead of partial rows.
+"""
+
+import numpy as np
+
+from LocalStatsEngine import normalized_difference, qa_bits
+
+# Collections of each sensor: reflectance = DN * scale + offset, cloud = any of cloud_bits set in the qa band,
+# granules with the same date and orbit property are one pass
+SENSORS = {
+    "landsat": {"scale": 30, "threshold": 0.1, "collections": [
+        # QA bits as apply_cloud_mask: 5 and 3 on L5/L7, 7 and 3 where SR_B6 exists (L8/L9)
+        {"id": "LANDSAT/LT05/C02/T2_L2", "platform": "LANDSAT_5", "green": "SR_B2", "swir1": "SR_B5",
+         "qa": "QA_PIXEL", "cloud_bits": (5, 3), "scale": 0.0000275, "offset": -0.2, "orbit": "WRS_PATH"},
+        {"id": "LANDSAT/LE07/C02/T2_L2", "platform": "LANDSAT_7", "green": "SR_B2", "swir1": "SR_B5",
+         "qa": "QA_PIXEL", "cloud_bits": (5, 3), "scale": 0.0000275, "offset": -0.2, "orbit": "WRS_PATH"},
+        {"id": "LANDSAT/LC08/C02/T2_L2", "platform": "LANDSAT_8", "green": "SR_B3", "swir1": "SR_B6",
+         "qa": "QA_PIXEL", "cloud_bits": (7, 3), "scale": 0.0000275, "offset": -0.2, "orbit": "WRS_PATH"},
+        {"id": "LANDSAT/LC09/C02/T2_L2", "platform": "LANDSAT_9", "green": "SR_B3", "swir1": "SR_B6",
+         "qa": "QA_PIXEL", "cloud_bits": (7, 3), "scale": 0.0000275, "offset": -0.2, "orbit": "WRS_PATH"},
+    ]},
+    "sentinel2": {"scale": 10, "threshold": 0.1, "collections": [
+        {"id": "COPERNICUS/S2_SR_HARMONIZED", "platform": "SENTINEL_2", "green": "B3", "swir1": "B11",
+         "qa": "QA60", "cloud_bits": (10, 11), "scale": 0.0001, "offset": 0, "resample": True,
+         "orbit": "SENSING_ORBIT_NUMBER"},
+    ]},
+}
+
+
+def select_sensors(names):
+    # Sensors of a run, in registry order
+    unknown = [name for name in names if name not in SENSORS]
+    if unknown:
+        raise ValueError(f"Unknown sensor {', '.join(unknown)}, expected one of {', '.join(SENSORS)}")
+    return [name for name in SENSORS if name in names]
+
+
+def harmonize(image, sensor, collection, projection):
+    # green, swir1 (reflectance) and cloud bands of one scene, with its sensor and platform set
+    import ee
+    scale = SENSORS[sensor]["scale"]
+    green = image.select(collection["green"]).multiply(collection["scale"]).add(collection["offset"]).rename('green')
+    swir1 = image.select(collection["swir1"]).multiply(collection["scale"]).add(collection["offset"])
+    if collection.get("resample"):
+        swir1 = swir1.resample('bicubic').reproject(crs=projection, scale=scale)
+    qa = image.select(collection["qa"])
+    cloud = qa.bitwiseAnd(sum(1 << bit for bit in collection["cloud_bits"])).neq(0).rename('cloud')
+    harmonized = ee.Image.cat([green, swir1.rename('swir1'), cloud]).copyProperties(image, ['system:time_start'])
+    return ee.Image(harmonized).set({'sensor': sensor, 'platform': collection["platform"], 'orbit': image.get(collection["orbit"])})
+
+
+def mosaic_same_day(images, orbit_property):
+    """
+    One image per acquisition date and orbit: the granules of a pass are mosaicked (masked no-data edges fall
+    through to the overlapping granule) and keep the first granule's properties and time, plus the number of
+    granules merged. Call it on a collection already filtered to one waterbody, after any resampling, since a
+    mosaic has no native projection to resample from.
+    """
+    import ee
+
+    def add_key(image):
+        orbit = ee.Number(image.get(orbit_property)).format('%d')
+        return image.set('pass_key', image.date().format('YYYY-MM-dd').cat('_').cat(orbit))
+
+    keyed = images.map(add_key)
+    # One join groups the granules of every pass (one image per pass_key, with its pass saved as a list),
+    # instead of one filter over the whole collection per pass
+    passes = ee.Join.saveAll('same_pass').apply(
+        primary=keyed.distinct('pass_key'),
+        secondary=keyed,
+        condition=ee.Filter.equals(leftField='pass_key', rightField='pass_key')
+    )
+
+    def mosaic(first):
+        first = ee.Image(first)
+        granules = ee.ImageCollection.fromImages(first.get('same_pass'))
+        return ee.Image(granules.mosaic().copyProperties(first, exclude=['same_pass'])).set({
+            'system:time_start': first.get('system:time_start'),
+            'granules': granules.size()
+        })
+
+    return ee.ImageCollection(passes.map(mosaic))
+
+
+def harmonized_stats(image, geometry, properties, threshold, scale, projection):
+    """
+    MNDWI, cloud and total areas of one harmonized scene over one waterbody, in one reduceRegion at the sensor's scale.
+    properties (pfi, ufi) are copied onto the row.
+    """
+    import ee
+    pixel_area = ee.Image.pixelArea()
+    mndwi = image.normalizedDifference(['green', 'swir1'])
+    water_area = mndwi.gte(threshold).multiply(pixel_area).reproject(crs=projection, scale=scale).rename('MNDWI_Area')
+    cloud_area = image.select('cloud').multiply(pixel_area).reproject(crs=projection, scale=scale).rename('Cloud_Area')
+    statistics = ee.Image.cat([water_area, cloud_area, pixel_area.rename('Total_Area')]).reduceRegion(
+        reducer=ee.Reducer.sum(),
+        geometry=geometry,
+        scale=scale,
+        crs=projection
+    )
+    total_area = ee.Number(statistics.get('Total_Area'))
+    stats_dict = dict(properties)
+    stats_dict.update({
+        'date': image.date().format('YYYY-MM-dd'),
+        'sensor': image.get('sensor'),
+        'platform': image.get('platform'),
+        'mndwi_area': statistics.get('MNDWI_Area'),
+        'cloud_area': statistics.get('Cloud_Area'),
+        'total_area': total_area,
+        'mndwi_percent': ee.Number(statistics.get('MNDWI_Area')).divide(total_area).multiply(100),
+        'cloud_percent': ee.Number(statistics.get('Cloud_Area')).divide(total_area).multiply(100)
+    })
+    return ee.Feature(None, stats_dict)
+
+
+def sensor_stats(geometry, properties, sensors, start_date, end_date, projection, thresholds=None):
+    """
+    Statistics of every scene of the requested sensors over one waterbody, as one FeatureCollection.
+    The geometry and properties are prepared once per waterbody and shared by all sensors; same-day granules are
+    mosaicked so each pass gives one row. thresholds may override the MNDWI threshold of a sensor.
+    """
+    import ee
+    thresholds = thresholds or {}
+    stats = None
+    for sensor in sensors:
+        spec = SENSORS[sensor]
+        threshold = thresholds.get(sensor, spec["threshold"])
+        for collection in spec["collections"]:
+            scenes = (ee.ImageCollection(collection["id"])
+                      .filterBounds(geometry)
+                      .filterDate(start_date, end_date)
+                      .map(lambda image, sensor=sensor, collection=collection: harmonize(image, sensor, collection, projection)))
+            scenes = mosaic_same_day(scenes, 'orbit').map(
+                lambda image, threshold=threshold, scale=spec["scale"]: harmonized_stats(image, geometry, properties, threshold, scale, projection))
+            stats = scenes if stats is None else stats.merge(scenes)
+    return stats
+
+
+def harmonized_arrays(bands, collection, threshold):
+    # NumPy counterpart of harmonize and the MNDWI mask: water and cloud masks from DN band arrays
+    def reflectance(band):
+        return np.asarray(bands[band], dtype=np.float64) * collection["scale"] + collection["offset"]
+    water = normalized_difference(reflectance(collection["green"]), reflectance(collection["swir1"])) >= threshold
+    return water, qa_bits(bands[collection["qa"]], collection["cloud_bits"])
+
+
+def harmonized_check(seed=11):
+    # Sentinel-2 reproduces the s2_mndwi product exactly; Landsat keeps its cloud bits and uses reflectance
+    from LocalStatsEngine import water_and_cloud
+    rng = np.random.default_rng(seed)
+    ok = True
+    s2 = SENSORS["sentinel2"]["collections"][0]
+    bands = {"B3": rng.integers(0, 4000, (2, 8, 8)), "B11": rng.integers(0, 4000, (2, 8, 8)),
+             "QA60": rng.choice([0, 1 << 10, 1 << 11], (2, 8, 8))}
+    water, cloud = harmonized_arrays(bands, s2, SENSORS["sentinel2"]["threshold"])
+    expected_water, expected_cloud = water_and_cloud(bands, "s2_mndwi")
+    ok &= np.array_equal(water, expected_water) and np.array_equal(cloud, expected_cloud)
+    for collection in SENSORS["landsat"]["collections"]:
+        # DN from 7273 (reflectance 0), so no pixel is masked; SR_B6 marks L8/L9 to LocalStatsEngine as to apply_cloud_mask
+        bands = {collection["green"]: rng.integers(7273, 30000, (2, 8, 8)), collection["swir1"]: rng.integers(7273, 30000, (2, 8, 8)),
+                 "QA_PIXEL": rng.choice([21824, 21824 | 1 << 3, 1 << 5, 1 << 7], (2, 8, 8))}
+        water, cloud = harmonized_arrays(bands, collection, 0.1)
+        expected_water, expected_cloud = water_and_cloud(bands, "landsat_mndwi")
+        green = bands[collection["green"]] * 0.0000275 - 0.2
+        swir1 = bands[collection["swir1"]] * 0.0000275 - 0.2
+        ok &= np.array_equal(cloud, expected_cloud) and np.array_equal(water, (green - swir1) / (green + swir1) >= 0.1)
+    print("Sensors: " + ", ".join(f"{name} ({len(spec['collections'])} collections)" for name, spec in SENSORS.items()))
+    return bool(ok)
+
+
+if __name__ == '__main__':
+    print("Sensor registry check passed" if harmonized_check() else "Sensor registry check failed")
@@ -10,13 +10,17 @@ Date: 19/11/2024
 This script processes satellite data to track water surface areas using Sentinel-2 data using Google Earth Engine.
 """
 
+import csv
 import ee
-import pandas as pd
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 from google.cloud import storage
 from google.oauth2 import service_account
-from io import BytesIO
 import time
+from FeatureState import bootstrap_state, feature_key, geometry_hash, load_state, mark_processed, master_pfis, plan_backfill, print_backfill, save_state
+from SensorRegistry import mosaic_same_day
+from ShardedExport import EarthEngineBackend, plan_shards, run_shards, stitch_shards
+from TaskMonitor import merge_export
+from WatermarkManifest import BucketStore, last_capture_date
 
 # Initialize variables.
 start_date = "2015-06-27"
@@ -31,6 +35,11 @@ service_account_json = r'\\bnefile34\groupdir\SWI\SPATIAL\Remote_Sensing\Project
 CLD_PRB_THRESH = 50
 MNDWI_THRESH = 0
 SCALE = 10
+# Areas are reduced in Australian Albers (equal area), as the other Timeseries scripts
+albers_projection = ee.Projection('EPSG:3577')
+# Export shards: waterbodies per task and tasks running at once (ShardedExport.py)
+SHARD_SIZE = 5000
+MAX_TASKS = 3
 
 # Function Definitions.
 def get_s2_sr_cld_col(aoi, start_date, end_date):
@@ -73,24 +82,22 @@ def time_series(feature, start_date):
         # Get the image acquisition date and time in UTC
         image_date_utc = ee.Date(image.get('system:time_start'))
         image_date_aest = image_date_utc.advance(10, 'hour')
-        # Clip to the boundary
+        # Clip to the boundary (B11 was resampled to 10m before the granules were mosaicked)
         image_clip = image.clip(geeFeatureGeometry)
-        # Resample B11 to 10m
-        image_resample = resample_to_10m(image_clip)        
 
         ### 2. Cloud Area
         # Select band
         cloudmask = image.select('clouds')
         # Calculate band areas
-        cloud_area = cloudmask.multiply(ee.Image.pixelArea()).rename('Cloud_Area')        
+        cloud_area = cloudmask.multiply(ee.Image.pixelArea()).reproject(crs=albers_projection, scale=SCALE).rename('Cloud_Area')        
 
         ### 3. Water area
         # Compute MNDWI using normalized difference
-        mndwi = image_resample.normalizedDifference(['B3', 'B11']).rename('MNDWI')
+        mndwi = image_clip.normalizedDifference(['B3', 'B11']).rename('MNDWI')
         # Mask the MNDWI image to include only water pixels
         mndwi_mask = mndwi.updateMask(cloudmask.Not()).gte(MNDWI_THRESH).rename('MNDWI_Mask')
         # Create a water area image
-        water_area = mndwi_mask.multiply(ee.Image.pixelArea()).rename('MNDWI_Area')        
+        water_area = mndwi_mask.multiply(ee.Image.pixelArea()).reproject(crs=albers_projection, scale=SCALE).rename('MNDWI_Area')        
 
         ### 4. Total area
         # Create total pixel area image
@@ -109,7 +116,8 @@ def time_series(feature, start_date):
         statistics = combinedAreas.reduceRegion(
             reducer=ee.Reducer.sum(),
             geometry=geeFeatureGeometry,
-            scale=SCALE
+            scale=SCALE,
+            crs=albers_projection
         )
         # Prepare stats dictionary
         stats_dict = {
@@ -124,23 +132,13 @@ def time_series(feature, start_date):
 
     # Create Sentinel-2 image collection
     imageCollection = get_s2_sr_cld_col(geeFeatureGeometry, start_date, end_date)
-    imageCollection = imageCollection.map(add_cloud_bands)
+    imageCollection = imageCollection.map(add_cloud_bands).map(resample_to_10m)
+    # One image per pass: granules of the same date and orbit mosaicked, so each date gives one complete row
+    imageCollection = mosaic_same_day(imageCollection, 'SENSING_ORBIT_NUMBER')
     # Generate statistics
     stats_collection = imageCollection.map(calculate_stats)
     return stats_collection
 
-def export_daily_stats(stats_feature_collection, description, bucket_name):
-    # Export the daily statistics to Google Cloud Storage and monitor the task status
-    export_task = ee.batch.Export.table.toCloudStorage(
-        collection=ee.FeatureCollection(stats_feature_collection),
-        description=description,
-        bucket=bucket_name,
-        fileNamePrefix=description,
-        fileFormat='CSV'
-    )
-    export_task.start()
-    print("Finished - Check Google Earth Engine for task status")
-
 def initialize_gee(service_account_json):
     credentials = service_account.Credentials.from_service_account_file(
         service_account_json, 
@@ -149,12 +147,41 @@ def initialize_gee(service_account_json):
     ee.Initialize(credentials)
 
 def find_last_capture_date(storage_client, bucket_name, output_filename):
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.get_blob(output_filename)
-    if blob:
-        old_df = pd.read_csv(BytesIO(blob.download_as_string()), parse_dates=['date'])
-        return old_df['date'].max().strftime('%Y-%m-%d')
-    return None
+    # Read the last date from the master table's sidecar manifest instead of downloading the table
+    store = BucketStore(storage_client.get_bucket(bucket_name))
+    return last_capture_date(store, output_filename)
+
+def feature_signatures(fc_server):
+    # Geometry hash (from area, perimeter and centroid), drainage basin and Earth Engine pfi value of every waterbody,
+    # fetched in one request and keyed by the string pfi used in the feature state
+    def signature(feature):
+        geometry = feature.geometry()
+        return ee.Feature(None, {
+            'pfi': feature.get('pfi'),
+            'drainage_b': feature.get('drainage_b'),
+            'area': geometry.area(1),
+            'perimeter': geometry.perimeter(1),
+            'centroid': geometry.centroid(1).coordinates()
+        })
+    columns = ['pfi', 'drainage_b', 'area', 'perimeter', 'centroid']
+    rows = fc_server.map(signature).reduceColumns(ee.Reducer.toList(len(columns)), columns).get('list').getInfo()
+    hashes = {feature_key(pfi): geometry_hash([area, perimeter, centroid]) for pfi, basin, area, perimeter, centroid in rows}
+    basins = {feature_key(pfi): basin for pfi, basin, area, perimeter, centroid in rows}
+    values = {feature_key(pfi): pfi for pfi, basin, area, perimeter, centroid in rows}
+    return hashes, basins, values
+
+def stats_collection(fc_server, work, pfis, values):
+    # Flattened statistics of the given waterbodies, each from the start date of its work unit
+    pfis = set(pfis)
+    stats_series = None
+    for unit in work:
+        unit_pfis = [pfi for pfi in unit['pfis'] if pfi in pfis]
+        if not unit_pfis:
+            continue
+        unit_features = fc_server.filter(ee.Filter.inList('pfi', [values[pfi] for pfi in unit_pfis]))
+        unit_series = unit_features.map(lambda feature, unit_start=unit['start_date']: time_series(feature, unit_start))
+        stats_series = unit_series if stats_series is None else stats_series.merge(unit_series)
+    return ee.FeatureCollection(stats_series.flatten())
 
 def main(service_account_json, bucket_name, features, output_filename, description):
     # Initialize Google Earth Engine
@@ -183,21 +210,16 @@ def main(service_account_json, bucket_name, features, output_filename, descripti
     except storage.exceptions.NotFound as e:
         print(f"Bucket or file not found with error: {e}")
         return
-    except pd.errors.EmptyDataError as e:
-        print(f"No data found in the CSV with error: {e}")
+    except (OSError, csv.Error) as e:
+        # The master table is scanned when its manifest is missing or out of date
+        print(f"Failed to read the master table with error: {e}")
         return
 
-    updated_start_date = start_date
     if last_capture_date:
-        try:
-            updated_start_date = (datetime.strptime(last_capture_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
-            print("Timeseries updating from date: {}".format(updated_start_date))
-            description += f"_update_{datetime.now().strftime('%Y%m%d')}"
-        except ValueError as e:
-            print(f"Date parsing failed with error: {e}")
-            return
+        print("Timeseries updating from date: {}".format(last_capture_date))
+        description += f"_update_{datetime.now().strftime('%Y%m%d')}"
     else:
-        print("Creating new timeseries from date: {}".format(updated_start_date))
+        print("Creating new timeseries from date: {}".format(start_date))
 
     # Create a feature collection for the waterbodies and map the time series analysis over it
     try:
@@ -206,20 +228,50 @@ def main(service_account_json, bucket_name, features, output_filename, descripti
         print(f"Failed to create feature collection with error: {e}")
         return
 
-    stats_series = None
+    # Per waterbody state (FeatureState.py): new features get their full history, edited ones are recomputed
+    # and unchanged ones are extended from their own last date
     try:
-        stats_series = fc_server.map(lambda feature: time_series(feature, updated_start_date))
+        store = BucketStore(storage_client.get_bucket(bucket_name))
+        hashes, basins, values = feature_signatures(fc_server)
+        state = load_state(store, output_filename)
+        if state is None:
+            # First run with per-feature state: the features already in the master (one scan) are complete up to
+            # its watermark, the others are new
+            state = bootstrap_state(hashes, last_capture_date, master_pfis(store, output_filename)) if last_capture_date else {}
+        work = plan_backfill(state, hashes, start_date, end_date)
+        print_backfill(work, len(set(state) - set(hashes)))
     except ee.EEException as e:
-        print(f"Failed during the mapping of time_series function with error: {e}")
+        print(f"Failed to read the waterbody geometries with error: {e}")
+        return
+    if not work:
+        print("All waterbodies are up to date")
         return
 
-    # Flatten the results and export
+    # Export in shards by drainage basin, at most MAX_TASKS at once, retrying failed shards
+    shards = plan_shards([(pfi, basins.get(pfi)) for unit in work for pfi in unit['pfis']], SHARD_SIZE)
+    print(f"Exporting {len(shards)} shards of at most {SHARD_SIZE} waterbodies")
     try:
-        flattened_stats = ee.FeatureCollection(stats_series.flatten())
-        export_daily_stats(flattened_stats, description, bucket_name)
+        backend = EarthEngineBackend(lambda pfis: stats_collection(fc_server, work, pfis, values), bucket_name, description)
+        outputs, failed = run_shards(backend, shards, MAX_TASKS)
     except ee.EEException as e:
         print(f"Failed to export statistics with error: {e}")
         return
+    if failed:
+        print(f"Shards failed: {', '.join(failed)}; their waterbodies will be retried on the next run")
+
+    # Stitch the shard outputs into one update table
+    if outputs:
+        summary = stitch_shards(store, outputs, description + '.csv')
+        print(f"Stitched {len(outputs)} shards into {description}.csv ({summary['written']} rows)")
+        # run_shards has already waited for the tasks, so the update is merged into the master straight away
+        if description + '.csv' != output_filename:
+            summary = merge_export(store, description + '.csv', output_filename)
+            print(f"Merged into {output_filename}: {summary['written']} rows up to {summary['last_date']}")
+
+    # Record the exported date ranges against the waterbodies of the completed shards
+    done = {pfi for shard in shards if shard['shard'] in outputs for pfi in shard['pfis']}
+    work_done = [dict(unit, pfis=[pfi for pfi in unit['pfis'] if pfi in done]) for unit in work]
+    save_state(store, output_filename, mark_processed(state, work_done, hashes, end_date))
 
 if __name__ == '__main__':
     main(service_account_json, bucket, features, output_filename, description)
@@ -0,0 +1,143 @@
+# Sentinel2 Multi-Index Timeseries Update
+# Remote Sensing Team
+# 18/10/2026
+# Computes every index in INDICES (IndexRegistry.py) from one read of each scene
+
+### 1. Import modules
+print("Starting Sentinel2 Multi-Index Timeseries Update")
+print("1. Import modules")
+
+import ee
+from datetime import datetime, timedelta, date
+from google.cloud import storage
+from google.oauth2 import service_account
+import sys
+from IndexRegistry import resample_bands, scene_stats, select_indices
+from SensorRegistry import mosaic_same_day
+from TaskMonitor import monitor_export
+from WatermarkManifest import BucketStore, last_capture_date
+
+### 2. Initialize GEE with the service account credentials
+print("2. Initialising GEE")
+
+try:
+    SERVICE_ACCOUNT_JSON = r'K:\Projects\GEE\Service Key\remote-sensing-420704-a195c59596e7.json'
+    credentials = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_JSON, 
+        scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    ee.Initialize(credentials)
+except:
+    print("Initialisation failed")
+    sys.exit()
+
+### 3. Declare Variables
+print("3. Declaring variables")
+
+features = 'projects/remote-sensing-420704/assets/Waterbodies_qld_constructed'
+output_filename = 'sentinel2_daily_multi_index_statistics.csv'
+uniqueid_field = "pfi"
+# Indices and water thresholds computed in the one pass (None keeps the registry threshold)
+indices = select_indices({'mndwi': 0.1, 'awei': 0, 'ndwi': None, 'ndvi': None})
+BUCKET = "sentinel2_timeseries"
+albers_projection = ee.Projection('EPSG:3577')
+
+### 4. Define Functions
+print("4. Defining functions")
+
+def time_series(feature):
+    geeFeatureGeometry = ee.Geometry(feature.geometry())
+    dateRange = ee.DateRange(start_date, end_date)
+
+    def calculate_stats(image):
+        # Every requested index from the one resampled read of the scene
+        return scene_stats(image, geeFeatureGeometry, indices, {uniqueid_field: feature.get(uniqueid_field)}, albers_projection)
+
+    # Create an ImageCollection for the feature, load and resample the bands once, mosaic the granules of each pass
+    # and map the calculate_stats function
+    images = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED') \
+        .filterBounds(geeFeatureGeometry)\
+        .filterDate(dateRange)\
+        .map(lambda image: resample_bands(image, indices, albers_projection))
+    return mosaic_same_day(images, 'SENSING_ORBIT_NUMBER').map(calculate_stats)
+
+def export_daily_stats(stats_feature_collection, description, bucket_name):
+    # Export the daily statistics to Google Cloud Storage and monitor the task status
+    export_task = ee.batch.Export.table.toCloudStorage(
+        collection=ee.FeatureCollection(stats_feature_collection),
+        description=description,
+        bucket=bucket_name,
+        fileNamePrefix=description,
+        fileFormat='CSV'
+    )
+    export_task.start()
+    print(f"    Export task {export_task.id} started")
+    return export_task
+
+### 5. Find last capture date
+print("5. Finding last capture date")
+
+try:
+
+    # Initialize storage client
+    storage_client = storage.Client.from_service_account_json(SERVICE_ACCOUNT_JSON)
+    store = BucketStore(storage_client.get_bucket(BUCKET))
+    # Last date from the master CSV's sidecar manifest, without downloading the CSV
+    last_date = last_capture_date(store, output_filename)
+
+    # Check if master CSV exists and read its last capture date
+    if last_date is not None:
+        start_date = (datetime.strptime(last_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        end_date = date.today().strftime('%Y-%m-%d')
+        description = f'sentinel2_daily_multi_index_update_{datetime.now().strftime("%Y%m%d")}'
+        print("    " + start_date)    
+    else:
+        print("     Master CSV file not found. Creating new file.")
+        # Analysis period
+        start_date = "1900-01-01"
+        end_date = "2030-01-01"
+        description = "sentinel2_daily_multi_index_statistics"
+
+except:
+    print("Error: Storage bucket not found")
+    sys.exit()
+
+### 6. Run timeseries of waterbodies
+print("6. Create waterbody feature collection")
+
+try:
+    # Generate and export statistics
+    fc_server = ee.FeatureCollection(features)
+except:
+    print("Error: Waterbody features not found")
+    sys.exit()
+
+### 7. For each waterbody, calculate daily statistics
+print("7. Calculating daily statistics")
+
+try:
+    stats_collections = fc_server.map(time_series)
+    flattened_stats = ee.FeatureCollection(stats_collections.flatten())
+except:
+    print("Error: Calculating statistics failed")
+    sys.exit()
+
+### 7. Export data to cloud bucket
+print("8. Exporting data to cloud bucket")
+
+try:
+    # Start the export process
+    export_task = export_daily_stats(flattened_stats, description, BUCKET)
+except:
+    print("Error: Exporting statistics to cloud bucket failed")
+    sys.exit()
+
+### 9. Wait for the export and merge it into the master CSV
+print("9. Monitoring export task")
+
+try:
+    # Polls the task with backoff and merges the update as soon as it completes, then rewrites the manifest
+    monitor_export(export_task.id, store, description + '.csv', output_filename)
+except:
+    print("Error: Merging the export into the master CSV failed")
+    sys.exit()
@@ -0,0 +1,256 @@
+# ShardedExport.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Sharded export of the Timeseries statistics, instead of one Export.table.toCloudStorage over the whole state.
+plan_shards splits the waterbodies into balanced shards (by drainage basin, with large basins split and small ones
+packed together, or by feature count alone). run_shards keeps up to max_in_flight export tasks running under the
+quota, polls them through a TaskMonitor (backoff, recorded state transitions), retries failed shards and returns
+each shard's output, and stitch_shards merges the outputs into one update table (MergeUpdates.py).
+Tasks go through a backend: EarthEngineBackend submits real exports, FakeBackend runs them in-process on a local
+directory so the scheduling can be tested offline.
+"""
+
+import asyncio
+import csv
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+from MergeUpdates import merge_updates
+
+# Earth Engine task states
+DONE_STATES = ("COMPLETED",)
+FAILED_STATES = ("FAILED", "CANCELLED")
+
+
+def earth_engine_status(task_id):
+    # State and error message of an Earth Engine task
+    import ee
+    status = ee.data.getTaskStatus(task_id)[0]
+    return status["state"], status.get("error_message")
+
+
+def plan_shards(features, max_features=5000, by_group=True):
+    """
+    Balanced shards of at most max_features waterbodies.
+    features is a list of (pfi, group) pairs, e.g. the drainage basin (drainage_b). With by_group, a basin stays in
+    one shard when it fits; larger basins are split into equal parts and smaller ones packed together (first fit,
+    largest first). Without it, features are cut into equal shards in pfi order.
+    Returns a list of shards, each a dict with the shard name, its groups and its pfis.
+    """
+    if not by_group:
+        pfis = sorted(pfi for pfi, group in features)
+        count = max((len(pfis) + max_features - 1) // max_features, 1)
+        size = (len(pfis) + count - 1) // count
+        return [{"shard": f"shard{i:03d}", "groups": [], "pfis": pfis[i * size:(i + 1) * size]} for i in range(count) if pfis[i * size:(i + 1) * size]]
+    groups = defaultdict(list)
+    for pfi, group in features:
+        groups[group].append(pfi)
+    pieces = []
+    for group, pfis in groups.items():
+        pfis.sort()
+        parts = (len(pfis) + max_features - 1) // max_features
+        size = (len(pfis) + parts - 1) // parts
+        for start in range(0, len(pfis), size):
+            pieces.append((group, pfis[start:start + size]))
+    bins = []
+    for group, pfis in sorted(pieces, key=lambda piece: -len(piece[1])):
+        for shard in bins:
+            if len(shard["pfis"]) + len(pfis) <= max_features:
+                break
+        else:
+            shard = {"groups": [], "pfis": []}
+            bins.append(shard)
+        shard["groups"].append(group)
+        shard["pfis"] += pfis
+    return [dict(shard, shard=f"shard{i:03d}") for i, shard in enumerate(bins)]
+
+
+class EarthEngineBackend:
+    """
+    Export tasks on Earth Engine. make_collection(pfis) returns the flattened statistics FeatureCollection of a
+    shard's waterbodies; each shard is exported to <description>_<shard>.csv in the bucket.
+    """
+
+    def __init__(self, make_collection, bucket_name, description):
+        import ee
+        self.ee = ee
+        self.make_collection = make_collection
+        self.bucket_name = bucket_name
+        self.description = description
+
+    def output_name(self, shard):
+        return f"{self.description}_{shard['shard']}"
+
+    def submit(self, shard):
+        task = self.ee.batch.Export.table.toCloudStorage(
+            collection=self.make_collection(shard["pfis"]),
+            description=self.output_name(shard),
+            bucket=self.bucket_name,
+            fileNamePrefix=self.output_name(shard),
+            fileFormat='CSV'
+        )
+        task.start()
+        return task.id
+
+    def status(self, task_id):
+        return earth_engine_status(task_id)
+
+    def output(self, shard):
+        return self.output_name(shard) + ".csv"
+
+
+class FakeBackend:
+    """
+    In-process stand-in for Earth Engine tasks. A task completes after `polls` status calls and writes
+    rows(shard) as <description>_<shard>.csv in folder. fail_attempts maps a shard name to the number of its
+    first attempts that fail, and raise_attempts to the number of its first attempts whose submit raises (as a
+    network error would), to exercise retries.
+    """
+
+    def __init__(self, folder, rows, description="fake_export", polls=2, fail_attempts=None, raise_attempts=None):
+        self.folder = folder
+        self.rows = rows
+        self.description = description
+        self.polls = polls
+        self.fail_attempts = dict(fail_attempts or {})
+        self.raise_attempts = dict(raise_attempts or {})
+        self.tasks = {}
+        self.attempts = defaultdict(int)
+        self.max_running = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def running(self):
+        return sum(task["state"] == "RUNNING" for task in self.tasks.values())
+
+    def submit(self, shard):
+        self.attempts[shard["shard"]] += 1
+        if self.attempts[shard["shard"]] <= self.raise_attempts.get(shard["shard"], 0):
+            raise ConnectionError(f"{shard['shard']}: injected submit error")
+        task_id = f"{shard['shard']}-{self.attempts[shard['shard']]}"
+        failing = self.attempts[shard["shard"]] <= self.fail_attempts.get(shard["shard"], 0)
+        self.tasks[task_id] = {"shard": shard, "state": "RUNNING", "polls": 0, "failing": failing}
+        self.max_running = max(self.max_running, self.running())
+        return task_id
+
+    def status(self, task_id):
+        task = self.tasks[task_id]
+        if task["state"] == "RUNNING":
+            task["polls"] += 1
+            if task["polls"] >= self.polls:
+                if task["failing"]:
+                    task["state"] = "FAILED"
+                else:
+                    rows = self.rows(task["shard"])
+                    with open(os.path.join(self.folder, self.output(task["shard"])), "w", newline="") as output_file:
+                        writer = csv.DictWriter(output_file, fieldnames=list(rows[0]) if rows else ["pfi", "date"])
+                        writer.writeheader()
+                        writer.writerows(rows)
+                    task["state"] = "COMPLETED"
+        return task["state"], "injected failure" if task["state"] == "FAILED" else None
+
+    def output(self, shard):
+        return f"{self.description}_{shard['shard']}.csv"
+
+
+def run_shards(backend, shards, max_in_flight=3, max_retries=2, initial_delay=30, max_delay=300, log_path=None,
+               sleep=asyncio.sleep):
+    """
+    Run every shard through the backend with at most max_in_flight tasks at once.
+    Each task is polled by a TaskMonitor (TaskMonitor.py) from initial_delay with backoff up to max_delay, so the
+    state transitions and durations of every shard are recorded (and logged to log_path when given).
+    A failed shard is resubmitted up to max_retries times; an exception from submitting or polling a shard (e.g. a
+    network error that outlasts the monitor's retries) counts as a failed attempt of that shard only.
+    Returns (outputs, failed): the output name of every completed shard keyed by shard name, and the names of the
+    shards that failed every attempt.
+    """
+    # Imported here, as TaskMonitor imports the task states of this module
+    from TaskMonitor import TaskMonitor
+    monitor = TaskMonitor(backend.status, initial_delay=initial_delay, max_delay=max_delay, log_path=log_path, sleep=sleep)
+    outputs = {}
+    failed = []
+
+    async def run_shard(shard, slots):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, max_retries + 2):
+            async with slots:
+                try:
+                    task_id = await loop.run_in_executor(None, backend.submit, shard)
+                    summary = await monitor.watch(task_id, shard)
+                    state, error = summary["state"], summary["error"]
+                except Exception as e:
+                    state, error = "FAILED", e
+            if state in DONE_STATES:
+                outputs[shard["shard"]] = backend.output(shard)
+                print(f"{shard['shard']} completed ({len(shard['pfis'])} waterbodies)")
+                return
+            if attempt <= max_retries:
+                print(f"{shard['shard']} failed ({error}), retrying")
+            else:
+                print(f"{shard['shard']} failed after {attempt} attempts ({error})")
+                failed.append(shard["shard"])
+
+    async def run_all():
+        slots = asyncio.Semaphore(max_in_flight)
+        await asyncio.gather(*[run_shard(shard, slots) for shard in shards])
+
+    asyncio.run(run_all())
+    return outputs, failed
+
+
+def stitch_shards(store, outputs, output_name, remove_outputs=True):
+    """
+    Merge the shard outputs in a store (WatermarkManifest LocalStore or BucketStore) into one update table,
+    deduplicated by (pfi, date, sensor). Once the table is written, the shard outputs are deleted from the store
+    (unless remove_outputs is False). Returns the merge summary.
+    """
+    work_folder = tempfile.mkdtemp(prefix="stitch_")
+    try:
+        paths = []
+        for name in sorted(outputs.values()):
+            path = os.path.join(work_folder, name)
+            if not store.download(name, path):
+                raise FileNotFoundError(f"Shard output {name} not found")
+            paths.append(path)
+        output_path = os.path.join(work_folder, output_name)
+        summary = merge_updates(output_path, paths)
+        store.upload(output_path, output_name)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    if remove_outputs:
+        for name in outputs.values():
+            store.delete(name)
+    return summary
+
+
+def fake_check():
+    # Offline run of the scheduler: 23 waterbodies in 4 basins, one shard failing twice
+    from WatermarkManifest import LocalStore
+    features = [(f"{i:03d}", basin) for i, basin in enumerate(["Burdekin"] * 11 + ["Fitzroy"] * 7 + ["Mary"] * 3 + ["Moonie"] * 2)]
+    shards = plan_shards(features, max_features=6)
+    folder = tempfile.mkdtemp(prefix="fake_export_")
+
+    async def no_wait(delay):
+        await asyncio.sleep(0)
+
+    try:
+        backend = FakeBackend(folder, lambda shard: [{"pfi": pfi, "date": "2024-01-01", "mndwi_area": 1.0} for pfi in shard["pfis"]],
+                              fail_attempts={"shard001": 2}, raise_attempts={"shard002": 1})
+        outputs, failed = run_shards(backend, shards, max_in_flight=2, max_retries=2, sleep=no_wait)
+        summary = stitch_shards(LocalStore(folder), outputs, "fake_export.csv")
+        with open(os.path.join(folder, "fake_export.csv"), newline="") as output_file:
+            rows = list(csv.DictReader(output_file))
+        leftover = [name for name in outputs.values() if os.path.exists(os.path.join(folder, name))]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print(f"{len(shards)} shards, {len(outputs)} completed, {len(failed)} failed, at most {backend.max_running} running, "
+          f"{summary['written']} rows stitched, {len(leftover)} shard outputs left")
+    return (not failed and not leftover and backend.max_running <= 2
+            and sorted(row["pfi"] for row in rows) == sorted(pfi for pfi, basin in features))
+
+
+if __name__ == '__main__':
+    print("Fake backend check passed" if fake_check() else "Fake backend check failed")
@@ -0,0 +1,280 @@
+# StatisticsStore.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Partitioned Parquet store for the daily waterbody statistics, replacing the monolithic CSV exports.
+Layout: <root>/sensor=<sensor>/index=<index>/year=<year>/part-<timestamp>-<source>.parquet
+
+Each part is sorted by pfi and day, with compact columns: pfi/ufi dictionary-encoded strings, day as int32 days
+since 1970-01-01 and float32 areas and percents. Row groups are small enough that reading one waterbody's history
+only touches the row groups whose pfi min/max statistics hold it.
+ingest_csv converts an update CSV produced by export_daily_stats (a harmonized table with a sensor column is split
+into the sensor partitions, otherwise --sensor names the sensor); appending only ever adds part files. Ingested
+sources are logged in <root>/_ingested.json so a CSV is ingested once.
+Every row carries the version (ingest time in ns) of its part. Overlapping updates can hold the same (pfi, day)
+more than once, so read_history keeps the row of the latest part. compact_store rewrites each partition that has
+accumulated several parts as one deduplicated, sorted part, so a history read keeps touching a few row groups.
+Needs pyarrow (pip install pyarrow).
+Usage: python StatisticsStore.py ingest sentinel2_daily_mndwi_update_20241120.csv --sensor sentinel2 --index mndwi --root store
+       python StatisticsStore.py history 114006000066958 --sensor sentinel2 --index mndwi --root store
+       python StatisticsStore.py compact --index mndwi --root store
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from ExportSchema import DATE_FORMATS, DROP_COLUMNS
+
+ID_COLUMNS = ("pfi", "ufi")
+SENSOR_COLUMN = "sensor"
+VERSION_COLUMN = "version"
+# Columns identifying one statistics row across the store
+KEY_COLUMNS = ("sensor", "index", "pfi", "day")
+ROW_GROUP_SIZE = 32768
+EPOCH = date(1970, 1, 1)
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for the statistics store: pip install pyarrow")
+    return pyarrow
+
+
+def day_to_date(day):
+    return EPOCH + timedelta(days=int(day))
+
+
+def date_to_day(value):
+    return (value - EPOCH).days
+
+
+def read_ingest_log(root):
+    path = os.path.join(root, "_ingested.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as log_file:
+        return json.load(log_file)
+
+
+def write_ingest_log(root, log):
+    path = os.path.join(root, "_ingested.json")
+    with open(path + ".tmp", "w") as log_file:
+        json.dump(log, log_file, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def compact_table(table):
+    """
+    Statistics table with the store's columns: dictionary-encoded ids, int32 day numbers, float32 areas and percents.
+    The date column is parsed with either export date format; rows with no date are dropped.
+    """
+    pa = import_pyarrow()
+    pc = pa.compute
+    table = table.drop([name for name in DROP_COLUMNS if name in table.column_names])
+    dates = table.column("date").cast(pa.string())
+    parsed = pc.coalesce(*[pc.strptime(dates, format=date_format, unit="s", error_is_null=True) for date_format in DATE_FORMATS])
+    days = parsed.cast(pa.date32()).cast(pa.int32())
+    columns = {}
+    for name in table.column_names:
+        if name == "date":
+            continue
+        column = table.column(name)
+        if name in ID_COLUMNS or name == SENSOR_COLUMN:
+            # Dictionary-encoded in the Parquet files and when read back (open_dataset)
+            column = column.cast(pa.string())
+        elif name.endswith("_area") or name.endswith("_percent"):
+            column = column.cast(pa.float32())
+        columns[name] = column
+    compact = pa.table(dict(columns, day=days, year=pc.year(parsed).cast(pa.int16())))
+    return compact.filter(pc.is_valid(compact.column("day")))
+
+
+def partition_folder(root, sensor, index, year):
+    return os.path.join(root, f"sensor={sensor}", f"index={index}", f"year={year}")
+
+
+def write_part(folder, part, name):
+    # Written under a temporary "_" name, which dataset discovery skips, so readers never see a partial part
+    pa = import_pyarrow()
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    temp_path = os.path.join(folder, f"_{name}.tmp")
+    pa.parquet.write_table(part, temp_path, row_group_size=ROW_GROUP_SIZE, compression="zstd",
+                           use_dictionary=[column for column in ID_COLUMNS if column in part.column_names], write_statistics=True)
+    os.replace(temp_path, path)
+    return path
+
+
+def latest_rows(table, keys):
+    """
+    One row per key, the one with the highest version (the latest part), sorted by the keys.
+    Keys missing from the table are ignored.
+    """
+    pa = import_pyarrow()
+    keys = [key for key in keys if key in table.column_names]
+    for key in keys:
+        # Dictionary keys (ids, hive partition values) compared and sorted as plain strings
+        if pa.types.is_dictionary(table.schema.field(key).type):
+            table = table.set_column(table.column_names.index(key), key, table.column(key).cast(pa.string()))
+    table = table.sort_by([(key, "ascending") for key in keys] + [(VERSION_COLUMN, "descending")])
+    if table.num_rows < 2:
+        return table
+    keep = np.ones(table.num_rows, dtype=bool)
+    changed = np.zeros(table.num_rows - 1, dtype=bool)
+    for key in keys:
+        values = table.column(key).to_numpy(zero_copy_only=False)
+        changed |= values[1:] != values[:-1]
+    keep[1:] = changed
+    return table.filter(pa.array(keep))
+
+
+def append_table(root, table, sensor, index, source="append"):
+    """
+    Append a compact statistics table as new part files, one per year partition, each sorted by pfi and day.
+    A table with a sensor column goes to the partition of each row's sensor, and sensor may be None.
+    Existing parts are never touched. Returns the paths written.
+    """
+    pa = import_pyarrow()
+    pc = pa.compute
+    if SENSOR_COLUMN in table.column_names:
+        paths = []
+        for name in sorted(pc.unique(table.column(SENSOR_COLUMN)).to_pylist()):
+            rows = table.filter(pc.equal(table.column(SENSOR_COLUMN), name)).drop([SENSOR_COLUMN])
+            paths += append_table(root, rows, name, index, source)
+        return paths
+    if sensor is None:
+        raise ValueError("No sensor column in the table, a sensor is required")
+    paths = []
+    stamp = time.strftime("%Y%m%d%H%M%S")
+    version = time.time_ns()
+    table = table.append_column(VERSION_COLUMN, pa.array(np.full(table.num_rows, version, dtype=np.int64)))
+    for year in sorted(pc.unique(table.column("year")).to_pylist()):
+        part = table.filter(pc.equal(table.column("year"), year)).drop(["year"])
+        part = part.sort_by([("pfi", "ascending"), ("day", "ascending")])
+        paths.append(write_part(partition_folder(root, sensor, index, year), part, f"part-{stamp}-{source}.parquet"))
+    return paths
+
+
+def compact_partition(folder):
+    """
+    Rewrite the parts of one partition folder as a single part sorted by pfi and day, keeping the latest row of
+    each (pfi, day). The new part is in place before the old ones are removed, and readers deduplicate, so a
+    history read during compaction still sees each row once. Returns the new part's path, or None with fewer
+    than two parts.
+    """
+    pa = import_pyarrow()
+    parts = sorted(glob.glob(os.path.join(folder, "part-*.parquet")))
+    if len(parts) < 2:
+        return None
+    table = pa.concat_tables([pa.parquet.read_table(part) for part in parts], promote_options="default")
+    compacted = latest_rows(table, ("pfi", "day"))
+    path = write_part(folder, compacted, f"part-{time.strftime('%Y%m%d%H%M%S')}-compacted.parquet")
+    for part in parts:
+        if part != path:
+            os.remove(part)
+    return path
+
+
+def compact_store(root, sensor=None, index=None, min_parts=2):
+    # Compact every partition (optionally of one sensor and index) holding at least min_parts parts
+    pattern = partition_folder(root, sensor or "*", index or "*", "*")
+    compacted = []
+    for folder in sorted(glob.glob(pattern)):
+        if len(glob.glob(os.path.join(folder, "part-*.parquet"))) >= min_parts:
+            path = compact_partition(folder)
+            if path:
+                compacted.append(path)
+    print(f"Compacted {len(compacted)} partitions")
+    return compacted
+
+
+def ingest_csv(root, csv_path, sensor, index):
+    """
+    Convert an update CSV from export_daily_stats into the store. A CSV already ingested (same name and size) is skipped.
+    Returns the part paths written.
+    """
+    pa = import_pyarrow()
+    name = os.path.basename(csv_path)
+    size = os.path.getsize(csv_path)
+    log = read_ingest_log(root)
+    if log.get(name, {}).get("size") == size:
+        print(f"{name} already ingested")
+        return []
+    column_types = {column: pa.string() for column in ID_COLUMNS + ("date", SENSOR_COLUMN)}
+    table = pa.csv.read_csv(csv_path, convert_options=pa.csv.ConvertOptions(column_types=column_types))
+    compact = compact_table(table)
+    source = os.path.splitext(name)[0]
+    paths = append_table(root, compact, sensor, index, source)
+    log[name] = {"size": size, "rows": compact.num_rows, "sensor": sensor, "index": index,
+                 "parts": [os.path.relpath(path, root) for path in paths]}
+    write_ingest_log(root, log)
+    print(f"Ingested {compact.num_rows} of {table.num_rows} rows from {name} into {len(paths)} partitions")
+    return paths
+
+
+def open_dataset(root):
+    pa = import_pyarrow()
+    ds = pa.dataset
+    # Ids come back dictionary-encoded, as they are stored
+    parquet_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=list(ID_COLUMNS)))
+    return ds.dataset(root, format=parquet_format, partitioning="hive")
+
+
+def read_history(root, pfi, sensor=None, index=None, columns=None):
+    """
+    Statistics of one waterbody, sorted by day, one row per sensor, index and day (the latest part's row when
+    overlapping updates were ingested). The partition filters prune whole folders and the pfi filter is checked
+    against each row group's min/max, so only the row groups holding the pfi are read.
+    """
+    pa = import_pyarrow()
+    field = pa.dataset.field
+    condition = field("pfi") == pfi
+    if sensor is not None:
+        condition = condition & (field("sensor") == sensor)
+    if index is not None:
+        condition = condition & (field("index") == index)
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + list(KEY_COLUMNS) + [VERSION_COLUMN]))
+    table = latest_rows(open_dataset(root).to_table(columns=read_columns, filter=condition), KEY_COLUMNS)
+    table = table.sort_by([("day", "ascending")])
+    return table if columns is None else table.select(list(columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned Parquet store for the daily waterbody statistics")
+    parser.add_argument("command", choices=("ingest", "history", "compact"))
+    parser.add_argument("target", nargs="*", help="CSV files to ingest, or the pfi to read")
+    parser.add_argument("--sensor", help="Sensor of the CSVs (default: their sensor column)")
+    parser.add_argument("--index")
+    parser.add_argument("--root", default="statistics_store")
+    args = parser.parse_args()
+    if args.command == "compact":
+        compact_store(args.root, args.sensor, args.index)
+    elif args.command == "ingest":
+        if not args.index:
+            parser.error("--index is required to ingest")
+        for csv_path in args.target:
+            ingest_csv(args.root, csv_path, args.sensor, args.index)
+    else:
+        for pfi in args.target:
+            history = read_history(args.root, pfi, args.sensor, args.index)
+            print(f"{pfi}: {history.num_rows} rows")
+            for row in history.to_pylist():
+                row["date"] = day_to_date(row.pop("day")).isoformat()
+                print(row)
+
+
+if __name__ == '__main__':
+    main()
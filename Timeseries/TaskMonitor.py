@@ -0,0 +1,222 @@
+# TaskMonitor.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Asyncio monitor for the export tasks started by export_daily_stats, so nobody has to watch the Earth Engine console.
+Every task is polled on its own coroutine with exponential backoff (the delay resets when the state changes, and
+a failed status request, e.g. a network error, is retried with the same backoff); state transitions and their
+durations are recorded, and appended to a JSON lines log when one is given. ShardedExport.run_shards polls its
+shard tasks through the same monitor.
+When a task completes, its on_complete action runs straight away, e.g. merge_export, which merges the produced
+CSV into the master table and rewrites its manifest, so the table is usable seconds after the export finishes.
+"""
+
+import asyncio
+import csv
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ExportSchema import iso_date
+from MergeUpdates import merge_updates, read_header
+from ShardedExport import DONE_STATES, FAILED_STATES, earth_engine_status
+from WatermarkManifest import read_manifest, write_manifest
+
+
+def append_rows(store, export_path, master_name, manifest, work_folder):
+    """
+    Append an export to the master without downloading it, when that cannot create duplicates: the master's
+    manifest is current and every export row is dated after its watermark, with no new columns.
+    The export is deduplicated and laid out in the master's columns first. Returns the merge summary, or None
+    when the export needs a full merge.
+    """
+    if manifest is None or manifest.get("last_date") is None or manifest.get("table_signature") != store.signature(master_name):
+        return None
+    sorted_path = os.path.join(work_folder, "sorted_" + os.path.basename(export_path))
+    summary = merge_updates(sorted_path, [export_path])
+    columns = manifest["columns"]
+    if not set(read_header(sorted_path)) <= set(columns):
+        return None
+    rows_path = os.path.join(work_folder, "rows_" + os.path.basename(export_path))
+    with open(sorted_path, newline="") as sorted_file, open(rows_path, "w", newline="") as rows_file:
+        writer = csv.writer(rows_file)
+        for row in csv.DictReader(sorted_file):
+            if iso_date(row.get("date", "")) <= manifest["last_date"]:
+                return None
+            writer.writerow([row.get(column, "") for column in columns])
+    store.append(master_name, rows_path)
+    summary.update(appended=summary["written"], written=manifest["rows"] + summary["written"],
+                   last_date=max(manifest["last_date"], summary["last_date"] or manifest["last_date"]))
+    write_manifest(store, master_name, summary["last_date"], summary["written"], columns)
+    return summary
+
+
+def merge_export(store, export_name, master_name):
+    """
+    Merge a completed export CSV in a store (WatermarkManifest LocalStore or BucketStore) into the master table and
+    write its manifest. Returns the merge summary.
+    A plain daily update (all rows after the master's watermark) is appended without downloading the master
+    (append_rows). Anything else, e.g. recomputed history of edited waterbodies, needs the full merge: the whole
+    master is downloaded, merged with the export through a local work folder (MergeUpdates.py) and uploaded again,
+    which costs a transfer of the master each way.
+    """
+    work_folder = tempfile.mkdtemp(prefix="merge_export_")
+    try:
+        export_path = os.path.join(work_folder, export_name)
+        if not store.download(export_name, export_path):
+            raise FileNotFoundError(f"Export {export_name} not found")
+        summary = append_rows(store, export_path, master_name, read_manifest(store, master_name), work_folder)
+        if summary is None:
+            print(f"    Full merge of {export_name}: downloading {master_name}")
+            master_path = os.path.join(work_folder, master_name)
+            store.download(master_name, master_path)
+            summary = merge_updates(master_path, [export_path])
+            store.upload(master_path, master_name)
+            write_manifest(store, master_name, summary["last_date"], summary["written"], read_header(master_path))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return summary
+
+
+class TaskMonitor:
+    """
+    Tracks export tasks until they finish.
+    status(task_id) returns (state, error) and may block (it runs in a worker thread). on_complete(task_id, context)
+    runs when a task completes, on_failed(task_id, context, error) when it fails. Polling starts every initial_delay
+    seconds and backs off by factor up to max_delay while the state does not change. A status call that raises is
+    retried with the same backoff; after max_status_errors consecutive errors the error is raised from watch.
+    """
+
+    def __init__(self, status=earth_engine_status, on_complete=None, on_failed=None, initial_delay=10, max_delay=300,
+                 factor=2, log_path=None, clock=time.time, sleep=asyncio.sleep, max_status_errors=10):
+        self.status = status
+        self.on_complete = on_complete
+        self.on_failed = on_failed
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.log_path = log_path
+        self.clock = clock
+        self.sleep = sleep
+        self.max_status_errors = max_status_errors
+        self.transitions = []
+
+    def record(self, task_id, state, started, changed):
+        # One state transition: the new state, when it was seen and how long the previous state lasted
+        now = self.clock()
+        transition = {"task": task_id, "state": state, "at": now, "elapsed": now - started, "previous_duration": now - changed}
+        self.transitions.append(transition)
+        print(f"Task {task_id}: {state} after {transition['elapsed']:.0f} s")
+        if self.log_path:
+            with open(self.log_path, "a") as log_file:
+                log_file.write(json.dumps(transition) + "\n")
+        return now
+
+    async def watch(self, task_id, context=None):
+        """
+        Poll one task until it completes or fails, then run its action.
+        Returns a summary dict with the final state, the export time and the time the action took.
+        """
+        loop = asyncio.get_running_loop()
+        started = changed = self.clock()
+        state = None
+        delay = self.initial_delay
+        status_errors = 0
+        while True:
+            try:
+                new_state, error = await loop.run_in_executor(None, self.status, task_id)
+                status_errors = 0
+            except Exception as e:
+                status_errors += 1
+                if status_errors >= self.max_status_errors:
+                    raise
+                print(f"Task {task_id}: status request failed ({e}), retrying in {delay:.0f} s")
+                await self.sleep(delay)
+                delay = min(delay * self.factor, self.max_delay)
+                continue
+            if new_state != state:
+                changed = self.record(task_id, new_state, started, changed)
+                state = new_state
+                delay = self.initial_delay
+            if state in DONE_STATES or state in FAILED_STATES:
+                break
+            await self.sleep(delay)
+            delay = min(delay * self.factor, self.max_delay)
+        summary = {"task": task_id, "state": state, "export_time": self.clock() - started, "error": error, "action_time": 0.0}
+        action_start = self.clock()
+        if state in DONE_STATES and self.on_complete is not None:
+            summary["result"] = await loop.run_in_executor(None, self.on_complete, task_id, context)
+        elif state in FAILED_STATES and self.on_failed is not None:
+            await loop.run_in_executor(None, self.on_failed, task_id, context, error)
+        summary["action_time"] = self.clock() - action_start
+        return summary
+
+    async def watch_all(self, tasks):
+        # Watch (task_id, context) pairs concurrently
+        return await asyncio.gather(*[self.watch(task_id, context) for task_id, context in tasks])
+
+    def run(self, tasks):
+        return asyncio.run(self.watch_all(tasks))
+
+
+def monitor_export(task_id, store, export_name, master_name, log_path=None):
+    """
+    Wait for one export task and merge its CSV into the master table as soon as it completes (an export that
+    creates the master itself is only waited for). Returns the watch summary.
+    """
+    merge = None if export_name == master_name else lambda task, context: merge_export(store, export_name, master_name)
+    monitor = TaskMonitor(on_complete=merge,
+                          on_failed=lambda task, context, error: print(f"Export {export_name} failed: {error}"),
+                          log_path=log_path)
+    summary = monitor.run([(task_id, export_name)])[0]
+    if summary["state"] in DONE_STATES:
+        print(f"Export finished in {summary['export_time']:.0f} s, {master_name} updated {summary['action_time']:.1f} s later")
+    return summary
+
+
+def fake_check():
+    # Offline run: two fake tasks with scripted states, polled without waiting
+    from WatermarkManifest import LocalStore
+    folder = tempfile.mkdtemp(prefix="monitor_")
+    store = LocalStore(folder)
+    with open(os.path.join(folder, "master.csv"), "w") as table_file:
+        table_file.write("date,pfi,mndwi_area\n2024-01-01,1,5.0\n")
+    with open(os.path.join(folder, "update.csv"), "w") as table_file:
+        table_file.write("system:index,date,pfi,mndwi_area,.geo\n0,2024-01-01,1,6.0,{}\n1,2024-01-02,1,7.0,{}\n")
+    with open(os.path.join(folder, "daily.csv"), "w") as table_file:
+        table_file.write("system:index,date,pfi,mndwi_area,.geo\n0,2024-01-04,1,8.0,{}\n1,2024-01-03,1,9.0,{}\n")
+    # "error" makes one status request raise, as a network error would
+    scripts = {"task-a": ["READY", "error", "RUNNING", "RUNNING", "RUNNING", "COMPLETED"], "task-b": ["READY", "FAILED"]}
+    polls = []
+
+    def status(task_id):
+        polls.append(task_id)
+        states = scripts[task_id]
+        state = states.pop(0) if len(states) > 1 else states[0]
+        if state == "error":
+            raise ConnectionError("injected status error")
+        return state, ("quota" if state == "FAILED" else None)
+
+    async def no_wait(delay):
+        await asyncio.sleep(0)
+
+    monitor = TaskMonitor(status, on_complete=lambda task, context: merge_export(store, "update.csv", "master.csv"),
+                          sleep=no_wait)
+    summaries = monitor.run([("task-a", None), ("task-b", None)])
+    # A daily update after the watermark is appended to the master without downloading it
+    appended = merge_export(store, "daily.csv", "master.csv")
+    with open(os.path.join(folder, "master.csv")) as table_file:
+        rows = table_file.read().splitlines()
+    manifest = read_manifest(store, "master.csv")
+    shutil.rmtree(folder)
+    print(f"{len(monitor.transitions)} transitions, {len(polls)} polls, master rows: {rows[1:]}")
+    return ([summary["state"] for summary in summaries] == ["COMPLETED", "FAILED"] and appended.get("appended") == 2
+            and rows == ["date,pfi,mndwi_area", "2024-01-01,1,6.0", "2024-01-02,1,7.0", "2024-01-03,1,9.0", "2024-01-04,1,8.0"]
+            and manifest["rows"] == 4 and manifest["last_date"] == "2024-01-04")
+
+
+if __name__ == '__main__':
+    print("Task monitor check passed" if fake_check() else "Task monitor check failed")
@@ -0,0 +1,263 @@
+# WatermarkManifest.py
+# Remote Sensing Team
+# Department of Regional Development, Manufacturing and Water
+
+"""
+Sidecar manifest written alongside each master statistics table (e.g. sentinel2_daily_mndwi_statistics.csv),
+recording the last processed date, the row count and the schema version. The Timeseries scripts read the
+manifest instead of downloading and parsing the whole master CSV to find date.max().
+
+The manifest also stores the master table's signature (generation and size in the bucket, size and mtime
+locally). When the table has changed since the manifest was written, or the manifest is missing, the table is
+scanned once and the manifest rewritten, so a master merged by hand never leaves a stale watermark.
+
+LocalStore is a local-directory stand-in for the bucket, for testing without Google Cloud Storage (--check runs
+the manifest cycle on one).
+Usage: python WatermarkManifest.py sentinel2_daily_mndwi_statistics.csv --folder data
+       python WatermarkManifest.py sentinel2_daily_mndwi_statistics.csv --bucket sentinel2_timeseries --key service_key.json
+       python WatermarkManifest.py --check
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from ExportSchema import parse_date
+
+SCHEMA_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+class LocalStore:
+    # Tables and manifests in a local directory, standing in for the bucket
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def signature(self, name):
+        path = os.path.join(self.folder, name)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def read_bytes(self, name):
+        path = os.path.join(self.folder, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as table_file:
+            return table_file.read()
+
+    def write_bytes(self, name, data, content_type="application/octet-stream"):
+        # Written under a temporary name and renamed, so readers never see a partial file
+        path = os.path.join(self.folder, name)
+        with open(path + ".tmp", "wb") as table_file:
+            table_file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def download(self, name, path):
+        # Copy a table to a local path; False when it does not exist
+        source = os.path.join(self.folder, name)
+        if not os.path.exists(source):
+            return False
+        shutil.copyfile(source, path)
+        return True
+
+    def upload(self, path, name):
+        target = os.path.join(self.folder, name)
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+    def append(self, name, path):
+        # Add the bytes of a local file to the end of a table
+        with open(path, "rb") as source, open(os.path.join(self.folder, name), "ab") as target:
+            shutil.copyfileobj(source, target)
+
+    def delete(self, name):
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class BucketStore:
+    # Tables and manifests in a Google Cloud Storage bucket (google.cloud.storage Bucket)
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def signature(self, name):
+        # Blob metadata only, the table itself is not downloaded
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return [blob.generation, blob.size]
+
+    def read_bytes(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return blob.download_as_bytes()
+
+    def write_bytes(self, name, data, content_type="application/octet-stream"):
+        self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+
+    def download(self, name, path):
+        # Stream a blob to a local path without holding it in memory; False when it does not exist
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return False
+        blob.download_to_filename(path)
+        return True
+
+    def upload(self, path, name):
+        # A GCS upload replaces the blob atomically once complete
+        self.bucket.blob(name).upload_from_filename(path)
+
+    def append(self, name, path):
+        # Compose the table with an uploaded part on the server, so the table itself is never downloaded
+        part = self.bucket.blob(name + ".append.tmp")
+        part.upload_from_filename(path)
+        try:
+            table = self.bucket.blob(name)
+            table.compose([self.bucket.get_blob(name), part])
+        finally:
+            part.delete()
+
+    def delete(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is not None:
+            blob.delete()
+
+
+def manifest_name(table):
+    return table + MANIFEST_SUFFIX
+
+
+def read_manifest(store, table):
+    # The table's manifest, or None when it is missing or from another schema version
+    data = store.read_bytes(manifest_name(table))
+    if data is None:
+        return None
+    try:
+        manifest = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if manifest.get("schema_version") != SCHEMA_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(store, table, last_date, rows, columns, signature=None):
+    """
+    Write the manifest of a master table. signature is the table's store signature when the manifest was
+    built from it (defaults to the table's current signature), used to detect a table changed since.
+    """
+    manifest = {
+        "schema_version": SCHEMA_VERSION,
+        "table": table,
+        "last_date": last_date,
+        "rows": rows,
+        "columns": list(columns),
+        "table_signature": signature if signature is not None else store.signature(table),
+        "updated": datetime.now().isoformat(timespec="seconds"),
+    }
+    store.write_bytes(manifest_name(table), json.dumps(manifest, indent=2).encode("utf-8"), "application/json")
+    return manifest
+
+
+def rebuild_manifest(store, table, date_column="date"):
+    """
+    Scan the master table once and write its manifest; None when the table does not exist.
+    The table is streamed from a local copy, and dates are read in either export format (ExportSchema.py).
+    """
+    signature = store.signature(table)
+    work_folder = tempfile.mkdtemp(prefix="manifest_")
+    try:
+        path = os.path.join(work_folder, os.path.basename(table))
+        if not store.download(table, path):
+            return None
+        last_date = None
+        rows = 0
+        with open(path, newline="") as table_file:
+            reader = csv.DictReader(table_file)
+            columns = reader.fieldnames or []
+            for row in reader:
+                rows += 1
+                day = parse_date(row.get(date_column))
+                if day is not None and (last_date is None or day > last_date):
+                    last_date = day
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return write_manifest(store, table, last_date.isoformat() if last_date else None, rows, columns, signature)
+
+
+def last_capture_date(store, table, date_column="date"):
+    """
+    Last processed date ('YYYY-MM-DD') of a master table, or None when there is no table yet.
+    Reads only the manifest; the table is scanned (and the manifest rewritten) only when the manifest is
+    missing or the table changed since it was written.
+    """
+    signature = store.signature(table)
+    if signature is None:
+        return None
+    manifest = read_manifest(store, table)
+    if manifest is None or manifest.get("table_signature") != signature:
+        print("    Manifest missing or out of date, scanning the master table once")
+        manifest = rebuild_manifest(store, table, date_column)
+        if manifest is None:
+            return None
+    return manifest["last_date"]
+
+
+def manifest_check():
+    # Manifest cycle on a LocalStore: rebuild from dd-MM-YYYY dates, read back, rebuild after the table changes
+    folder = tempfile.mkdtemp(prefix="manifest_check_")
+    try:
+        store = LocalStore(folder)
+        table = "sentinel2_daily_mndwi_statistics.csv"
+        ok = last_capture_date(store, table) is None
+        store.write_bytes(table, b"date,pfi,mndwi_area\n05-03-2024,1,2.0\n12-02-2024,1,3.0\n31-12-2023,2,1.0\n")
+        ok &= last_capture_date(store, table) == "2024-03-05"
+        manifest = read_manifest(store, table)
+        ok &= manifest["rows"] == 3 and manifest["table_signature"] == store.signature(table)
+        # Unchanged table: the manifest is used as written
+        store.write_bytes(manifest_name(table), json.dumps(dict(manifest, last_date="2024-03-06")).encode("utf-8"))
+        ok &= last_capture_date(store, table) == "2024-03-06"
+        # Changed table (e.g. merged by hand): the stale manifest is rebuilt
+        store.write_bytes(table, b"date,pfi,mndwi_area\n2024-04-01,1,2.0\n05-03-2024,1,2.0\n")
+        ok &= last_capture_date(store, table) == "2024-04-01" and read_manifest(store, table)["rows"] == 2
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the manifest of a master statistics table")
+    parser.add_argument("table", nargs="?")
+    parser.add_argument("--folder", help="Local directory standing in for the bucket")
+    parser.add_argument("--bucket")
+    parser.add_argument("--key", help="Service account JSON for the bucket")
+    parser.add_argument("--check", action="store_true", help="Check the manifest cycle on a temporary LocalStore")
+    args = parser.parse_args()
+    if args.check:
+        print("Manifest check passed" if manifest_check() else "Manifest check failed")
+        return
+    if not args.table:
+        parser.error("a table is required")
+    if args.folder:
+        store = LocalStore(args.folder)
+    else:
+        from google.cloud import storage
+        client = storage.Client.from_service_account_json(args.key) if args.key else storage.Client()
+        store = BucketStore(client.get_bucket(args.bucket))
+    manifest = rebuild_manifest(store, args.table)
+    print(json.dumps(manifest, indent=2) if manifest else f"{args.table} not found")
+
+
+if __name__ == '__main__':
+    main()